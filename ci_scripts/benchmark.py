@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_vertex import add_config_arguments, config_from_args, start_server
+
+# --- レイテンシ・スループットのベンチマーク ---
+# 本番の認証情報なしに call_api / call_judge / get_embeddings の性能変化を測るため、
+# ローカルのモックサーバ (mock_vertex.py) に対して compare_models.py の実装をそのまま呼び出す。
+# 結果は JSON のベースラインとして保存し、次回の計測と比較できる。
+
+SCENARIOS = ("generate", "judge", "embedding", "single", "batch")
+DEFAULT_OUTPUT = "benchmark_baseline.json"
+# 比較時に「悪化」とみなす変化率
+DEFAULT_TOLERANCE = 0.10
+
+def load_compare_models(api_base):
+    """モックサーバに向けた設定で compare_models を読み込む
+
+    compare_models はモジュール読み込み時に環境変数から設定を読むため、先に環境変数を設定する。
+    キャッシュ類は計測を歪めるため、結果ストアは計測用の回答で履歴を汚さないため無効化する。
+    """
+    os.environ["VERTEX_API_BASE"] = api_base
+    os.environ.setdefault("VERTEX_API_KEY", "mock-key")
+    os.environ.setdefault("GCP_PROJECT_ID", "mock-project")
+    os.environ.setdefault("VERTEX_ENDPOINT_ID", "mock-endpoint")
+    for prefix in ("RESPONSE_CACHE", "JUDGE_CACHE", "EMBEDDING_STORE", "RESULTS_STORE"):
+        os.environ[f"{prefix}_DISABLED"] = "1"
+    import compare_models
+    return compare_models
+
+def percentile(sorted_values, q):
+    """線形補間したパーセンタイルを返す"""
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+def distribution(values):
+    """秒単位の値の分布をミリ秒で返す"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+class Recorder:
+    """1シナリオ分の計測値を集める"""
+
+    def __init__(self):
+        self.latencies = []
+        self.ttfts = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency, ttft=None, error=False):
+        with self._lock:
+            self.latencies.append(latency)
+            if ttft is not None:
+                self.ttfts.append(ttft)
+            if error:
+                self.errors += 1
+
+def _timed(recorder, func):
+    """func の所要時間を記録する。例外を送出するか、真の値 (エラー内容) を返した場合は失敗として数える"""
+    started_at = time.monotonic()
+    try:
+        error = func()
+    except Exception:
+        error = True
+    recorder.add(time.monotonic() - started_at, error=bool(error))
+
+def run_scenario(cm, name, iterations, concurrency, prompts, answer, batch_workers):
+    """シナリオを実行し、(Recorder, 経過秒) を返す
+
+    answer は審判・埋め込みの入力に使う回答テキスト (ウォームアップで生成したもの)。
+    """
+    recorder = Recorder()
+
+    def prompt_at(i):
+        return prompts[i % len(prompts)]
+
+    def generate(i):
+        # TTFT を計測するため call_api ではなく stream_generate を直接呼ぶ
+        stats = cm.StreamStats("Benchmark")
+        payload = {
+            "contents": [{"role": "user", "parts": [{"text": prompt_at(i)}]}],
+            "generationConfig": {"maxOutputTokens": 8192, "temperature": 0.7},
+        }
+        try:
+            for _ in cm.stream_generate(cm.tuned_model_url(), payload, stats):
+                pass
+        except Exception:
+            recorder.add(time.monotonic() - stats.started_at, error=True)
+            return
+        recorder.add(stats.elapsed, stats.ttft)
+
+    def judge(i):
+        _timed(recorder, lambda: cm.call_judge(answer, prompt_at(i))[1])
+
+    def embedding(i):
+        # 埋め込みストアは無効化済みだが、同一テキストの重複排除を避けるため番号を付ける
+        _timed(recorder, lambda: cm.get_embeddings([f"{answer}\n#{i}", prompt_at(i)]) and None)
+
+    def single(i):
+        _timed(recorder, lambda: cm.evaluate_item({"prompt": prompt_at(i), "reference": answer}).get("error"))
+
+    started_at = time.monotonic()
+    if name == "batch":
+        # バッチはスイート全体を1回の run_batch で評価する (項目ごとの所要時間は計測しない)
+        items = [{"prompt": prompt_at(i), "reference": answer} for i in range(iterations)]
+        recorder.errors = sum(1 for result in cm.run_batch(items, workers=batch_workers) if "error" in result)
+    else:
+        task = {"generate": generate, "judge": judge, "embedding": embedding, "single": single}[name]
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            list(executor.map(task, range(iterations)))
+    return recorder, time.monotonic() - started_at
+
+def summarize(recorder, elapsed, iterations, server_stats_before, server_stats_after):
+    requests = server_stats_after["requests"] - server_stats_before["requests"]
+    throttled = server_stats_after["throttled"] - server_stats_before["throttled"]
+    return {
+        "iterations": iterations,
+        "errors": recorder.errors,
+        "http_requests": requests,
+        "throttled": throttled,
+        "wall_sec": round(elapsed, 3),
+        "iterations_per_sec": round(iterations / elapsed, 2) if elapsed else None,
+        "requests_per_sec": round(requests / elapsed, 2) if elapsed else None,
+        "latency": distribution(recorder.latencies),
+        "ttft": distribution(recorder.ttfts),
+    }
+
+# 比較対象の指標 (値が大きいほど悪いか)
+COMPARED_METRICS = [
+    ("latency", "p50_ms", True),
+    ("latency", "p95_ms", True),
+    ("latency", "p99_ms", True),
+    ("ttft", "p50_ms", True),
+    ("ttft", "p95_ms", True),
+    (None, "requests_per_sec", False),
+    (None, "iterations_per_sec", False),
+]
+
+def compare(baseline, current, tolerance):
+    """ベースラインとの差分を表示し、許容範囲を超えて悪化した指標のリストを返す"""
+    regressions = []
+    print(f"\nComparison with baseline ({baseline.get('created_at', '?')}, tolerance {tolerance:.0%}):")
+    for name, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for group, key, higher_is_worse in COMPARED_METRICS:
+            old = (base.get(group) or {}).get(key) if group else base.get(key)
+            new = (result.get(group) or {}).get(key) if group else result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            label = f"{name}.{group + '.' if group else ''}{key}"
+            print(f"  {label:<36} {old:>10} -> {new:>10} ({change:+.1%}){'  ⚠️ regression' if worse else ''}")
+            if worse:
+                regressions.append(label)
+    return regressions
+
+def format_report(results):
+    lines = [f"Benchmark against {results['server']} ({'mock' if results['mock'] else 'external'} server)"]
+    for name, result in results["scenarios"].items():
+        lines.append(
+            f"\n[{name}] {result['iterations']} iterations, {result['errors']} errors, "
+            f"{result['http_requests']} HTTP requests ({result['throttled']} throttled), "
+            f"{result['wall_sec']}s, {result['iterations_per_sec']} it/s, {result['requests_per_sec']} req/s"
+        )
+        for group in ("latency", "ttft"):
+            dist = result.get(group)
+            if dist:
+                lines.append(
+                    f"  {group:<8} p50 {dist['p50_ms']}ms / p95 {dist['p95_ms']}ms / "
+                    f"p99 {dist['p99_ms']}ms / max {dist['max_ms']}ms"
+                )
+    return "\n".join(lines)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark compare_models.py against a local mock Vertex AI server.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Scenario to run (repeatable, default: all).")
+    parser.add_argument("--iterations", type=int, default=50, help="Calls per scenario (items for batch).")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent calls for generate/judge/embedding/single.")
+    parser.add_argument("--workers", type=int, default=4, help="Workers for the batch scenario.")
+    parser.add_argument("--suite", help="JSONL prompt suite to cycle through (same format as --mode batch).")
+    parser.add_argument("--server-url", help="Benchmark an already running server instead of starting the mock.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Write the results as JSON to this path.")
+    parser.add_argument("--compare", help="Baseline JSON to compare against (exit 1 on regression).")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative change treated as a regression.")
+    parser.add_argument("--verbose", action="store_true", help="Keep per-request logs from compare_models on stderr.")
+    add_config_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    config = config_from_args(args)
+    server = None if args.server_url else start_server(config)
+    api_base = args.server_url or server.url
+    cm = load_compare_models(api_base)
+    # バッチモードと同じ形式のプロンプト集を使う
+    prompts = [item["prompt"] for item in cm.load_suite(args.suite)] if args.suite else [cm.DEFAULT_PROMPT]
+    stats = (lambda: dict(server.stats)) if server else (lambda: {"requests": 0, "throttled": 0})
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "server": api_base,
+        "mock": server is not None,
+        "mock_config": config.to_dict() if server else None,
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "batch_workers": args.workers,
+        "prompts": len(prompts),
+        "scenarios": {},
+    }
+    with open(os.devnull, "w") as devnull:
+        quiet = (lambda: contextlib.nullcontext()) if args.verbose else (lambda: contextlib.redirect_stderr(devnull))
+        # 審判・埋め込みの入力にする回答を1件生成しておく (接続の確立も兼ねる)
+        with quiet():
+            answer, error = cm.call_api(cm.base_model_url(), prompts[0], "Warmup")
+        if error:
+            print(f"Error: warmup request failed: {error}", file=sys.stderr)
+            sys.exit(1)
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}...", file=sys.stderr)
+            before = stats()
+            with quiet():
+                recorder, elapsed = run_scenario(cm, name, args.iterations, args.concurrency, prompts, answer, args.workers)
+            results["scenarios"][name] = summarize(recorder, elapsed, args.iterations, before, stats())
+
+    print(format_report(results))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if server:
+        server.shutdown()
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import re
+
+# --- 長文の分割 ---
+# 埋め込みモデルの入力上限を超える回答を、段落 → 文の順に自然な境界で分割する。
+
+SENTENCE_END = re.compile(r"(?<=[。！？!?])")
+
+def _split_sentences(paragraph):
+    return [s for s in SENTENCE_END.split(paragraph) if s.strip()]
+
+def _hard_split(text, max_chars):
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+def chunk_text(text, max_chars):
+    """text を max_chars 以下のチャンクに分割して返す
+
+    段落 (改行) 単位で詰め込み、段落が長すぎる場合は文末 (。！？) で分割する。
+    それでも収まらない文は文字数で機械的に切る。
+    """
+    if len(text) <= max_chars:
+        return [text]
+
+    # (直前との区切り文字, 断片) のリスト。同じ段落内の文は区切りなしで連結する
+    pieces = []
+    for paragraph in text.split("\n"):
+        if not paragraph.strip():
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(("\n", paragraph))
+            continue
+        sep = "\n"
+        for sentence in _split_sentences(paragraph):
+            for part in ([sentence] if len(sentence) <= max_chars else _hard_split(sentence, max_chars)):
+                pieces.append((sep, part))
+                sep = ""
+
+    chunks, current = [], ""
+    for sep, piece in pieces:
+        candidate = f"{current}{sep}{piece}" if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+        else:
+            chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
@@ -1,8 +1,27 @@
 import os
 import json
-import urllib.request
-import urllib.error
+import hashlib
 import sys
+import time
+import atexit
+import random
+import statistics
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.vertex_client import RequestCanceller, session as http_session
+
+from chunking import chunk_text
+from embedding_store import EmbeddingStore, make_key as make_embedding_key
+from json_stream import JsonObjectScanner, iter_json_objects
+from lexical import reference_similarities as lexical_similarities
+from metrics import METRICS, SCORE_PREFIX, distribution, evaluate_response, is_informational
+from response_cache import DEFAULT_JUDGE_CACHE_PATH, ResponseCache, make_key
+from sequential import DEFAULT_ALPHA, DEFAULT_MIN_ITEMS, SequentialMonitor
+from similarity import POOLING_METHODS, pairwise, pool_vectors, similarity_matrix, top_k
+from hedging import Hedger
+from results_store import ResultsStore, default_run_id
+from tracing import TRACER
 
 # --- Configuration from Environment Variables ---
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
@@ -10,107 +29,341 @@ REGION = os.environ.get("GCP_REGION", "us-central1")
 VERTEX_API_KEY = os.environ.get("VERTEX_API_KEY")
 VERTEX_ENDPOINT_ID = os.environ.get("VERTEX_ENDPOINT_ID")
 BASE_MODEL_ID = "gemini-2.5-flash"
+# API のベースURL。ローカルのモックサーバ (mock_vertex.py) に向ける場合に上書きする
+VERTEX_API_BASE = os.environ.get("VERTEX_API_BASE") or f"https://{REGION}-aiplatform.googleapis.com"
+
+# 同一モデル・プロンプト・generationConfig の応答を再利用するディスクキャッシュ
+RESPONSE_CACHE = ResponseCache.from_env()
+# チューニング済みモデルへのヘッジリクエスト (--hedge または HEDGE_ENABLED で有効化)
+HEDGER = Hedger.from_env()
+# 全モードの評価結果を追記する履歴ストア (ci_scripts/results_store.py で比較する)
+RESULTS_STORE = ResultsStore.from_env()
+RUN_ID = default_run_id()
 
 # Default Prompt if not provided via args
 DEFAULT_PROMPT = "部下から『モチベーションが上がらない』と相談されました。どう対応しますか？"
 
-def call_api(model_resource_url, prompt, label):
-    url = f"{model_resource_url}:streamGenerateContent?key={VERTEX_API_KEY}"
-    
+BASE_HEADING = f"### 🔹 Base Model ({BASE_MODEL_ID})"
+TUNED_HEADING = "### 🔸 Tuned Model (Fine-Tuned)"
+
+# チューニング済みモデルは "endpoint/<エンドポイントID>" で指定する (結果ストアのモデル名と同じ形式)
+ENDPOINT_PREFIX = "endpoint/"
+
+def model_url(model):
+    """モデル指定 (パブリッシャーのモデルID または "endpoint/<エンドポイントID>") の URL を返す"""
+    prefix = f"{VERTEX_API_BASE}/v1beta1/projects/{PROJECT_ID}/locations/{REGION}"
+    if model.startswith(ENDPOINT_PREFIX):
+        return f"{prefix}/endpoints/{model[len(ENDPOINT_PREFIX):]}"
+    return f"{prefix}/publishers/google/models/{model}"
+
+def tuned_model_id():
+    return f"{ENDPOINT_PREFIX}{VERTEX_ENDPOINT_ID}"
+
+def base_model_url():
+    return model_url(BASE_MODEL_ID)
+
+def tuned_model_url():
+    return model_url(tuned_model_id())
+
+class StreamStats:
+    """ストリーミング1回分の計測値 (TTFT・所要時間・出力トークン数)"""
+
+    def __init__(self, label=""):
+        self.label = label
+        self.started_at = time.monotonic()
+        self.ttft = None
+        self.elapsed = None
+        self.output_tokens = 0
+        self.chunks = 0
+        self.early_exit = False
+
+    def mark_text(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.started_at
+        self.chunks += 1
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started_at
+
+    @property
+    def tokens_per_sec(self):
+        # 最初のトークン以降の生成速度 (TTFT はネットワーク・キュー待ちを含むため除外)
+        if not self.elapsed or not self.output_tokens:
+            return 0.0
+        gen_time = self.elapsed - (self.ttft or 0.0)
+        return self.output_tokens / gen_time if gen_time > 0 else 0.0
+
+    def summary(self):
+        ttft = f"{self.ttft:.2f}s" if self.ttft is not None else "-"
+        elapsed = f"{self.elapsed:.2f}s" if self.elapsed is not None else "-"
+        return (
+            f"⏱ {self.label}: TTFT {ttft} / total {elapsed} / "
+            f"{self.output_tokens} tokens ({self.tokens_per_sec:.1f} tokens/s)"
+            + (" [early exit]" if self.early_exit else "")
+        )
+
+def stream_generate(model_resource_url, payload, stats=None, span_name="generate", hedge_attempt=None):
+    """streamGenerateContent を SSE (alt=sse) で受信し、テキスト断片を到着順に yield する
+
+    レスポンス全体をメモリに保持せず、`data:` 行ごとに JSON をパースする。
+    呼び出し全体を span_name の Span として記録する。hedge_attempt (hedging.HedgeAttempt) を
+    渡すと最初の断片の到着を通知し、キャンセルされた時点で黙って受信を終える。
+    """
+    url = f"{model_resource_url}:streamGenerateContent?alt=sse&key={VERTEX_API_KEY}"
+    canceller = None
+    if hedge_attempt is not None:
+        # 応答ヘッダが届く前 (コールドなレプリカで止まっている間) でも切断できるよう、送信前に登録する
+        canceller = RequestCanceller()
+        hedge_attempt.register(canceller.cancel)
+    with TRACER.span(span_name) as span:
+        try:
+            # 生成は副作用がないため、5xx・通信エラーでも再送してよい
+            with http_session().request("POST", url, json_body=payload, idempotent=True,
+                                        canceller=canceller) as response:
+                span.bytes_sent = response.request_bytes
+                span.retries += response.retries
+                for raw_line in response:
+                    span.bytes_received += len(raw_line)
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    item = json.loads(line[len("data:"):])
+                    usage = item.get("usageMetadata")
+                    if usage:
+                        span.record_usage(usage)
+                        if stats is not None:
+                            stats.output_tokens = usage.get("candidatesTokenCount", stats.output_tokens)
+                    for cand in item.get("candidates", []):
+                        for part in cand.get("content", {}).get("parts", []):
+                            text = part.get("text", "")
+                            if text:
+                                if stats is not None:
+                                    stats.mark_text()
+                                if hedge_attempt is not None:
+                                    hedge_attempt.mark_first_byte()
+                                yield text
+        except Exception:
+            if hedge_attempt is not None and hedge_attempt.cancelled.is_set():
+                return
+            raise
+        finally:
+            # 受信中に切断されると例外ではなく EOF で終わることもあるため、ここでまとめて印を付ける
+            if hedge_attempt is not None and hedge_attempt.cancelled.is_set():
+                span.attrs["cancelled"] = True
+            if stats is not None:
+                stats.finish()
+
+def record_cache_hit(span_name):
+    """キャッシュから応答を返した呼び出しを Span として記録する"""
+    with TRACER.span(span_name) as span:
+        span.cached = True
+
+# ストリームの途中で切断された場合に、生成をやり直す回数
+GENERATION_STREAM_ATTEMPTS = int(os.environ.get("GENERATION_STREAM_ATTEMPTS", "3"))
+
+def _generate(model_resource_url, payload, label, on_text=None, hedge_attempt=None):
+    """ストリーミングで生成し、(テキスト, エラー) を返す
+
+    接続前の 429・5xx は共通クライアントが再送する。受信途中で切断された場合は、
+    まだ on_text に断片を渡していなければ最初から生成し直す (渡した後は重複するため諦める)。
+    """
+    if hedge_attempt is not None and hedge_attempt.hedged:
+        label = f"{label}, hedge"
+    span_name = f"generate ({label})"
+    for attempt in range(GENERATION_STREAM_ATTEMPTS):
+        stats = StreamStats(label)
+        parts = []
+        try:
+            for text in stream_generate(model_resource_url, payload, stats, span_name, hedge_attempt):
+                parts.append(text)
+                if on_text:
+                    on_text(text)
+            break
+        except json.JSONDecodeError as e:
+            return None, f"Error parsing JSON: {e}"
+        except Exception as e:
+            # 接続前のエラーは共通クライアントで再試行済み (例外が retries 属性を持つ)
+            if hasattr(e, "retries") or (parts and on_text) or attempt + 1 >= GENERATION_STREAM_ATTEMPTS:
+                return None, f"Error ({label}): {e}"
+            time.sleep(http_session().retry_policy.delay(attempt))
+        finally:
+            print(stats.summary(), file=sys.stderr)
+    if hedge_attempt is not None and hedge_attempt.cancelled.is_set():
+        return None, f"Error ({label}): cancelled"
+    return "".join(parts), None
+
+def call_api(model_resource_url, prompt, label, on_text=None):
+    """モデルに生成させた全文を (テキスト, エラー) で返す。on_text を渡すと断片を受信するたびに呼び出す
+
+    失敗時のテキストは None で、エラー内容を採点しないよう呼び出し側で区別する。
+    ヘッジが有効な場合、チューニング済みモデル (エンドポイント) への呼び出しは HEDGER 経由で送る
+    (断片を逐次出力する on_text 指定時は、出力が重複するためヘッジしない)。
+    """
     payload = {
         "contents": [{"role": "user", "parts": [{"text": prompt}]}],
         "generationConfig": {"maxOutputTokens": 8192, "temperature": 0.7}
     }
-    
-    headers = {"Content-Type": "application/json"}
-    data = json.dumps(payload).encode("utf-8")
-    
-    full_text = ""
-    try:
-        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-        with urllib.request.urlopen(req) as response:
-            full_resp = response.read().decode("utf-8")
+
+    cache_key = make_key(model_resource_url, payload)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        record_cache_hit(f"generate ({label})")
+        if on_text:
+            on_text(cached)
+        return cached, None
+
+    if HEDGER.enabled and on_text is None and "/endpoints/" in model_resource_url:
+        full_text, error = HEDGER.run(
+            model_resource_url,
+            lambda hedge_attempt: _generate(model_resource_url, payload, label, hedge_attempt=hedge_attempt),
+        )
+    else:
+        full_text, error = _generate(model_resource_url, payload, label, on_text)
+    if error:
+        return None, error
+    RESPONSE_CACHE.put(cache_key, full_text)
+    return full_text, None
+
+def run_concurrently(prompt, targets):
+    """複数モデルへの call_api を並列実行し、targets と同じ順序で (テキスト, エラー) のリストを返す
+
+    各リクエストの例外は個別にエラーへ変換し、他方をキャンセルしない。
+    """
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(call_api, url, prompt, label) for url, label in targets]
+        results = []
+        for future, (_, label) in zip(futures, targets):
             try:
-                resp_list = json.loads(full_resp)
-                for item in resp_list:
-                    if "candidates" in item:
-                        for cand in item["candidates"]:
-                             if "content" in cand and "parts" in cand["content"]:
-                                 for part in cand["content"]["parts"]:
-                                     full_text += part.get("text", "")
+                results.append(future.result())
             except Exception as e:
-                return f"Error parsing JSON: {e}"
-    except Exception as e:
-        return f"Error ({label}): {e}"
-    
-    return full_text
+                results.append((None, f"Error ({label}): {e}"))
+    return results
 
 import argparse
 import re
 
 # --- 定量評価ロジック ---
+# 指標の計算は metrics.py の登録済み指標 (register_metric) で行う。
 
-def evaluate_response(text):
-    """テキストから定量指標を計算して返す"""
-    char_count = len(text)
-    paragraphs = [p for p in text.split("\n") if p.strip()]
-    paragraph_count = len(paragraphs)
-    effective_char_count = len(text.replace(" ", "").replace("　", "").replace("\n", "").replace("\r", ""))
-    # リスト項目数 (「-」「・」「*」「○」「•」で始まる行)
-    list_items = len([p for p in text.split("\n") if re.match(r"^\s*[-・*○•・・]|^\s*\d+[.)）]", p)])
-    # 文字数 / 段落数 = 平均段落文字数
-    avg_para_length = round(effective_char_count / paragraph_count) if paragraph_count > 0 else 0
-    # 疑問文数 (「？」「？」で終わる行)
-    question_count = len([p for p in text.split("\n") if p.strip().endswith(("？", "?"))])
-    return {
-        "char_count": char_count,
-        "paragraph_count": paragraph_count,
-        "effective_char_count": effective_char_count,
-        "list_items": list_items,
-        "avg_para_length": avg_para_length,
-        "question_count": question_count,
-    }
+# 定量評価レポートに載せる指標 (表示名, evaluate_response のキー, 説明)
+SCORE_METRICS = [(metric.label, metric.name, metric.description) for metric in METRICS.values()]
+# 勝敗・ランキングに数える指標 (大小に良し悪しのない参考指標を除く)
+RANKED_METRICS = [key for key, metric in METRICS.items() if not metric.informational]
 
 def format_score_report(base_score, tuned_score):
     """両スコアを比較してMarkdown形式の評価サマリーを返す"""
-    rows = [
-        ("文字数", base_score["char_count"], tuned_score["char_count"], "回答の総分量。多いほど詳細な回答"),
-        ("実質文字数", base_score["effective_char_count"], tuned_score["effective_char_count"], "空白・改行除く内容密度"),
-        ("段落数", base_score["paragraph_count"], tuned_score["paragraph_count"], "回答の構造化度合い"),
-        ("リスト項目数", base_score["list_items"], tuned_score["list_items"], "箇条書き等の具体的な列挙"),
-        ("平均段落文字数", base_score["avg_para_length"], tuned_score["avg_para_length"], "各段落の情報密度（高すぎると読みにくい）"),
-        ("疑問文数", base_score["question_count"], tuned_score["question_count"], "相談者への考察促進の指標"),
-    ]
+    rows = [(label, base_score[key], tuned_score[key], desc, METRICS[key].informational) for label, key, desc in SCORE_METRICS]
 
     table_lines = [
         "| 指標 | 🔹 ベースモデル | 🔸 チューニング済み | 差分 | 計測内容 |",
         "|---|---|---|---|---|",
     ]
     win_count = 0
-    for label, base_val, tuned_val, desc in rows:
-        diff = tuned_val - base_val
+    for label, base_val, tuned_val, desc, informational in rows:
+        # 敬語率などの小数の指標で浮動小数点の誤差を表示しないよう丸める
+        diff = round(tuned_val - base_val, 2)
         sign = "+" if diff >= 0 else ""
-        mark = "✅" if diff > 0 else ("➖" if diff == 0 else "⚠️")
-        if diff > 0:
+        if informational:
+            mark = "ℹ️"
+        else:
+            mark = "✅" if diff > 0 else ("➖" if diff == 0 else "⚠️")
+        if diff > 0 and not informational:
             win_count += 1
         table_lines.append(f"| {label} | {base_val} | {tuned_val} | {sign}{diff} {mark} | {desc} |")
 
-    if win_count == len(rows):
+    ranked = len(RANKED_METRICS)
+    if win_count == ranked:
         verdict = "**判定:** チューニング済みモデルの回答がすべての指標で上回っています。"
     elif win_count > 0:
-        verdict = f"**判定:** チューニング済みモデルが {win_count}/{len(rows)} 指標で上回っています。"
+        verdict = f"**判定:** チューニング済みモデルが {win_count}/{ranked} 指標で上回っています。"
     else:
         verdict = "**判定:** ベースモデルと同等かそれ以上の結果です。チューニングデータの見直しを検討してください。"
 
     report = "## 📊 定量評価サマリー\n\n"
     report += "\n".join(table_lines)
     report += f"\n\n{verdict}\n"
+    if ranked < len(rows):
+        report += "\n> ℹ️ の指標は大小に良し悪しのない参考値のため、判定には数えません。\n"
     return report
 
+# --- 処理時間・トークン数のレポート ---
+
+TRACE_LABELS = {
+    "generate (Base Model)": "🔹 生成 (ベース)",
+    "generate (Tuned Model)": "🔸 生成 (チューニング済み)",
+    "generate (Tuned Model, hedge)": "🔸 生成 (チューニング済み・ヘッジ)",
+    "judge": "🧑\u200d⚖️ 審判",
+    "embedding": "🔍 埋め込み",
+    "stage: generate": "ステージ: 生成",
+    "stage: score": "ステージ: 定量評価",
+    "stage: judge": "ステージ: 審判",
+    "stage: similarity": "ステージ: 類似度",
+    "format: score": "整形: 定量評価",
+    "format: judge": "整形: 審判",
+    "format: similarity": "整形: 類似度",
+}
+
+def _format_bytes(n):
+    return f"{n / 1024:.1f} KB" if n >= 1024 else f"{n} B"
+
+def format_trace_report(summary, hedging=None):
+    """TRACER.summary() の集計をMarkdown形式の表で返す (hedging は HEDGER.to_dict())"""
+    table_lines = [
+        "| 処理 | 回数 | 合計時間 | 最大時間 | 入力トークン | 出力トークン | 送信 / 受信 | リトライ | キャッシュ |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    # API 呼び出し → ステージ → 整形 の順に並べる
+    kind_order = {"api": 0, "stage": 1, "format": 2}
+    rows = sorted(summary.items(), key=lambda item: kind_order.get(item[1]["kind"], len(kind_order)))
+    for name, row in rows:
+        label = TRACE_LABELS.get(name, name)
+        count = f"{row['count']}" + (f" (エラー {row['errors']})" if row["errors"] else "")
+        if row["kind"] == "api":
+            detail = (
+                f"{row['prompt_tokens']} | {row['output_tokens']} | "
+                f"{_format_bytes(row['bytes_sent'])} / {_format_bytes(row['bytes_received'])} | "
+                f"{row['retries']} | {row['cached']}"
+            )
+        else:
+            detail = "- | - | - | - | -"
+        table_lines.append(f"| {label} | {count} | {row['total_sec']:.2f}s | {row['max_sec']:.2f}s | {detail} |")
+
+    report = "## ⏱ 処理時間・トークン数\n\n"
+    report += "\n".join(table_lines)
+    report += "\n\n> 合計時間は呼び出しごとの所要時間の合計です (並列に実行した分も足し合わせています)。\n"
+    if hedging:
+        report += (
+            f"\n**ヘッジ:** チューニング済みモデルへの {hedging['requests']} 件中 {hedging['fired']} 件でヘッジを送信し、"
+            f"{hedging['won']} 件でヘッジ側が先に完了しました。\n"
+        )
+    return report
+
+def trace_extras():
+    """メトリクス JSON に追加する値 (ヘッジの発火・勝利回数)"""
+    return {"hedging": HEDGER.to_dict()} if HEDGER.enabled else {}
+
 # --- LLM-as-Judge ロジック ---
 
 JUDGE_CRITERIA = ["実用性", "共感性", "専門性"]
 
+# 複数サンプルを取る場合は多様性を持たせるため温度を上げる
+JUDGE_TEMPERATURE = 0.1
+JUDGE_SAMPLING_TEMPERATURE = 0.7
+JUDGE_PARALLEL_REQUESTS = int(os.environ.get("JUDGE_PARALLEL_REQUESTS", "4"))
+JUDGE_AGGREGATES = ("median", "mean")
+
+JUDGE_CRITERIA_TEXT = """\
+## 評価基準 (各軸 1〜10 点 / 5点が「一般的なマネージャーの標準」)
+- 実用性: 具体的なアクションや手順が含まれているか
+  - 1〜4: 抽象的で実行できない / 5: 標準的な対応 / 6〜10: 即実践できる具体策がある
+- 共感性: 相談者の感情を受け止め、心理的安全性を確保しているか
+  - 1〜4: 感情への言及なし / 5: 一応受け止めている / 6〜10: 深く寄り添い信頼を高める
+- 専門性: マネジメント理論や業界知識が反映されているか
+  - 1〜4: 一般論のみ / 5: 標準的なマネジメント知識 / 6〜10: 具体的なフレームワークや根拠がある
+"""
+
 JUDGE_PROMPT_TEMPLATE = """\
 あなたはマネジメントの専門家です。
 以下の質問に対する回答を厳密に評価し、必ずJSON形式のみで返してください。
@@ -121,20 +374,128 @@ JUDGE_PROMPT_TEMPLATE = """\
 ## 評価対象の回答
 {response_text}
 
-## 評価基準 (各軸 1〜10 点 / 5点が「一般的なマネージャーの標準」)
-- 実用性: 具体的なアクションや手順が含まれているか
-  - 1〜4: 抽象的で実行できない / 5: 標準的な対応 / 6〜10: 即実践できる具体策がある
-- 共感性: 相談者の感情を受け止め、心理的安全性を確保しているか
-  - 1〜4: 感情への言及なし / 5: 一応受け止めている / 6〜10: 深く寄り添い信頼を高める
-- 専門性: マネジメント理論や業界知識が反映されているか
-  - 1〜4: 一般論のみ / 5: 標準的なマネジメント知識 / 6〜10: 具体的なフレームワークや根拠がある
-
+""" + JUDGE_CRITERIA_TEXT + """
 ## 出力形式
 以下のJSONのみを返してください。他のテキストは一切含めないでください。
 {{"実用性": <1-10>, "共感性": <1-10>, "専門性": <1-10>, "コメント": "<50字以内の総評>"}}
 """
 
-def call_judge(response_text, original_prompt):
+PAIRWISE_JUDGE_PROMPT_TEMPLATE = """\
+あなたはマネジメントの専門家です。
+以下の質問に対する2つの回答 (回答A・回答B) を比較しながら、それぞれを厳密に評価し、必ずJSON形式のみで返してください。
+
+## 質問
+{original_prompt}
+
+## 回答A
+{response_a}
+
+## 回答B
+{response_b}
+
+""" + JUDGE_CRITERIA_TEXT + """
+## 出力形式
+以下のJSONのみを返してください。他のテキストは一切含めないでください。
+{{"回答A": {{"実用性": <1-10>, "共感性": <1-10>, "専門性": <1-10>}}, "回答B": {{"実用性": <1-10>, "共感性": <1-10>, "専門性": <1-10>}}, "コメント": "<50字以内の比較総評>"}}
+"""
+
+# 審判結果 (集約後) のキャッシュ。レポートの再生成で API を再度呼ばないようにする
+JUDGE_CACHE = ResponseCache.from_env("JUDGE_CACHE", DEFAULT_JUDGE_CACHE_PATH)
+
+def _judge_generation_config(sample_index):
+    # サンプルごとに seed を変え、応答キャッシュ上でも別サンプルとして扱う
+    if sample_index == 0:
+        return {"maxOutputTokens": 2048, "temperature": JUDGE_TEMPERATURE}
+    return {"maxOutputTokens": 2048, "temperature": JUDGE_SAMPLING_TEMPERATURE, "seed": sample_index}
+
+# 審判のプロンプトと生成設定のハッシュ。JUDGE_CACHE のキーに含め、評価基準や温度を変えたら
+# 以前の審判結果を使わないようにする
+JUDGE_CONFIG_HASH = hashlib.sha256(json.dumps(
+    [JUDGE_PROMPT_TEMPLATE, PAIRWISE_JUDGE_PROMPT_TEMPLATE, JUDGE_CRITERIA, _judge_generation_config(0), _judge_generation_config(1)],
+    ensure_ascii=False, sort_keys=True,
+).encode("utf-8")).hexdigest()
+
+def validate_judgment(judgment):
+    """審判スコアに全評価軸が 1〜10 の数値で含まれているか検証し、問題があればエラー内容を返す"""
+    if not isinstance(judgment, dict):
+        return f"スコアがオブジェクトではありません: {str(judgment)[:300]}"
+    for key in JUDGE_CRITERIA:
+        score = judgment.get(key)
+        if isinstance(score, bool) or not isinstance(score, (int, float)):
+            return f"{key} のスコアがありません: {str(judgment)[:300]}"
+        if not 1 <= score <= 10:
+            return f"{key} のスコアが範囲外です (1〜10): {score}"
+    return None
+
+def validate_pairwise_judgment(result):
+    """比較審判の結果 (回答A・回答B) を検証し、問題があればエラー内容を返す"""
+    for label in ("回答A", "回答B"):
+        error = validate_judgment(result.get(label))
+        if error:
+            return f"{label}: {error}"
+    return None
+
+def _run_judge_prompt(judge_prompt, sample_index=0, validate=validate_judgment):
+    """審判プロンプトを送信して応答テキストを返す。失敗時は (None, エラー内容)
+
+    ストリームを括弧対応のスキャナに流し込み、validate を通るスコアの JSON が
+    完結した時点で接続を閉じる (以降の出力を待たず、課金トークンも抑える)。
+    """
+    payload = {
+        "contents": [{"role": "user", "parts": [{"text": judge_prompt}]}],
+        "generationConfig": _judge_generation_config(sample_index),
+    }
+
+    cache_key = make_key(base_model_url(), payload)
+    full_text = RESPONSE_CACHE.get(cache_key)
+    if full_text is not None:
+        record_cache_hit("judge")
+    else:
+        stats = StreamStats(f"Judge #{sample_index + 1}")
+        scanner = JsonObjectScanner()
+        parts = []
+        stream = stream_generate(base_model_url(), payload, stats, "judge")
+        try:
+            for text in stream:
+                parts.append(text)
+                if any(_parse_valid(obj, validate) for obj in scanner.feed(text)):
+                    stats.early_exit = True
+                    break
+        except Exception as e:
+            return None, str(e)
+        finally:
+            stream.close()
+        full_text = "".join(parts)
+        print(stats.summary(), file=sys.stderr)
+        RESPONSE_CACHE.put(cache_key, full_text)
+    return full_text, None
+
+def _parse_valid(json_str, validate):
+    try:
+        obj = json.loads(json_str)
+    except json.JSONDecodeError:
+        return None
+    return obj if validate(obj) is None else None
+
+def _extract_judge_json(full_text, validate=validate_judgment):
+    """審判の応答テキストから検証済みの JSON を取り出して (結果, エラー) を返す"""
+    # コードブロックや前置きの文章があっても、トップレベルの {...} を順に試す
+    candidates = iter_json_objects(full_text)
+    if not candidates:
+        return None, f"JSONが取得できませんでした: {full_text[:300]}"
+    error = None
+    for json_str in candidates:
+        try:
+            result = json.loads(json_str)
+        except json.JSONDecodeError as e:
+            error = f"JSONパースエラー: {e} / raw: {json_str[:300]}"
+            continue
+        error = validate(result)
+        if error is None:
+            return result, None
+    return None, error
+
+def call_judge(response_text, original_prompt, sample_index=0):
     """ベースモデルを審判として呼び出し、スコアを返す"""
     if not VERTEX_API_KEY or not PROJECT_ID:
         return None, "VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。"
@@ -143,47 +504,117 @@ def call_judge(response_text, original_prompt):
         original_prompt=original_prompt,
         response_text=response_text,
     )
-    base_url = (
-        f"https://{REGION}-aiplatform.googleapis.com/v1beta1"
-        f"/projects/{PROJECT_ID}/locations/{REGION}"
-        f"/publishers/google/models/{BASE_MODEL_ID}"
+    full_text, error = _run_judge_prompt(judge_prompt, sample_index)
+    if error:
+        return None, error
+    return _extract_judge_json(full_text)
+
+def call_judge_pairwise(base_text, tuned_text, original_prompt, sample_index=0):
+    """2つの回答を1回の審判プロンプトで比較採点し、(ベース, チューニング済み, エラー) を返す
+
+    提示順による偏りを打ち消すため、奇数番目のサンプルでは回答A/Bを入れ替える。
+    """
+    if not VERTEX_API_KEY or not PROJECT_ID:
+        return None, None, "VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。"
+
+    swapped = sample_index % 2 == 1
+    response_a, response_b = (tuned_text, base_text) if swapped else (base_text, tuned_text)
+    judge_prompt = PAIRWISE_JUDGE_PROMPT_TEMPLATE.format(
+        original_prompt=original_prompt,
+        response_a=response_a,
+        response_b=response_b,
     )
-    url = f"{base_url}:streamGenerateContent?key={VERTEX_API_KEY}"
-    payload = {
-        "contents": [{"role": "user", "parts": [{"text": judge_prompt}]}],
-        "generationConfig": {"maxOutputTokens": 2048, "temperature": 0.1},
-    }
-    headers = {"Content-Type": "application/json"}
-    data = json.dumps(payload).encode("utf-8")
+    full_text, error = _run_judge_prompt(judge_prompt, sample_index, validate_pairwise_judgment)
+    if error:
+        return None, None, error
+    result, error = _extract_judge_json(full_text, validate_pairwise_judgment)
+    if error:
+        return None, None, error
+    judgment_a, judgment_b = result["回答A"], result["回答B"]
+    comment = result.get("コメント", "")
+    if comment:
+        judgment_a = dict(judgment_a, コメント=comment)
+        judgment_b = dict(judgment_b, コメント=comment)
+    if swapped:
+        return judgment_b, judgment_a, None
+    return judgment_a, judgment_b, None
 
-    full_text = ""
-    try:
-        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-        with urllib.request.urlopen(req) as response:
-            resp_list = json.loads(response.read().decode("utf-8"))
-            for item in resp_list:
-                for cand in item.get("candidates", []):
-                    for part in cand.get("content", {}).get("parts", []):
-                        full_text += part.get("text", "")
-    except Exception as e:
-        return None, str(e)
+def aggregate_judgments(judgments, method="median"):
+    """複数サンプルの審判スコアを軸ごとに集約する (サンプル数と分散も付与する)"""
+    valid = [j for j in judgments if j]
+    if not valid:
+        return None
+    if len(valid) == 1:
+        return valid[0]
+    aggregate = statistics.median if method == "median" else statistics.mean
+    result, variance = {}, {}
+    for key in JUDGE_CRITERIA:
+        scores = [j[key] for j in valid if isinstance(j.get(key), (int, float))]
+        if scores:
+            result[key] = round(aggregate(scores), 2)
+            variance[key] = round(statistics.pvariance(scores), 2)
+    comments = [j["コメント"] for j in valid if j.get("コメント")]
+    if comments:
+        result["コメント"] = comments[0]
+    result["サンプル数"] = len(valid)
+    result["集約方法"] = method
+    result["分散"] = variance
+    return result
 
-    # コードブロック (```json ... ```) に包まれている場合に対応
-    code_block_match = re.search(r"```(?:json)?\s*([\s\S]*?)```", full_text)
-    if code_block_match:
-        json_str = code_block_match.group(1).strip()
-    else:
-        # 裸のJSONを抽出
-        raw_match = re.search(r"\{[\s\S]*\}", full_text)
-        json_str = raw_match.group() if raw_match else None
+def judge_responses(base_text, tuned_text, original_prompt, samples=1, pairwise=False, aggregate="median"):
+    """両モデルの回答を審判し、(ベース, チューニング済み, ベースのエラー, チューニング済みのエラー) を返す
 
-    if not json_str:
-        return None, f"JSONが取得できませんでした: {full_text[:300]}"
-    try:
-        result = json.loads(json_str)
-        return result, None
-    except json.JSONDecodeError as e:
-        return None, f"JSONパースエラー: {e} / raw: {json_str[:300]}"
+    samples 件の審判呼び出しを並列に実行して集約する。結果は JUDGE_CACHE に保存し、
+    同じ回答・設定での再実行では API を呼ばない。
+    """
+    cache_key = make_key(f"{base_model_url()}#judge", {
+        "contents": [original_prompt, base_text, tuned_text],
+        "generationConfig": {
+            "samples": samples, "pairwise": pairwise, "aggregate": aggregate, "judge": JUDGE_CONFIG_HASH,
+        },
+    })
+    cached = JUDGE_CACHE.get(cache_key)
+    if cached is not None:
+        return tuple(json.loads(cached))
+
+    base_samples, tuned_samples = [], []
+    base_errors, tuned_errors = [], []
+    with ThreadPoolExecutor(max_workers=max(1, JUDGE_PARALLEL_REQUESTS)) as executor:
+        if pairwise:
+            futures = [
+                executor.submit(call_judge_pairwise, base_text, tuned_text, original_prompt, i)
+                for i in range(samples)
+            ]
+            for future in futures:
+                base_j, tuned_j, error = future.result()
+                base_samples.append(base_j)
+                tuned_samples.append(tuned_j)
+                if error:
+                    base_errors.append(error)
+                    tuned_errors.append(error)
+        else:
+            base_futures = [executor.submit(call_judge, base_text, original_prompt, i) for i in range(samples)]
+            tuned_futures = [executor.submit(call_judge, tuned_text, original_prompt, i) for i in range(samples)]
+            for futures, judged, errors in ((base_futures, base_samples, base_errors),
+                                            (tuned_futures, tuned_samples, tuned_errors)):
+                for future in futures:
+                    judgment, error = future.result()
+                    judged.append(judgment)
+                    if error:
+                        errors.append(error)
+
+    base_judgment = aggregate_judgments(base_samples, aggregate)
+    tuned_judgment = aggregate_judgments(tuned_samples, aggregate)
+    base_error = None if base_judgment else (base_errors[0] if base_errors else "審判結果がありません。")
+    tuned_error = None if tuned_judgment else (tuned_errors[0] if tuned_errors else "審判結果がありません。")
+    result = (base_judgment, tuned_judgment, base_error, tuned_error)
+    if not base_errors and not tuned_errors:
+        JUDGE_CACHE.put(cache_key, json.dumps(result, ensure_ascii=False))
+    return result
+
+def judge_total(judgment):
+    """審判スコアの合計点を返す"""
+    return sum(judgment.get(k, 0) for k in JUDGE_CRITERIA)
 
 def format_judge_report(base_judgment, tuned_judgment, base_error, tuned_error):
     """審判スコアを比較してMarkdown形式のレポートを返す"""
@@ -212,9 +643,14 @@ def format_judge_report(base_judgment, tuned_judgment, base_error, tuned_error):
             else:
                 level = "-"
             lines.append(f"| {key} | {score}/10 | {level} |")
-        lines.append(f"| **合計** | **{total}/30** | |")  
+        lines.append(f"| **合計** | **{round(total, 2)}/30** | |")
         comment = judgment.get("コメント", "")
-        return "\n".join(lines) + (f"\n\n> {comment}" if comment else "")
+        text = "\n".join(lines) + (f"\n\n> {comment}" if comment else "")
+        if "サンプル数" in judgment:
+            method = "中央値" if judgment.get("集約方法") == "median" else "平均"
+            variance = " / ".join(f"{k} {v}" for k, v in judgment.get("分散", {}).items())
+            text += f"\n\n> {judgment['サンプル数']} サンプルの{method} (分散: {variance})"
+        return text
 
     report += "### 🔹 ベースモデル\n"
     report += render_table(base_judgment, base_error) + "\n\n"
@@ -223,9 +659,9 @@ def format_judge_report(base_judgment, tuned_judgment, base_error, tuned_error):
 
     # 判定
     if base_judgment and tuned_judgment:
-        base_total = sum(base_judgment.get(k, 0) for k in JUDGE_CRITERIA)
-        tuned_total = sum(tuned_judgment.get(k, 0) for k in JUDGE_CRITERIA)
-        diff = tuned_total - base_total
+        base_total = judge_total(base_judgment)
+        tuned_total = judge_total(tuned_judgment)
+        diff = round(tuned_total - base_total, 2)
         sign = "+" if diff >= 0 else ""
         if diff > 0:
             verdict = f"**判定:** チューニング済みモデルが {sign}{diff}点 上回っています。 ✅"
@@ -240,37 +676,143 @@ def format_judge_report(base_judgment, tuned_judgment, base_error, tuned_error):
 # --- 意味的類似度 (埋め込みベクトル) ロジック ---
 
 EMBEDDING_MODEL_ID = "text-multilingual-embedding-002"
+EMBEDDING_MAX_CHARS = 3000  # API上限対応 (これを超える回答はチャンクに分割する)
+# 1回の :predict に載せる上限 (インスタンス数 / 合計文字数)
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "250"))
+EMBEDDING_BATCH_CHAR_BUDGET = int(os.environ.get("EMBEDDING_BATCH_CHAR_BUDGET", "20000"))
+# 同時に送る :predict リクエスト数
+EMBEDDING_PARALLEL_REQUESTS = int(os.environ.get("EMBEDDING_PARALLEL_REQUESTS", "4"))
 
-def get_embedding(text):
-    """テキストをVertex AI埋め込みモデルでベクトル化して返す"""
+# 一度ベクトル化したテキスト (参照回答・同一回答) を再計算しないためのストア
+EMBEDDING_STORE = EmbeddingStore.from_env()
+
+def embedding_model_url():
+    return (
+        f"{VERTEX_API_BASE}/v1/projects/{PROJECT_ID}"
+        f"/locations/{REGION}/publishers/google/models/{EMBEDDING_MODEL_ID}"
+    )
+
+def _embedding_batches(items):
+    """(key, text) のリストを API 上限に収まるバッチに分割する"""
+    batch, chars = [], 0
+    for key, text in items:
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or chars + len(text) > EMBEDDING_BATCH_CHAR_BUDGET):
+            yield batch
+            batch, chars = [], 0
+        batch.append((key, text))
+        chars += len(text)
+    if batch:
+        yield batch
+
+def _predict_embeddings(texts):
+    """1回の :predict 呼び出しで texts をまとめてベクトル化する"""
+    url = f"{embedding_model_url()}:predict?key={VERTEX_API_KEY}"
+    payload = {"instances": [{"content": text} for text in texts]}
+    with TRACER.span("embedding", instances=len(texts)) as span:
+        with http_session().request("POST", url, json_body=payload, idempotent=True) as response:
+            span.bytes_sent = response.request_bytes
+            span.retries += response.retries
+            data = response.read()
+        span.bytes_received = len(data)
+        result = json.loads(data.decode("utf-8"))
+        # 埋め込みの課金単位は入力トークン数 (statistics.token_count)
+        span.prompt_tokens = span.total_tokens = sum(
+            int(pred["embeddings"].get("statistics", {}).get("token_count", 0)) for pred in result["predictions"]
+        )
+    return [pred["embeddings"]["values"] for pred in result["predictions"]]
+
+def get_embeddings(texts):
+    """複数テキストをまとめてベクトル化し、入力順のベクトルのリストを返す
+
+    ストアに保存済みのテキストは再計算せず、未登録分のみをバッチで :predict に送る。
+    """
     if not VERTEX_API_KEY or not PROJECT_ID:
         raise RuntimeError("VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。")
 
-    url = (
-        f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
-        f"/locations/{REGION}/publishers/google/models/{EMBEDDING_MODEL_ID}:predict"
-        f"?key={VERTEX_API_KEY}"
-    )
-    payload = {"instances": [{"content": text[:3000]}]}  # API上限対応
-    headers = {"Content-Type": "application/json"}
-    data = json.dumps(payload).encode("utf-8")
+    contents = [text[:EMBEDDING_MAX_CHARS] for text in texts]
+    keys = [make_embedding_key(EMBEDDING_MODEL_ID, content) for content in contents]
+    vectors = EMBEDDING_STORE.get_many(keys)
 
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    with urllib.request.urlopen(req) as response:
-        result = json.loads(response.read().decode("utf-8"))
-    return result["predictions"][0]["embeddings"]["values"]
+    pending = {}
+    for key, content in zip(keys, contents):
+        if key not in vectors:
+            pending.setdefault(key, content)
+
+    fetched = {}
+    batches = list(_embedding_batches(list(pending.items())))
+    with ThreadPoolExecutor(max_workers=max(1, min(EMBEDDING_PARALLEL_REQUESTS, len(batches) or 1))) as executor:
+        responses = executor.map(lambda batch: _predict_embeddings([content for _, content in batch]), batches)
+        for batch, values in zip(batches, responses):
+            fetched.update(zip([key for key, _ in batch], values))
+    EMBEDDING_STORE.put_many(fetched)
+    vectors.update(fetched)
+    return [vectors[key] for key in keys]
+
+def get_embedding(text):
+    """テキストをVertex AI埋め込みモデルでベクトル化して返す"""
+    return get_embeddings([text])[0]
+
+def get_document_embeddings(texts, pooling="mean"):
+    """長文を切り捨てずにベクトル化し、入力順のベクトルのリストを返す
+
+    各テキストを段落・文の境界でチャンクに分割し、全チャンクをまとめて
+    get_embeddings に渡した後、テキストごとにプーリングする
+    (mean はチャンクの文字数による加重平均)。
+    """
+    chunked = [chunk_text(text, EMBEDDING_MAX_CHARS) for text in texts]
+    flat = [chunk for chunks in chunked for chunk in chunks]
+    flat_vectors = get_embeddings(flat)
+
+    vectors, offset = [], 0
+    for chunks in chunked:
+        chunk_vectors = flat_vectors[offset:offset + len(chunks)]
+        offset += len(chunks)
+        vectors.append(pool_vectors(chunk_vectors, pooling, weights=[len(c) for c in chunks]))
+    return vectors
 
 def cosine_similarity(vec1, vec2):
     """コサイン類似度を計算して返す (0、1の範囲)"""
-    dot = sum(a * b for a, b in zip(vec1, vec2))
-    norm1 = sum(a * a for a in vec1) ** 0.5
-    norm2 = sum(b * b for b in vec2) ** 0.5
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-    return dot / (norm1 * norm2)
-
-def format_similarity_report(base_sim, tuned_sim):
-    """類似度スコアを比較してMarkdown形式のレポートを返す"""
+    return pairwise([vec1], [vec2])[0]
+
+def reference_similarities(ref_vec, response_vecs):
+    """参照回答に対する各回答の類似度を1回の行列計算で返す"""
+    sims = similarity_matrix(response_vecs, [ref_vec])
+    return [float(row[0]) for row in sims]
+
+# 類似度の計算方法: 埋め込み (Vertex AI) または文字 n-gram TF-IDF (API 呼び出しなし, ci_scripts/lexical.py)
+SIMILARITY_BACKENDS = ("embedding", "lexical")
+
+def similarity_scores(reference_text, base_text, tuned_text, pooling="mean", backend="embedding"):
+    """参照回答に対する (ベース, チューニング済み) の類似度を返す"""
+    if backend == "lexical":
+        (base_sim,), (tuned_sim,) = lexical_similarities([reference_text], [base_text], [tuned_text])
+        return base_sim, tuned_sim
+    ref_vec, base_vec, tuned_vec = get_document_embeddings([reference_text, base_text, tuned_text], pooling)
+    base_sim, tuned_sim = reference_similarities(ref_vec, [base_vec, tuned_vec])
+    return base_sim, tuned_sim
+
+SIMILARITY_REPORT_NOTES = {
+    "embedding": (
+        "## 🔍 意味的類似度評価 (BERTScore-like)\n\n"
+        "> **このスコアについて**\n"
+        "> \u300c`text-multilingual-embedding-002`\u300dで各回答をベクトル化し、参照回答とのコサイン類似度を計算しています。\n"
+        "> - スコアは **0～1** の範囲で、**1.0 に近いほど参照回答と意味的に近い**\n"
+        "> - 3000字を超える回答は段落・文の境界で分割してベクトル化し、回答全体を評価しています\n"
+        "> - **参照回答が短い場合**は全体スコアが下がる傾向があります（山山と寮を比べるような状態）\n"
+        "> - 差分がマイナスの場合、チューニングで回答が大幅に長くなり参照回答のキーワードが「簿化」した可能性があります\n\n"
+    ),
+    "lexical": (
+        "## 🔍 表層的類似度評価 (文字 n-gram TF-IDF)\n\n"
+        "> **このスコアについて**\n"
+        "> 各回答を文字 2〜3-gram の TF-IDF ベクトルに変換し、参照回答とのコサイン類似度を計算しています (API 呼び出しなし)。\n"
+        "> - スコアは **0～1** の範囲で、**1.0 に近いほど参照回答と表現 (言い回し・キーワード) が重なる**\n"
+        "> - 言い換えや同義語は一致とみなされないため、意味的類似度より低めの値になります\n"
+        "> - 差分がマイナスの場合、チューニングで参照回答のキーワードを使わなくなった可能性があります\n\n"
+    ),
+}
+
+def format_similarity_report(base_sim, tuned_sim, backend="embedding"):
+    """類似度スコアを比較してMarkdown形式のレポートを返す (backend は similarity_scores と同じ)"""
     diff = tuned_sim - base_sim
     sign = "+" if diff >= 0 else ""
     mark = "✅" if diff > 0 else ("➖" if diff == 0 else "⚠️")
@@ -283,36 +825,695 @@ def format_similarity_report(base_sim, tuned_sim):
         f"| **差分** | **{sign}{diff:.4f} {mark}** |",
     ]
 
+    closeness = "表現" if backend == "lexical" else "意味"
     if diff > 0:
-        verdict = "チューニング済みモデルの回答が参照回答により近い意味を持っています。"
+        verdict = f"チューニング済みモデルの回答が参照回答により近い{closeness}を持っています。"
     elif diff == 0:
         verdict = "両モデルの類似度は同等です。"
     else:
-        verdict = "ベースモデルの回答が参照回答により近い意味を持っています。チューニングデータの見直しを検討してください。"
-
-    report = "## 🔍 意味的類似度評価 (BERTScore-like)\n\n"
-    report += "> **このスコアについて**\n"
-    report += "> \u300c`text-multilingual-embedding-002`\u300dで各回答をベクトル化し、参照回答とのコサイン類似度を計算しています。\n"
-    report += "> - スコアは **0～1** の範囲で、**1.0 に近いほど参照回答と意味的に近い**\n"
-    report += "> - **参照回答が短い場合**は全体スコアが下がる傾向があります（山山と寮を比べるような状態）\n"
-    report += "> - 差分がマイナスの場合、チューニングで回答が大幅に長くなり参照回答のキーワードが「簿化」した可能性があります\n\n"
+        verdict = f"ベースモデルの回答が参照回答により近い{closeness}を持っています。チューニングデータの見直しを検討してください。"
+
+    report = SIMILARITY_REPORT_NOTES[backend]
     report += "\n".join(table_lines)
     report += f"\n\n**判定:** {verdict}\n"
     return report
+# --- 評価結果の記録 ---
+
+def model_versions():
+    """結果ストアに記録する (モデル, エンドポイントURL) をベース・チューニング済みの順で返す
+
+    チューニング済みモデルはエンドポイントIDで区別する (再学習でエンドポイントが変わればバージョンも変わる)。
+    """
+    return (BASE_MODEL_ID, base_model_url()), (tuned_model_id(), tuned_model_url())
+
+def result_metrics(score=None, judgment=None, similarity=None, similarity_backend="embedding"):
+    """定量評価・審判・類似度の結果を {指標名: 値} にまとめる
+
+    類似度は計算方法によって値の範囲が異なるため、埋め込み以外は "similarity.<backend>" として区別する。
+    """
+    metrics = {f"{SCORE_PREFIX}{key}": value for key, value in (score or {}).items()}
+    if judgment:
+        metrics["judge.total"] = judge_total(judgment)
+        metrics.update({f"judge.{c}": judgment[c] for c in JUDGE_CRITERIA if c in judgment})
+    if similarity is not None:
+        metrics["similarity" if similarity_backend == "embedding" else f"similarity.{similarity_backend}"] = similarity
+    return metrics
+
+def record_results(mode, prompt, base_metrics, tuned_metrics):
+    """ベース・チューニング済みの指標 (result_metrics の戻り値) を結果ストアに追記する
+
+    プロンプトが無い場合や、エンドポイントID・プロジェクトが未設定でモデルを特定できない場合
+    (evaluate / similarity モードでファイルだけを渡した場合など) は、比較に使えないため記録しない。
+    """
+    if not RESULTS_STORE.enabled:
+        return
+    missing = [
+        name for name, value in (
+            ("prompt", prompt and prompt.strip()), ("GCP_PROJECT_ID", PROJECT_ID), ("VERTEX_ENDPOINT_ID", VERTEX_ENDPOINT_ID),
+        ) if not value
+    ]
+    if missing:
+        print(f"⚠️ Results store: {mode} results not recorded ({', '.join(missing)} missing)", file=sys.stderr)
+        return
+    for (model, endpoint), metrics in zip(model_versions(), (base_metrics, tuned_metrics)):
+        RESULTS_STORE.record(RUN_ID, mode, prompt, model, endpoint, metrics)
+
+# --- バッチ評価ロジック ---
+
+BATCH_DEFAULT_WORKERS = 4
+
+def load_suite(path, limit=None):
+    """JSONL のプロンプト集を読み込み、{"prompt", "reference"} のリストを返す
+
+    `{"prompt": ..., "reference": ...}` 形式に加え、学習データ形式
+    (`{"contents": [...]}`) の場合は最初の user 発話をプロンプト、
+    最初の model 発話を参照回答として扱う。
+    """
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "contents" in entry:
+                texts = {}
+                for turn in entry["contents"]:
+                    text = "".join(p.get("text", "") for p in turn.get("parts", []))
+                    texts.setdefault(turn.get("role"), text)
+                prompt = texts.get("user")
+                reference = texts.get("model")
+            else:
+                prompt = entry.get("prompt")
+                reference = entry.get("reference")
+            if not prompt:
+                continue
+            items.append({"prompt": prompt, "reference": reference})
+            if limit and len(items) >= limit:
+                break
+    return items
+
+def evaluate_item(item, pooling="mean", judge_opts=None, similarity_backend="embedding"):
+    """1件のプロンプトについて生成・定量評価・審判・類似度をまとめて実行する
+
+    どちらかの生成に失敗した場合はエラー内容を採点せず、"error" のみを返す。
+    similarity_backend が "lexical" の場合、類似度は run_batch でスイート全体をまとめて計算する。
+    """
+    prompt = item["prompt"]
+    (base_text, base_error), (tuned_text, tuned_error) = run_concurrently(
+        prompt, [(base_model_url(), "Base Model"), (tuned_model_url(), "Tuned Model")]
+    )
+    if base_error or tuned_error:
+        return {"prompt": prompt, "error": " / ".join(e for e in (base_error, tuned_error) if e)}
+    result = {
+        "prompt": prompt,
+        "base_text": base_text,
+        "tuned_text": tuned_text,
+        "base_score": evaluate_response(base_text),
+        "tuned_score": evaluate_response(tuned_text),
+    }
+    (result["base_judgment"], result["tuned_judgment"],
+     result["base_judge_error"], result["tuned_judge_error"]) = judge_responses(
+        base_text, tuned_text, prompt, **(judge_opts or {})
+    )
+
+    reference = item.get("reference")
+    if reference and similarity_backend == "embedding":
+        try:
+            ref_vec, base_vec, tuned_vec = get_document_embeddings([reference, base_text, tuned_text], pooling)
+            result["base_sim"], result["tuned_sim"] = reference_similarities(ref_vec, [base_vec, tuned_vec])
+            result["vectors"] = (ref_vec, base_vec, tuned_vec)
+        except Exception as e:
+            result["similarity_error"] = str(e)
+    return result
+
+def run_batch(items, workers=BATCH_DEFAULT_WORKERS, pooling="mean", judge_opts=None, similarity_backend="embedding"):
+    """items を最大 workers 件ずつ並列に評価し、入力順の結果リストを返す"""
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(evaluate_item, item, pooling, judge_opts, similarity_backend): i
+            for i, item in enumerate(items)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = {"prompt": items[i]["prompt"], "error": str(e)}
+            print(f"📦 {done}/{len(items)} 件完了", file=sys.stderr)
+    if similarity_backend == "lexical":
+        score_lexical_similarities(items, results)
+    return results
+
+def score_lexical_similarities(items, results):
+    """参照回答のある項目の類似度を文字 n-gram TF-IDF でまとめて計算し、results に書き込む
+
+    IDF をスイート全体のテキストから求めるため、項目ごとではなく一括で計算する。
+    """
+    scored = [(item["reference"], r) for item, r in zip(items, results) if item.get("reference") and "error" not in r]
+    if not scored:
+        return
+    base_sims, tuned_sims = lexical_similarities(
+        [reference for reference, _ in scored],
+        [r["base_text"] for _, r in scored],
+        [r["tuned_text"] for _, r in scored],
+    )
+    for (_, r), base_sim, tuned_sim in zip(scored, base_sims, tuned_sims):
+        r["base_sim"], r["tuned_sim"] = base_sim, tuned_sim
+
+def api_call_count():
+    """これまでに実際に送った API 呼び出しの回数 (キャッシュから返した分は除く)"""
+    return sum(row["count"] - row["cached"] for row in TRACER.summary().values() if row["kind"] == "api")
+
+def run_sequential_batch(items, workers=BATCH_DEFAULT_WORKERS, pooling="mean", judge_opts=None,
+                         similarity_backend="embedding", alpha=DEFAULT_ALPHA, min_items=DEFAULT_MIN_ITEMS, seed=None):
+    """items をランダムな順序で評価し、審判スコア合計の逐次検定が有意になった時点で打ち切る
+
+    常に最大 workers 件だけを実行し、1件終わるごとに検定を更新してから次の項目を投入する。
+    打ち切った時点で実行中の項目は最後まで評価して結果に含める (逐次検定はどの時点で止めても有効)。
+    戻り値は (評価した順の結果リスト, SequentialMonitor, 推定で省略できた API 呼び出し回数)。
+    """
+    order = list(items)
+    random.Random(seed).shuffle(order)
+    monitor = SequentialMonitor(alpha=alpha, min_items=min_items)
+    calls_before = api_call_count()
+    evaluated, results = [], []
+    remaining = iter(order)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+
+        def submit_next():
+            item = next(remaining, None)
+            if item is not None:
+                running[executor.submit(evaluate_item, item, pooling, judge_opts, similarity_backend)] = item
+
+        for _ in range(max(1, workers)):
+            submit_next()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"prompt": item["prompt"], "error": str(e)}
+                evaluated.append(item)
+                results.append(result)
+                if "error" not in result:
+                    monitor.update(
+                        result_metrics(result["base_score"], result["base_judgment"], result.get("base_sim")),
+                        result_metrics(result["tuned_score"], result["tuned_judgment"], result.get("tuned_sim")),
+                    )
+                print(f"📦 {len(results)}/{len(items)} 件完了", file=sys.stderr)
+                # should_stop は一度 True になると戻らないため、停止後は新しい項目を投入しない
+                if not monitor.should_stop:
+                    submit_next()
+    if similarity_backend == "lexical":
+        score_lexical_similarities(evaluated, results)
+    # 省略した項目も、評価した項目と同じ平均回数の API 呼び出しが必要だったとみなす
+    calls_made = api_call_count() - calls_before
+    calls_saved = round((len(items) - len(results)) * calls_made / len(results)) if results else 0
+    return results, monitor, calls_saved
+
+SEQUENTIAL_VERDICTS = {
+    "better": "チューニング済みモデルが有意に優勢",
+    "worse": "ベースモデルが有意に優勢",
+    None: "有意差なし",
+}
+# 大小に良し悪しのない参考指標 (metrics.is_informational) は優劣ではなく増減として表示する
+SEQUENTIAL_CHANGES = {
+    "better": "チューニング済みモデルで有意に増加 (参考)",
+    "worse": "チューニング済みモデルで有意に減少 (参考)",
+    None: "有意差なし",
+}
+
+def format_sequential_report(monitor, total, evaluated, calls_saved):
+    """逐次検定の結果と、早期終了で省略した件数・API 呼び出し回数をMarkdown形式で返す
+
+    evaluated はエラーになった項目も含めて評価を実行した件数 (calls_saved と同じ基準)。
+    """
+    report = "\n## ⏹ 逐次検定による早期終了\n\n"
+    if monitor.should_stop:
+        verdict = SEQUENTIAL_VERDICTS[monitor.verdict]
+        report += f"審判スコア合計の検定が {monitor.stopped_at} 件目で有意 ({verdict}, α = {monitor.alpha}) になったため評価を打ち切りました。\n"
+        report += f"{total - evaluated}/{total} 件の評価を省略し、推定 **{calls_saved} 回**の API 呼び出しを節約しました。\n"
+        if monitor.tests[monitor.primary].verdict != monitor.verdict:
+            report += "停止時に実行中だった項目を含めた下表の最終集計では、判定が停止時と異なります (停止の判断は停止時点の検定に基づきます)。\n"
+        report += "\n"
+    else:
+        report += f"{total} 件すべてを評価しましたが、審判スコア合計の検定は有意になりませんでした (α = {monitor.alpha})。\n\n"
+    report += "| 指標 | 勝ち / 引き分け / 負け | 平均差分 | 尤度比 | 判定 |\n|---|---|---|---|---|\n"
+    for name, test in sorted(monitor.tests.items(), key=lambda item: item[0] != monitor.primary):
+        label = f"**{name}** (停止判定)" if name == monitor.primary else name
+        report += (
+            f"| {label} | {test.wins} / {test.ties} / {test.losses} | {test.mean_delta:+.2f} | "
+            f"{test.to_dict()['likelihood_ratio']} | "
+            f"{(SEQUENTIAL_CHANGES if is_informational(name) else SEQUENTIAL_VERDICTS)[test.verdict]} |\n"
+        )
+    report += (
+        "\n> 勝率 50% (差がない) に対する符号検定の尤度比を、勝率に一様分布を置いた混合で計算しています。"
+        f"尤度比が 1/α = {1 / monitor.alpha:g} を超えると有意です。途中で何度確認しても有意水準は保たれます。"
+        "停止判定以外の指標は参考値です。\n"
+    )
+    return report
+
+def reference_match_rates(results):
+    """各回答の最近傍参照回答が自分の参照回答である割合を (ベース, チューニング) で返す
+
+    スイート内の全参照回答との類似度行列を一括計算し、top-1 が一致するかを数える。
+    """
+    with_vectors = [r for r in results if "vectors" in r]
+    if len(with_vectors) < 2:
+        return None
+    refs = [r["vectors"][0] for r in with_vectors]
+    rates = []
+    for column in (1, 2):
+        nearest = top_k([r["vectors"][column] for r in with_vectors], refs, k=1)
+        hits = sum(1 for i, best in enumerate(nearest) if best[0][0] == i)
+        rates.append(hits / len(with_vectors))
+    return tuple(rates)
+
+def _mean(values):
+    return round(sum(values) / len(values), 1) if values else 0
+
+def format_score_distribution(ok):
+    """定量評価の各指標の分布 (p10 / p50 / p90) をベースとチューニング済みで並べた表を返す"""
+    lines = [
+        "\n<details><summary>指標の分布 (p10 / p50 / p90)</summary>\n",
+        "| 指標 | 🔹 ベースモデル | 🔸 チューニング済み |",
+        "|---|---|---|",
+    ]
+    for label, key, _ in SCORE_METRICS:
+        cells = []
+        for side in ("base_score", "tuned_score"):
+            dist = distribution([r[side][key] for r in ok])
+            cells.append(f"{dist['p10']:g} / {dist['p50']:g} / {dist['p90']:g}")
+        lines.append(f"| {label} | {cells[0]} | {cells[1]} |")
+    lines.append("\n</details>\n")
+    return "\n".join(lines)
+
+def format_batch_report(results, similarity_backend="embedding"):
+    """バッチ評価の結果を集計してMarkdown形式のレポートを返す"""
+    ok = [r for r in results if "error" not in r]
+    report = "# 📦 バッチ評価レポート\n\n"
+    report += f"- 評価件数: {len(ok)}/{len(results)}\n\n"
+    if not ok:
+        return report + "> 評価に成功した項目がありません。\n"
+
+    metric_keys = ok[0]["base_score"].keys()
+    base_avg = {k: _mean([r["base_score"][k] for r in ok]) for k in metric_keys}
+    tuned_avg = {k: _mean([r["tuned_score"][k] for r in ok]) for k in metric_keys}
+    report += format_score_report(base_avg, tuned_avg).replace("## 📊 定量評価サマリー", "## 📊 定量評価サマリー (平均)")
+    report += format_score_distribution(ok)
+
+    judged = [r for r in ok if r["base_judgment"] and r["tuned_judgment"]]
+    report += "\n## 🧑\u200d⚖️ AI審判による評価 (集計)\n\n"
+    if judged:
+        diffs = [judge_total(r["tuned_judgment"]) - judge_total(r["base_judgment"]) for r in judged]
+        report += "| 項目 | 値 |\n|---|---|\n"
+        report += f"| 🔹 ベースモデル平均 | {_mean([judge_total(r['base_judgment']) for r in judged])}/30 |\n"
+        report += f"| 🔸 チューニング済み平均 | {_mean([judge_total(r['tuned_judgment']) for r in judged])}/30 |\n"
+        report += f"| 勝ち / 引き分け / 負け | {sum(d > 0 for d in diffs)} / {sum(d == 0 for d in diffs)} / {sum(d < 0 for d in diffs)} |\n"
+    else:
+        report += "> 審判スコアを取得できた項目がありません。\n"
+
+    with_sim = [r for r in ok if "base_sim" in r]
+    if with_sim:
+        title = "表層的類似度評価 (文字 n-gram TF-IDF, 平均)" if similarity_backend == "lexical" else "意味的類似度評価 (平均)"
+        report += f"\n## 🔍 {title}\n\n"
+        report += "| モデル | 類似度スコア |\n|---|---|\n"
+        report += f"| 🔹 ベースモデル | {sum(r['base_sim'] for r in with_sim) / len(with_sim):.4f} |\n"
+        report += f"| 🔸 チューニング済み | {sum(r['tuned_sim'] for r in with_sim) / len(with_sim):.4f} |\n"
+        rates = reference_match_rates(with_sim)
+        if rates:
+            report += f"\n参照回答の最近傍一致率 (全 {len(with_sim)} 件の参照回答中で自分の参照回答が最も近い割合): "
+            report += f"🔹 {rates[0]:.1%} / 🔸 {rates[1]:.1%}\n"
+
+    report += "\n## 📝 項目別結果\n\n"
+    report += "| # | プロンプト | 審判 (ベース → チューニング) | 類似度 (ベース → チューニング) |\n|---|---|---|---|\n"
+    for i, r in enumerate(results, start=1):
+        prompt = r["prompt"].replace("\n", " ").replace("|", "\\|")
+        prompt = prompt[:30] + ("…" if len(prompt) > 30 else "")
+        if "error" in r:
+            report += f"| {i} | {prompt} | エラー: {r['error']} | - |\n"
+            continue
+        if r["base_judgment"] and r["tuned_judgment"]:
+            judge_cell = f"{judge_total(r['base_judgment'])} → {judge_total(r['tuned_judgment'])}"
+        else:
+            judge_cell = "-"
+        sim_cell = f"{r['base_sim']:.4f} → {r['tuned_sim']:.4f}" if "base_sim" in r else "-"
+        report += f"| {i} | {prompt} | {judge_cell} | {sim_cell} |\n"
+    return report
+
+# --- Issue本文のパース ---
+
+def parse_prompt(content):
+    """Issue本文の「### Prompt」セクションを返す (セクションが無ければ本文全体)"""
+    match = re.search(r"### Prompt\s*\n\s*(.*)", content, re.DOTALL)
+    if not match:
+        return content.strip()
+    # 次のセクション (参照回答など) があれば手前で切る
+    return re.split(r"^###", match.group(1).strip(), maxsplit=1, flags=re.MULTILINE)[0].strip()
+
+def parse_reference(content):
+    """Issue本文の「### 参照回答」セクションを返す (無ければ空文字列)"""
+    match = re.search(r"### 参照回答\s*\n\s*(.*)", content, re.DOTALL)
+    if not match:
+        return ""
+    text = match.group(1).strip()
+    # 次のセクション (### で始まる行) があれば手前で切る
+    return re.split(r"^###", text, maxsplit=1, flags=re.MULTILINE)[0].strip()
+
+# --- パイプライン (全ステージを1プロセスで実行) ---
+
+PIPELINE_ARTIFACTS = {
+    "base": "base_result.md",
+    "tuned": "tuned_result.md",
+    "score": "score_result.md",
+    "judge": "judge_result.md",
+    "similarity": "similarity_result.md",
+}
+
+PIPELINE_METRICS = "metrics.json"
+PIPELINE_SKIPPED_NOTE = "> 回答の生成に失敗したため、評価をスキップしました。\n"
+
+def _traced(name, kind, func, *args):
+    """func(*args) を1つの Span として記録して実行する"""
+    with TRACER.span(name, kind):
+        return func(*args)
+
+def run_pipeline(prompt, reference=None, output_dir=".", pooling="mean", judge_opts=None, metrics_path=None,
+                 similarity_backend="embedding"):
+    """生成 (ベース ∥ チューニング済み) → 定量評価 ∥ 審判 ∥ 類似度 を実行し、全Markdownを書き出す
+
+    評価系のステージは生成結果だけに依存するため並列に実行する。
+    いずれかのステージが失敗しても、他のステージの成果物は書き出す。
+    各ステージ・API 呼び出しの計測値は metrics_path (既定: output_dir/metrics.json) に書き出し、
+    処理時間・トークン数の表を定量評価サマリーの後ろに付ける。
+    """
+    (base_text, base_error), (tuned_text, tuned_error) = _traced(
+        "stage: generate", "stage", run_concurrently,
+        prompt, [(base_model_url(), "Base Model"), (tuned_model_url(), "Tuned Model")],
+    )
+    artifacts = {
+        "base": f"{BASE_HEADING}\n{base_error or base_text}\n",
+        "tuned": f"{TUNED_HEADING}\n{tuned_error or tuned_text}\n",
+    }
+
+    def score_stage():
+        base_score, tuned_score = evaluate_response(base_text), evaluate_response(tuned_text)
+        record_results("pipeline", prompt, result_metrics(score=base_score), result_metrics(score=tuned_score))
+        return _traced("format: score", "format", format_score_report, base_score, tuned_score)
+
+    def judge_stage():
+        judged = judge_responses(base_text, tuned_text, prompt, **(judge_opts or {}))
+        record_results("pipeline", prompt, result_metrics(judgment=judged[0]), result_metrics(judgment=judged[1]))
+        return _traced("format: judge", "format", format_judge_report, *judged)
+
+    def similarity_stage():
+        sims = similarity_scores(reference, base_text, tuned_text, pooling, similarity_backend)
+        record_results(
+            "pipeline", prompt,
+            result_metrics(similarity=sims[0], similarity_backend=similarity_backend),
+            result_metrics(similarity=sims[1], similarity_backend=similarity_backend),
+        )
+        return _traced("format: similarity", "format", format_similarity_report, *sims, similarity_backend)
+
+    stages = {"score": score_stage, "judge": judge_stage}
+    # 参照回答がない場合は類似度評価をスキップする
+    if reference:
+        stages["similarity"] = similarity_stage
+    # エラー内容を回答として採点しない
+    if base_error or tuned_error:
+        stages = {name: (lambda: PIPELINE_SKIPPED_NOTE) for name in stages}
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = {name: executor.submit(_traced, f"stage: {name}", "stage", stage) for name, stage in stages.items()}
+        for name, future in futures.items():
+            try:
+                artifacts[name] = future.result()
+            except Exception as e:
+                artifacts[name] = f"> {name} ステージの実行に失敗しました: {e}\n"
+    artifacts["score"] += "\n" + format_trace_report(TRACER.summary(), trace_extras().get("hedging"))
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, content in artifacts.items():
+        with open(os.path.join(output_dir, PIPELINE_ARTIFACTS[name]), "w", encoding="utf-8") as f:
+            f.write(content)
+    TRACER.write_json(metrics_path or os.path.join(output_dir, PIPELINE_METRICS), trace_extras())
+    return artifacts
+
+# --- N モデル比較 (複数の候補エンドポイントを一度に比較) ---
+
+# 比較するモデルのカンマ区切りリスト ("[ラベル=]モデルID" または "[ラベル=]endpoint/<エンドポイントID>")
+COMPARE_MODELS = os.environ.get("COMPARE_MODELS", "")
+
+def parse_model_specs(value):
+    """モデル指定のカンマ区切りを [(ラベル, モデル)] にする。空なら ベース・チューニング済みの2モデル"""
+    specs = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        label, _, model = entry.rpartition("=")
+        specs.append((label.strip() or model.strip(), model.strip()))
+    if not specs:
+        specs = [("Base Model", BASE_MODEL_ID), ("Tuned Model", tuned_model_id())]
+    return specs
+
+def judge_answer(text, original_prompt, samples=1, aggregate="median"):
+    """1つの回答を samples 回並列に審判し、集約した (結果, エラー) を返す"""
+    with ThreadPoolExecutor(max_workers=max(1, samples)) as executor:
+        judged = list(executor.map(lambda i: call_judge(text, original_prompt, i), range(samples)))
+    judgment = aggregate_judgments([j for j, _ in judged], aggregate)
+    errors = [e for _, e in judged if e]
+    return judgment, None if judgment else (errors[0] if errors else "審判結果がありません。")
+
+def evaluate_model(label, model, prompt, judge_opts=None):
+    """1モデル分の 生成 → 定量評価 → 審判 を実行した結果の dict を返す
+
+    各モデルは生成が終わり次第すぐ審判に進むため、全体の所要時間は最も遅いモデル1つ分に近くなる。
+    """
+    url = model_url(model)
+    result = {"label": label, "model": model, "url": url}
+    try:
+        text, error = call_api(url, prompt, label)
+    except Exception as e:
+        text, error = None, f"Error ({label}): {e}"
+    if error:
+        result["error"] = error
+        return result
+    opts = judge_opts or {}
+    result["text"] = text
+    result["score"] = evaluate_response(text)
+    result["judgment"], result["judge_error"] = judge_answer(
+        text, prompt, opts.get("samples", 1), opts.get("aggregate", "median")
+    )
+    return result
+
+def run_comparison(specs, prompt, reference=None, pooling="mean", judge_opts=None, similarity_backend="embedding"):
+    """全モデルに同じプロンプトを並列に送り、審判・類似度まで評価した結果を specs の順で返す
+
+    審判は各回答を独立に採点する (ペアワイズ審判は2モデル比較でのみ使える)。
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(specs))) as executor:
+        futures = [executor.submit(evaluate_model, label, model, prompt, judge_opts) for label, model in specs]
+        results = [future.result() for future in futures]
+
+    answered = [r for r in results if "error" not in r]
+    if reference and answered:
+        try:
+            if similarity_backend == "lexical":
+                sims = [sim for (sim,) in lexical_similarities([reference], *[[r["text"]] for r in answered])]
+            else:
+                vectors = get_document_embeddings([reference] + [r["text"] for r in answered], pooling)
+                sims = reference_similarities(vectors[0], vectors[1:])
+            for r, sim in zip(answered, sims):
+                r["similarity"] = sim
+        except Exception as e:
+            for r in answered:
+                r["similarity_error"] = str(e)
+
+    for r in answered:
+        RESULTS_STORE.record(
+            RUN_ID, "compare", prompt, r["model"], r["url"],
+            result_metrics(r["score"], r["judgment"], r.get("similarity"), similarity_backend),
+        )
+    return results
+
+def rank_models(results):
+    """審判スコア合計 → 類似度 → 定量指標で最高値を取った数 (参考指標を除く) の順に並べた結果を返す"""
+    answered = [r for r in results if "error" not in r]
+    best = {
+        key: max(r["score"][key] for r in answered)
+        for key in RANKED_METRICS
+    } if answered else {}
+    for r in answered:
+        r["score_wins"] = sum(1 for key in RANKED_METRICS if r["score"][key] == best[key])
+    return sorted(answered, key=lambda r: (
+        judge_total(r["judgment"]) if r.get("judgment") else float("-inf"),
+        round(r.get("similarity", float("-inf")), 4),
+        r["score_wins"],
+    ), reverse=True)
+
+def _table(header, rows):
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines += ["| " + " | ".join(str(cell) for cell in row) + " |" for row in rows]
+    return "\n".join(lines)
+
+def _mark_best(values, fmt="{}", informational=False):
+    """最大値のセルを太字にした文字列のリストを返す (None は "-", 全モデル同じ値・参考指標なら強調しない)
+
+    値は表示する桁数にそろえてから比べる (類似度の浮動小数点の誤差で差がつかないように)。
+    """
+    cells = [None if v is None else fmt.format(v) for v in values]
+    present = [(v, cell) for v, cell in zip(values, cells) if v is not None]
+    if informational or len({cell for _, cell in present}) <= 1:
+        return [cell or "-" for cell in cells]
+    top = fmt.format(max(v for v, _ in present))
+    return ["-" if cell is None else (f"**{cell}** 🏆" if cell == top else cell) for cell in cells]
+
+def format_multi_score_report(results):
+    """N モデルの定量評価を1つの表にしたMarkdownを返す (各指標の最高値に 🏆。参考指標は ℹ️ を付けて強調しない)"""
+    answered = [r for r in results if "error" not in r]
+    report = "## 📊 定量評価サマリー\n\n"
+    if not answered:
+        return report + "> 評価できる回答がありません。\n"
+    rows = [
+        [f"{label} ℹ️" if METRICS[key].informational else label]
+        + _mark_best([r["score"][key] for r in answered], informational=METRICS[key].informational) + [desc]
+        for label, key, desc in SCORE_METRICS
+    ]
+    report += _table(["指標"] + [r["label"] for r in answered] + ["計測内容"], rows) + "\n"
+    if len(RANKED_METRICS) < len(SCORE_METRICS):
+        report += "\n> ℹ️ の指標は大小に良し悪しのない参考値のため、最高値の強調・ランキングには数えません。\n"
+    return report
+
+def format_multi_judge_report(results):
+    """N モデルの審判スコアを1つの表にしたMarkdownを返す"""
+    answered = [r for r in results if "error" not in r]
+    report = "## 🧑‍⚖️ AI審判による評価\n\n"
+    if not answered:
+        return report + "> 評価できる回答がありません。\n"
+
+    def score(r, key):
+        value = (r.get("judgment") or {}).get(key)
+        return value if isinstance(value, (int, float)) else None
+
+    rows = [[f"{key} (/10)"] + _mark_best([score(r, key) for r in answered]) for key in JUDGE_CRITERIA]
+    totals = [round(judge_total(r["judgment"]), 2) if r.get("judgment") else None for r in answered]
+    rows.append(["**合計** (/30)"] + _mark_best(totals))
+    report += _table(["軸"] + [r["label"] for r in answered], rows) + "\n"
+    for r in answered:
+        if r.get("judge_error"):
+            report += f"\n> **{r['label']}**: 評価の取得に失敗しました: {r['judge_error']}\n"
+        elif r["judgment"].get("コメント"):
+            report += f"\n> **{r['label']}**: {r['judgment']['コメント']}\n"
+    return report + "\n"
+
+def format_ranking_report(results):
+    """総合ランキング (審判スコア合計 → 類似度 → 定量指標の最高値数) のMarkdownを返す"""
+    ranked = rank_models(results)
+    with_sim = any("similarity" in r for r in ranked)
+    header = ["順位", "モデル", "審判合計"] + (["類似度"] if with_sim else []) + ["定量指標の最高値"]
+    rows = []
+    for rank, r in enumerate(ranked, start=1):
+        row = [
+            f"{['🥇', '🥈', '🥉'][rank - 1] if rank <= 3 else rank}",
+            f"{r['label']} (`{r['model']}`)",
+            f"{round(judge_total(r['judgment']), 2)}/30" if r.get("judgment") else "-",
+        ]
+        if with_sim:
+            row.append(f"{r['similarity']:.4f}" if "similarity" in r else "-")
+        row.append(f"{r['score_wins']}/{len(RANKED_METRICS)}")
+        rows.append(row)
+    report = "## 🏆 総合ランキング\n\n"
+    report += _table(header, rows) + "\n" if rows else "> 評価できる回答がありません。\n"
+    for r in results:
+        if "error" in r:
+            report += f"\n> ⚠️ {r['label']} (`{r['model']}`): {r['error']}\n"
+    return report
+
+def format_compare_report(results, similarity_backend="embedding"):
+    """N モデル比較のレポート (ランキング・定量評価・審判・回答) を返す"""
+    report = format_ranking_report(results) + "\n"
+    report += format_multi_score_report(results) + "\n"
+    report += format_multi_judge_report(results)
+    if any("similarity" in r for r in results):
+        title = "表層的類似度評価 (文字 n-gram TF-IDF)" if similarity_backend == "lexical" else "意味的類似度評価"
+        report += f"\n## 🔍 {title}\n\n"
+        report += _table(["モデル", "類似度スコア"], [
+            [r["label"], cell] for r, cell in zip(
+                [r for r in results if "similarity" in r],
+                _mark_best([r["similarity"] for r in results if "similarity" in r], "{:.4f}"),
+            )
+        ]) + "\n"
+    report += "\n## 📝 回答\n"
+    for r in results:
+        report += f"\n<details><summary>{r['label']} (<code>{r['model']}</code>)</summary>\n\n"
+        report += f"{r.get('text') or r.get('error')}\n\n</details>\n"
+    return report
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run specific model comparison tasks.")
     parser.add_argument("prompt", nargs="?", help="The prompt to send to the models.")
-    parser.add_argument("--mode", choices=["parse", "parse-reference", "base", "tuned", "simultaneous", "evaluate", "judge", "similarity"], default="simultaneous", help="Execution mode.")
-    parser.add_argument("--body", help="Issue body content for parsing prompt.")
+    parser.add_argument("--mode", choices=["parse", "parse-reference", "base", "tuned", "simultaneous", "evaluate", "judge", "similarity", "batch", "pipeline", "compare"], default="simultaneous", help="Execution mode.")
+    parser.add_argument("--body", help="Issue body content for parsing prompt (for parse/parse-reference/pipeline/compare mode).")
     parser.add_argument("--base-file", help="Base model result file path (for evaluate/judge/similarity mode).")
     parser.add_argument("--tuned-file", help="Tuned model result file path (for evaluate/judge/similarity mode).")
     parser.add_argument("--prompt-text", help="Original prompt text (for judge mode).")
     parser.add_argument("--reference-text", help="Reference answer text (for similarity mode).")
-    parser.add_argument("--output", default="score_result.md", help="Output file path for evaluate/judge/similarity mode.")
+    parser.add_argument("--output", default="score_result.md", help="Output file path for evaluate/judge/similarity/batch/compare mode.")
+    parser.add_argument("--output-dir", default=".", help="Directory for all markdown artifacts (for pipeline mode).")
+    parser.add_argument("--metrics", help="Write per-call timing/token metrics as JSON to this path (pipeline mode default: <output-dir>/metrics.json).")
+    parser.add_argument("--similarity-backend", choices=SIMILARITY_BACKENDS, default="embedding", help="Score similarity with Vertex AI embeddings or offline character n-gram TF-IDF (for similarity/batch/pipeline mode).")
+    parser.add_argument("--pooling", choices=POOLING_METHODS, default="mean", help="How chunk embeddings of long answers are combined (for similarity/batch mode).")
+    parser.add_argument("--judge-samples", type=int, default=1, help="Number of judge samples drawn concurrently per answer (for judge/batch mode).")
+    parser.add_argument("--judge-aggregate", choices=JUDGE_AGGREGATES, default="median", help="How multiple judge samples are aggregated.")
+    parser.add_argument("--judge-pairwise", action="store_true", help="Score base and tuned answers together in one pairwise judge prompt.")
+    parser.add_argument("--models", default=COMPARE_MODELS, help="Comma-separated models for compare mode: [label=]model-id or [label=]endpoint/<id> (default: COMPARE_MODELS env, or base + tuned).")
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate request to the tuned endpoint when its first chunk is slower than the usual TTFT (see HEDGE_* env vars).")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache (e.g. when sampling nondeterministically).")
+    parser.add_argument("--suite", help="JSONL prompt suite (for batch mode).")
+    parser.add_argument("--limit", type=int, help="Maximum number of suite items to evaluate (for batch mode).")
+    parser.add_argument("--workers", type=int, default=BATCH_DEFAULT_WORKERS, help="Number of suite items evaluated concurrently (for batch mode).")
+    parser.add_argument("--early-stop", action="store_true", help="Evaluate the suite in random order and stop once the judge-total sequential test is significant (for batch mode).")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Significance level of the sequential test (for --early-stop).")
+    parser.add_argument("--min-items", type=int, default=DEFAULT_MIN_ITEMS, help="Minimum number of items evaluated before stopping early (for --early-stop).")
+    parser.add_argument("--seed", type=int, help="Random seed for the evaluation order (for --early-stop).")
     return parser.parse_args()
 
+def judge_options(args):
+    return {
+        "samples": max(1, args.judge_samples),
+        "pairwise": args.judge_pairwise,
+        "aggregate": args.judge_aggregate,
+    }
+
+def report_cache_stats():
+    if RESPONSE_CACHE.hits or RESPONSE_CACHE.misses:
+        print(RESPONSE_CACHE.summary(), file=sys.stderr)
+    if EMBEDDING_STORE.hits or EMBEDDING_STORE.misses:
+        print(EMBEDDING_STORE.summary(), file=sys.stderr)
+    if RESULTS_STORE.recorded:
+        print(f"🗂 Results store: {RESULTS_STORE.recorded} values recorded to {RESULTS_STORE.path}", file=sys.stderr)
+    for limiter in http_session().limiters.values():
+        if limiter.throttled:
+            print(limiter.summary(), file=sys.stderr)
+    if HEDGER.requests:
+        print(HEDGER.summary(), file=sys.stderr)
+
 def main():
     args = parse_arguments()
+    if args.no_cache:
+        RESPONSE_CACHE.enabled = False
+        JUDGE_CACHE.enabled = False
+    if args.hedge:
+        HEDGER.enabled = True
+    atexit.register(report_cache_stats)
+    # pipeline モードは成果物と一緒に書き出す
+    if args.metrics and args.mode != "pipeline":
+        atexit.register(lambda: TRACER.write_json(args.metrics, trace_extras()))
 
     # --- Mode: Evaluate (定量評価のみ) ---
     if args.mode == "evaluate":
@@ -327,6 +1528,7 @@ def main():
             tuned_text = f.read()
         base_score = evaluate_response(base_text)
         tuned_score = evaluate_response(tuned_text)
+        record_results("evaluate", args.prompt_text, result_metrics(score=base_score), result_metrics(score=tuned_score))
         report = format_score_report(base_score, tuned_score)
         output_path = args.output
         with open(output_path, "w", encoding="utf-8") as f:
@@ -342,20 +1544,23 @@ def main():
         if not base_file or not tuned_file or not reference_text:
             print("Error: --base-file、--tuned-file、--reference-text が必要です。")
             sys.exit(1)
-        if not VERTEX_API_KEY or not PROJECT_ID:
+        # lexical は API を呼ばないため認証情報は不要
+        if args.similarity_backend == "embedding" and (not VERTEX_API_KEY or not PROJECT_ID):
             print("Error: VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。")
             sys.exit(1)
         with open(base_file, "r", encoding="utf-8") as f:
             base_text = f.read()
         with open(tuned_file, "r", encoding="utf-8") as f:
             tuned_text = f.read()
-        print("🔍 埋め込みベクトルを取得中...")
-        ref_vec = get_embedding(reference_text)
-        base_vec = get_embedding(base_text)
-        tuned_vec = get_embedding(tuned_text)
-        base_sim = cosine_similarity(ref_vec, base_vec)
-        tuned_sim = cosine_similarity(ref_vec, tuned_vec)
-        report = format_similarity_report(base_sim, tuned_sim)
+        if args.similarity_backend == "embedding":
+            print("🔍 埋め込みベクトルを取得中...")
+        base_sim, tuned_sim = similarity_scores(reference_text, base_text, tuned_text, args.pooling, args.similarity_backend)
+        record_results(
+            "similarity", args.prompt_text,
+            result_metrics(similarity=base_sim, similarity_backend=args.similarity_backend),
+            result_metrics(similarity=tuned_sim, similarity_backend=args.similarity_backend),
+        )
+        report = format_similarity_report(base_sim, tuned_sim, args.similarity_backend)
         output_path = args.output
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(report)
@@ -374,10 +1579,11 @@ def main():
             base_text = f.read()
         with open(tuned_file, "r", encoding="utf-8") as f:
             tuned_text = f.read()
-        print("🧑‍⚖️ ベースモデルの回答を採点中...")
-        base_judgment, base_error = call_judge(base_text, original_prompt)
-        print("🧑‍⚖️ チューニング済みモデルの回答を採点中...")
-        tuned_judgment, tuned_error = call_judge(tuned_text, original_prompt)
+        print(f"🧑‍⚖️ 両モデルの回答を採点中 (サンプル数: {args.judge_samples})...")
+        base_judgment, tuned_judgment, base_error, tuned_error = judge_responses(
+            base_text, tuned_text, original_prompt, **judge_options(args)
+        )
+        record_results("judge", original_prompt, result_metrics(judgment=base_judgment), result_metrics(judgment=tuned_judgment))
         report = format_judge_report(base_judgment, tuned_judgment, base_error, tuned_error)
         output_path = args.output
         with open(output_path, "w", encoding="utf-8") as f:
@@ -385,29 +1591,95 @@ def main():
         print(report)
         return
 
+    # --- Mode: Batch (プロンプト集の一括評価) ---
+    if args.mode == "batch":
+        if not args.suite:
+            print("Error: --suite が必要です。")
+            sys.exit(1)
+        if not VERTEX_API_KEY or not PROJECT_ID:
+            print("Error: VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。")
+            sys.exit(1)
+        items = load_suite(args.suite, args.limit)
+        print(f"📦 {len(items)} 件のプロンプトを評価中 (並列数: {args.workers})...")
+        if args.early_stop:
+            results, monitor, calls_saved = run_sequential_batch(
+                items, args.workers, args.pooling, judge_options(args), args.similarity_backend,
+                args.alpha, args.min_items, args.seed,
+            )
+        else:
+            results = run_batch(items, args.workers, args.pooling, judge_options(args), args.similarity_backend)
+        for r in results:
+            if "error" not in r:
+                record_results(
+                    "batch", r["prompt"],
+                    result_metrics(r["base_score"], r["base_judgment"], r.get("base_sim"), args.similarity_backend),
+                    result_metrics(r["tuned_score"], r["tuned_judgment"], r.get("tuned_sim"), args.similarity_backend),
+                )
+        report = format_batch_report(results, args.similarity_backend)
+        if args.early_stop:
+            report += format_sequential_report(monitor, len(items), len(results), calls_saved)
+        report += "\n" + format_trace_report(TRACER.summary(), trace_extras().get("hedging"))
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+        print(report)
+        return
+
+    # --- Mode: Pipeline (パース → 生成 → 評価 を1プロセスで実行) ---
+    if args.mode == "pipeline":
+        content = args.body or os.environ.get("ISSUE_BODY", "")
+        prompt = args.prompt or (parse_prompt(content) if content else "")
+        if not prompt:
+            print("Error: prompt argument or issue body (via --body or ISSUE_BODY env var) is required.")
+            sys.exit(1)
+        if not VERTEX_API_KEY or not PROJECT_ID:
+            print("Error: VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。")
+            sys.exit(1)
+        reference = args.reference_text or parse_reference(content)
+        artifacts = run_pipeline(
+            prompt, reference, args.output_dir, args.pooling, judge_options(args), args.metrics, args.similarity_backend
+        )
+        print("\n\n---\n\n".join(artifacts.values()))
+        return
+
+    # --- Mode: Compare (N モデルを並列に比較) ---
+    if args.mode == "compare":
+        content = args.body or os.environ.get("ISSUE_BODY", "")
+        prompt = args.prompt or (parse_prompt(content) if content else "")
+        if not prompt:
+            print("Error: prompt argument or issue body (via --body or ISSUE_BODY env var) is required.")
+            sys.exit(1)
+        if not VERTEX_API_KEY or not PROJECT_ID:
+            print("Error: VERTEX_API_KEY または GCP_PROJECT_ID が未設定です。")
+            sys.exit(1)
+        if args.judge_pairwise:
+            print("Warning: --judge-pairwise は2モデル比較専用のため、各回答を個別に審判します。", file=sys.stderr)
+        specs = parse_model_specs(args.models)
+        reference = args.reference_text or parse_reference(content)
+        print(f"⚖️ {len(specs)} モデルを比較中: {', '.join(label for label, _ in specs)}", file=sys.stderr)
+        results = run_comparison(specs, prompt, reference, args.pooling, judge_options(args), args.similarity_backend)
+        report = format_compare_report(results, args.similarity_backend)
+        report += "\n" + format_trace_report(TRACER.summary(), trace_extras().get("hedging"))
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+        print(report)
+        return
+
     # --- Mode: Parse Prompt from Issue Body ---
     if args.mode == "parse":
         content = args.body or os.environ.get("ISSUE_BODY")
         if not content:
              print("Error: Body content is required (via --body or ISSUE_BODY env var).")
              sys.exit(1)
-        match = re.search(r"### Prompt\s*\n\s*(.*)", content, re.DOTALL)
-        if match:
-            print(match.group(1).strip())
-        else:
-            print(content.strip())
+        print(parse_prompt(content))
         return
 
     # --- Mode: Parse Reference Answer from Issue Body ---
     if args.mode == "parse-reference":
         content = args.body or os.environ.get("ISSUE_BODY", "")
-        match = re.search(r"### 参照回答\s*\n\s*(.*)", content, re.DOTALL)
-        if match:
-            text = match.group(1).strip()
-            # 次のセクション (### で始まる行) があれば手前で切る
-            text = re.split(r"^###", text, maxsplit=1, flags=re.MULTILINE)[0].strip()
-            print(text)
+        reference = parse_reference(content)
         # 参照回答がない場合は何も返さない (スキップのトリガーになる)
+        if reference:
+            print(reference)
         return
 
     # --- Standard Execution ---
@@ -420,21 +1692,41 @@ def main():
         print("Error: prompt argument is required for model execution modes.")
         sys.exit(1)
 
-    # 1. Base Model
+    targets = []
     if args.mode in ["base", "simultaneous"]:
-        base_url = f"https://{REGION}-aiplatform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/publishers/google/models/{BASE_MODEL_ID}"
-        base_res = call_api(base_url, prompt, "Base Model")
-        
-        print(f"### 🔹 Base Model ({BASE_MODEL_ID})")
-        print(base_res)
-
-    # 2. Tuned Model
+        targets.append((BASE_HEADING, base_model_url(), "Base Model"))
     if args.mode in ["tuned", "simultaneous"]:
-        tuned_url = f"https://{REGION}-aiplatform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/endpoints/{VERTEX_ENDPOINT_ID}"
-        tuned_res = call_api(tuned_url, prompt, "Tuned Model")
-        
-        print(f"### 🔸 Tuned Model (Fine-Tuned)")
-        print(tuned_res)
+        targets.append((TUNED_HEADING, tuned_model_url(), "Tuned Model"))
+
+    # 単一モデルの場合は受信した断片をそのまま標準出力へ書き出す
+    if len(targets) == 1:
+        heading, url, label = targets[0]
+        print(heading, flush=True)
+        streamed = []
+
+        def write_chunk(text):
+            streamed.append(text)
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        text, error = call_api(url, prompt, label, on_text=write_chunk)
+        # 途中でエラーになった場合はエラー内容を末尾に出力する
+        if error:
+            print(f"\n{error}" if streamed else error)
+        else:
+            print()
+            metrics = result_metrics(score=evaluate_response(text))
+            record_results("generate", prompt, *((metrics, None) if args.mode == "base" else (None, metrics)))
+        return
+
+    # ベース・チューニング済みを同時に実行し、出力順は targets の順に固定する
+    results = run_concurrently(prompt, [(url, label) for _, url, label in targets])
+    for (heading, _, _), (text, error) in zip(targets, results):
+        print(heading)
+        print(error or text)
+    record_results("generate", prompt, *(
+        None if error else result_metrics(score=evaluate_response(text)) for text, error in results
+    ))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+from array import array
+
+# --- 埋め込みベクトルの永続ストア ---
+# ベクトルは float32 の行として vectors.f32 に追記し、テキストのハッシュ → 行番号を
+# index.json に保持する。vectors.f32 はヘッダなしの行優先配列なので、NumPy があれば
+# np.memmap(path, dtype="float32").reshape(-1, dim) でそのまま読み込める。
+
+DEFAULT_STORE_DIR = os.path.join(".cache", "embeddings")
+
+def make_key(model, text):
+    """埋め込みモデル名と入力テキストからストアのキーを作る"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """同じテキストを二度埋め込まないためのディスクストア"""
+
+    def __init__(self, directory=DEFAULT_STORE_DIR, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._dim = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            directory=os.environ.get("EMBEDDING_STORE_DIR", DEFAULT_STORE_DIR),
+            enabled=os.environ.get("EMBEDDING_STORE_DISABLED", "") == "",
+        )
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.directory, "vectors.f32")
+
+    def _load(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            self._dim = meta.get("dim")
+            self._index = meta.get("keys", {})
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self._dim, "keys": self._index}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get_many(self, keys):
+        """保存済みのベクトルを {key: vector} で返す (未登録のキーは含まない)"""
+        if not self.enabled:
+            return {}
+        found = {}
+        with self._lock:
+            self._load()
+            rows = [(key, self._index[key]) for key in keys if key in self._index]
+            if rows:
+                row_bytes = self._dim * 4
+                with open(self.vectors_path, "rb") as f:
+                    for key, row in rows:
+                        f.seek(row * row_bytes)
+                        vec = array("f")
+                        vec.frombytes(f.read(row_bytes))
+                        found[key] = vec.tolist()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, vectors):
+        """{key: vector} を追記保存する"""
+        if not self.enabled or not vectors:
+            return
+        with self._lock:
+            self._load()
+            new_items = [(k, v) for k, v in vectors.items() if k not in self._index]
+            if not new_items:
+                return
+            if self._dim is None:
+                self._dim = len(new_items[0][1])
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.vectors_path, "ab") as f:
+                row = f.tell() // (self._dim * 4)
+                for key, vec in new_items:
+                    if len(vec) != self._dim:
+                        raise ValueError(f"embedding dim mismatch: {len(vec)} != {self._dim}")
+                    f.write(array("f", vec).tobytes())
+                    self._index[key] = row
+                    row += 1
+            self._save_index()
+
+    def summary(self):
+        return f"🧮 Embedding store: {self.hits} reused / {self.misses} embedded"
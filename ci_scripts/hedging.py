@@ -0,0 +1,180 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# --- ヘッジリクエスト (テールレイテンシ対策) ---
+# コールドなレプリカに当たると最初の応答まで長時間止まることがあるため、
+# 一定時間 (過去の TTFT の指定パーセンタイル) 経っても最初の断片が届かなければ同じリクエストをもう1本送り、
+# 先に正常に完了した方を採用して、負けた方の接続は切断する。
+
+DEFAULT_HISTORY_PATH = os.path.join(".cache", "hedge_latency.json")
+DEFAULT_PERCENTILE = 0.95
+# 履歴が min_samples 件に満たない間に使う待ち時間 (秒)
+DEFAULT_DELAY = 10.0
+DEFAULT_MIN_SAMPLES = 5
+MAX_HISTORY = 200
+# HEDGE_ENABLED でヘッジを無効とみなす値
+FALSE_VALUES = ("", "0", "false", "no", "off")
+
+class HedgeAttempt:
+    """1本分のリクエスト。最初の断片の到着と、キャンセル (接続の切断) を仲介する"""
+
+    def __init__(self, hedged, progress):
+        self.hedged = hedged
+        self.started_at = time.monotonic()
+        self.ttft = None
+        self.first_byte = threading.Event()
+        self.cancelled = threading.Event()
+        self._progress = progress
+        self._closers = []
+        self._lock = threading.Lock()
+
+    def mark_first_byte(self):
+        if not self.first_byte.is_set():
+            self.ttft = time.monotonic() - self.started_at
+            self.first_byte.set()
+            self._progress.set()
+
+    def register(self, closer):
+        """キャンセル時に呼ぶ関数 (受信中の接続を切断する) を登録する"""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._closers.append(closer)
+                return
+        closer()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            closers, self._closers = self._closers, []
+        for closer in closers:
+            try:
+                closer()
+            except OSError:
+                pass
+
+class Hedger:
+    """キー (エンドポイント) ごとの TTFT 履歴から待ち時間を決めてヘッジリクエストを送る"""
+
+    def __init__(self, enabled=False, percentile=DEFAULT_PERCENTILE, default_delay=DEFAULT_DELAY,
+                 min_samples=DEFAULT_MIN_SAMPLES, history_path=DEFAULT_HISTORY_PATH):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.history_path = history_path
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self._history = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix="HEDGE"):
+        """{prefix}_ENABLED / _PERCENTILE / _DEFAULT_DELAY / _MIN_SAMPLES / _HISTORY_PATH 環境変数から設定を読み込む"""
+        return cls(
+            enabled=os.environ.get(f"{prefix}_ENABLED", "").strip().lower() not in FALSE_VALUES,
+            percentile=float(os.environ.get(f"{prefix}_PERCENTILE", DEFAULT_PERCENTILE)),
+            default_delay=float(os.environ.get(f"{prefix}_DEFAULT_DELAY", DEFAULT_DELAY)),
+            min_samples=int(os.environ.get(f"{prefix}_MIN_SAMPLES", DEFAULT_MIN_SAMPLES)),
+            history_path=os.environ.get(f"{prefix}_HISTORY_PATH", DEFAULT_HISTORY_PATH),
+        )
+
+    def _load(self):
+        # 履歴はワークフローの実行をまたいで使うため、応答キャッシュと同じ .cache に保存する
+        if self._history is None:
+            self._history = {}
+            if self.history_path and os.path.exists(self.history_path):
+                try:
+                    with open(self.history_path, "r", encoding="utf-8") as f:
+                        self._history = json.load(f)
+                except (OSError, ValueError):
+                    pass
+        return self._history
+
+    def _save(self):
+        if not self.history_path:
+            return
+        directory = os.path.dirname(self.history_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.history_path, "w", encoding="utf-8") as f:
+            json.dump(self._history, f)
+
+    def delay(self, key):
+        """ヘッジを送るまでの待ち時間 (履歴の TTFT の percentile 点)"""
+        with self._lock:
+            samples = sorted(self._load().get(key, []))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return samples[min(len(samples) - 1, int(self.percentile * len(samples)))]
+
+    def observe(self, key, ttft):
+        with self._lock:
+            samples = self._load().setdefault(key, [])
+            samples.append(round(ttft, 3))
+            del samples[:-MAX_HISTORY]
+            self._save()
+
+    def run(self, key, func):
+        """func(attempt) を実行し、(テキスト, エラー) を返す
+
+        delay(key) 秒経っても最初の断片も結果も届かなければ、同じ func をもう1本並行して実行する。
+        先に成功した方の結果を返し、もう一方はキャンセルする (両方失敗した場合は後の方のエラー)。
+        スレッドはデーモンにして、止まったままの接続がプロセスの終了を妨げないようにする。
+        """
+        delay = self.delay(key)
+        results = queue.Queue()
+        progress = threading.Event()
+        attempts = []
+
+        def launch(hedged):
+            attempt = HedgeAttempt(hedged, progress)
+            attempts.append(attempt)
+
+            def target():
+                try:
+                    result = func(attempt)
+                except Exception as e:
+                    result = (None, str(e))
+                results.put((attempt, result))
+                progress.set()
+
+            threading.Thread(target=target, daemon=True).start()
+
+        with self._lock:
+            self.requests += 1
+        launch(hedged=False)
+        progress.wait(delay)
+        if results.empty() and not attempts[0].first_byte.is_set():
+            with self._lock:
+                self.fired += 1
+            launch(hedged=True)
+
+        pending = len(attempts)
+        while True:
+            winner, result = results.get()
+            pending -= 1
+            if result[1] is None or pending == 0:
+                break
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+        if result[1] is None:
+            if winner.hedged:
+                with self._lock:
+                    self.won += 1
+            if winner.ttft is not None:
+                self.observe(key, winner.ttft)
+        return result
+
+    def summary(self):
+        return (
+            f"🪁 Hedging: {self.fired}/{self.requests} requests hedged, "
+            f"{self.won} won by the hedge"
+        )
+
+    def to_dict(self):
+        return {"requests": self.requests, "fired": self.fired, "won": self.won}
@@ -0,0 +1,48 @@
+# --- ストリーミング JSON 抽出 ---
+# 生成途中のテキストを少しずつ受け取り、トップレベルの {...} が閉じた時点で
+# その文字列を返す。文字列リテラル内の括弧やエスケープは無視する。
+
+class JsonObjectScanner:
+    """チャンク単位で与えたテキストから完結した JSON オブジェクト文字列を取り出す"""
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        """text を追加し、この呼び出しで完結したオブジェクト文字列のリストを返す"""
+        completed = []
+        for ch in text:
+            if self._depth == 0:
+                # オブジェクトの外側の文字 (前置きの説明文やコードフェンス) は読み捨てる
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                continue
+
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed.append("".join(self._buffer))
+                    self._buffer = []
+        return completed
+
+def iter_json_objects(text):
+    """text に含まれるトップレベルの JSON オブジェクト文字列を順に返す"""
+    return JsonObjectScanner().feed(text)
@@ -0,0 +1,101 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # NumPy / SciPy が無い環境では純Pythonの疎ベクトル (dict) で計算する
+    np = None
+    sparse = None
+
+# --- 文字 n-gram TF-IDF による表層的類似度 ---
+# 埋め込み API を使わずに、参照回答との表現の重なりをローカルで計算する。
+# 日本語は単語境界が無いため、形態素解析の代わりに文字 n-gram を特徴量にする。
+# IDF は比較するテキスト全体 (参照回答と全回答) から求めるため、バッチでは件数が多いほど精度が上がる。
+
+DEFAULT_NGRAM_RANGE = (2, 3)
+
+# 区切りとして扱う文字 (n-gram はこれらをまたがない)
+SEPARATORS = re.compile(r"[\s、。,.・「」『』()\[\]【】!?:;*#\-_>|`~\"'/]+")
+
+def normalize_text(text):
+    """全角英数字・半角カナの揺れを吸収し (NFKC)、英字を小文字にそろえる"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+def char_ngrams(text, ngram_range=DEFAULT_NGRAM_RANGE):
+    """区切り文字で分けた各区間から文字 n-gram を数えた Counter を返す"""
+    counts = Counter()
+    low, high = ngram_range
+    for segment in SEPARATORS.split(normalize_text(text)):
+        for n in range(low, min(high, len(segment)) + 1):
+            counts.update([segment[i:i + n] for i in range(len(segment) - n + 1)])
+    return counts
+
+class TfidfVectorizer:
+    """文字 n-gram の TF-IDF ベクトル (L2 正規化済み) を作る
+
+    TF は 1 + log(出現回数)、IDF は log((1 + 文書数) / (1 + 出現文書数)) + 1 (平滑化)。
+    SciPy があれば CSR 行列、無ければ {n-gram: 重み} の dict のリストを返す。
+    """
+
+    def __init__(self, ngram_range=DEFAULT_NGRAM_RANGE):
+        self.ngram_range = ngram_range
+        self.vocabulary = {}
+        self.idf = None
+
+    def fit_transform(self, texts):
+        counts = [char_ngrams(text, self.ngram_range) for text in texts]
+        document_frequency = Counter()
+        for c in counts:
+            document_frequency.update(c.keys())
+        self.vocabulary = {gram: i for i, gram in enumerate(document_frequency)}
+        n_docs = len(texts)
+        idf = [math.log((1 + n_docs) / (1 + df)) + 1 for df in document_frequency.values()]
+        if sparse is not None:
+            self.idf = np.asarray(idf, dtype=np.float32)
+            return self._to_matrix(counts)
+        self.idf = dict(zip(document_frequency, idf))
+        return [self._to_dict(c) for c in counts]
+
+    def _to_matrix(self, counts):
+        indptr = [0]
+        indices = []
+        data = []
+        vocabulary = self.vocabulary
+        for c in counts:
+            indices.extend(vocabulary[gram] for gram in c)
+            data.extend(c.values())
+            indptr.append(len(indices))
+        indices = np.asarray(indices, dtype=np.int32)
+        values = (1 + np.log(np.asarray(data, dtype=np.float32))) * self.idf[indices]
+        matrix = sparse.csr_matrix((values, indices, np.asarray(indptr)), shape=(len(counts), len(vocabulary)))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.diags(1 / norms) @ matrix
+
+    def _to_dict(self, c):
+        vec = {gram: (1 + math.log(tf)) * self.idf[gram] for gram, tf in c.items()}
+        norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+        return {gram: v / norm for gram, v in vec.items()}
+
+def _pairwise(rows_a, rows_b):
+    if sparse is not None:
+        return [float(v) for v in np.asarray(rows_a.multiply(rows_b).sum(axis=1)).ravel()]
+    return [sum(v * b.get(gram, 0.0) for gram, v in a.items()) for a, b in zip(rows_a, rows_b)]
+
+def reference_similarities(references, *responses, ngram_range=DEFAULT_NGRAM_RANGE):
+    """references[i] と responses の各リストの i 番目との類似度を、リストごとに返す
+
+    例: reference_similarities(refs, base_texts, tuned_texts) -> [base_sims, tuned_sims]
+    """
+    count = len(references)
+    matrix = TfidfVectorizer(ngram_range).fit_transform(
+        list(references) + [text for texts in responses for text in texts]
+    )
+    ref_rows = matrix[:count]
+    return [
+        _pairwise(ref_rows, matrix[count * (i + 1):count * (i + 2)])
+        for i in range(len(responses))
+    ]
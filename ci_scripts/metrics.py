@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import re
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+
+# --- 定量評価の指標エンジン ---
+# 回答テキストごとに TextProfile (段落・リスト・見出し・文などの集計) を1つ作り、
+# 登録済みの各指標は TextProfile から値を計算する (同じ集計を指標ごとにやり直さない)。
+# 指標を増やすときは register_metric で関数を登録する。
+# JSONL の回答集をプロセスプールでストリーム処理し、指標ごとの分布を出すこともできる:
+#
+#   python3 ci_scripts/metrics.py responses.jsonl --group-by model
+
+# 1タスクあたりの行数と、同時に保持する未完了タスク数 (ワーカー数の倍数)。tuning/convert_data.py と同じ方式
+CHUNK_LINES = 2000
+MAX_PENDING_PER_WORKER = 2
+
+# 各パターンは改行をまたがない ([^\S\n] = 改行以外の空白)。テキスト全体に MULTILINE で1回ずつ適用する
+# 空白以外を含む行 (段落)
+PARAGRAPH_LINE = re.compile(r"^[^\S\n]*\S", re.MULTILINE)
+# 箇条書き (「-」「・」「*」「○」「•」) と番号付きリスト (「1.」「1)」「1）」) の行
+LIST_LINE = re.compile(r"^[^\S\n]*(?:[-・*○•]|\d+[.)）])", re.MULTILINE)
+# 「？」「?」で終わる行
+QUESTION_LINE = re.compile(r"[？?][^\S\n]*$", re.MULTILINE)
+# 見出し行 (Markdown の「#」、【見出し】、**太字だけの行**)
+HEADING_LINE = re.compile(r"^[^\S\n]*(?:#[^\n]*|【[^\n]*】[^\S\n]*|\*\*[^\n]+\*\*[^\S\n]*)$", re.MULTILINE)
+# 文: 「。」「！」「？」と改行で区切った区間のうち、閉じ括弧・空白以外の文字を含むもの
+SENTENCE = re.compile(r"[^。！？!?\n]*?[^。！？!?\n」』)）\"'\s][^。！？!?\n]*")
+# 丁寧語 (です・ます調) で終わる文
+POLITE_SENTENCE = re.compile(
+    r"(?:です|ます|ました|ません|でした|でしょう|ましょう|ください|ございます)[かねよ]?"
+    r"[」』)）\"'\s]*(?=[。！？!?\n]|$)"
+)
+# 実質文字数で数えない文字
+BLANK_CHARS = (" ", "　", "\n", "\r")
+
+class TextProfile:
+    """指標の計算に使うテキストの特徴量
+
+    各特徴量は最初に参照されたときに1回だけ計算してキャッシュする。複数の指標が同じ特徴量
+    (段落数など) を使っても走査は1回で済み、使われない特徴量は計算しない。
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.char_count = len(text)
+
+    @cached_property
+    def effective_char_count(self):
+        # 非ASCII文字列では str.translate による削除より str.count の方がずっと速い
+        return self.char_count - sum(self.text.count(c) for c in BLANK_CHARS)
+
+    @cached_property
+    def paragraph_count(self):
+        return len(PARAGRAPH_LINE.findall(self.text))
+
+    @cached_property
+    def list_items(self):
+        return len(LIST_LINE.findall(self.text))
+
+    @cached_property
+    def question_count(self):
+        return len(QUESTION_LINE.findall(self.text))
+
+    @cached_property
+    def _body(self):
+        """見出し行を除いた本文と見出し行数"""
+        return HEADING_LINE.subn("", self.text)
+
+    @cached_property
+    def heading_count(self):
+        return self._body[1]
+
+    @cached_property
+    def sentence_count(self):
+        return len(SENTENCE.findall(self._body[0]))
+
+    @cached_property
+    def polite_sentence_count(self):
+        return len(POLITE_SENTENCE.findall(self._body[0]))
+
+# --- 指標の登録 ---
+
+class Metric:
+    def __init__(self, name, label, description, func, informational=False):
+        self.name = name
+        self.label = label
+        self.description = description
+        self.func = func
+        self.informational = informational
+
+# 指標名 → Metric (登録順がレポートの表示順になる)
+METRICS = {}
+# 結果ストア・逐次検定で定量評価の指標名に付ける接頭辞 (compare_models.result_metrics)
+SCORE_PREFIX = "score."
+
+def register_metric(name, label, description="", informational=False):
+    """TextProfile を受け取って値を返す関数を指標として登録するデコレータ
+
+    値は「大きいほど良い」ものとしてレポートの勝敗・ランキング・回帰チェックで扱われる。
+    大小に良し悪しのない指標 (敬語率など) は informational=True で登録すると、値は表示するが勝敗には数えない。
+    """
+    def decorator(func):
+        METRICS[name] = Metric(name, label, description, func, informational)
+        return func
+    return decorator
+
+def is_informational(name):
+    """指標名 (結果ストアの "score.<name>" 形式も可) が勝敗に数えない参考指標か"""
+    if name.startswith(SCORE_PREFIX):
+        name = name[len(SCORE_PREFIX):]
+    metric = METRICS.get(name)
+    return metric is not None and metric.informational
+
+@register_metric("char_count", "文字数", "回答の総分量。多いほど詳細な回答")
+def char_count(profile):
+    return profile.char_count
+
+@register_metric("effective_char_count", "実質文字数", "空白・改行除く内容密度")
+def effective_char_count(profile):
+    return profile.effective_char_count
+
+@register_metric("paragraph_count", "段落数", "回答の構造化度合い")
+def paragraph_count(profile):
+    return profile.paragraph_count
+
+@register_metric("list_items", "リスト項目数", "箇条書き等の具体的な列挙")
+def list_items(profile):
+    return profile.list_items
+
+@register_metric("avg_para_length", "平均段落文字数", "各段落の情報密度（高すぎると読みにくい）")
+def avg_para_length(profile):
+    # 実質文字数 / 段落数
+    return round(profile.effective_char_count / profile.paragraph_count) if profile.paragraph_count else 0
+
+@register_metric("question_count", "疑問文数", "相談者への考察促進の指標")
+def question_count(profile):
+    return profile.question_count
+
+@register_metric("sentence_count", "文数", "「。」「？」「！」や改行で区切った文の数")
+def sentence_count(profile):
+    return profile.sentence_count
+
+@register_metric("keigo_ratio", "敬語率", "です・ます調で終わる文の割合 (0～1)", informational=True)
+def keigo_ratio(profile):
+    return round(profile.polite_sentence_count / profile.sentence_count, 2) if profile.sentence_count else 0
+
+@register_metric("heading_count", "見出し数", "「#」「【】」「**太字**」の見出し行。長い回答の読みやすさ", informational=True)
+def heading_count(profile):
+    return profile.heading_count
+
+def evaluate_response(text, metrics=None):
+    """テキストから登録済みの全指標 (metrics を渡した場合はその指標名のみ) を計算して返す"""
+    profile = TextProfile(text)
+    selected = METRICS.values() if metrics is None else [METRICS[name] for name in metrics]
+    return {metric.name: metric.func(profile) for metric in selected}
+
+# --- JSONL の一括集計 ---
+
+def response_texts(entry, field="text", group_by=None):
+    """1行分の JSON から (グループ, 回答テキスト) のリストを返す
+
+    field の値を回答として扱う。field が無く学習データ形式 (contents / messages) の場合は
+    モデル側の発話をすべて回答として扱う。
+    """
+    group = str(entry.get(group_by, "")) if group_by else ""
+    if isinstance(entry.get(field), str):
+        return [(group, entry[field])]
+    if "contents" in entry:
+        return [
+            (group, "".join(p.get("text", "") for p in turn.get("parts", [])))
+            for turn in entry["contents"] if turn.get("role") == "model"
+        ]
+    return [(group, msg.get("content", "")) for msg in entry.get("messages", []) if msg.get("role") == "assistant"]
+
+def read_chunks(infile, chunk_lines):
+    chunk = []
+    for line_no, line in enumerate(infile, start=1):
+        if not line.strip():
+            continue
+        chunk.append((line_no, line))
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def score_chunk(args):
+    """チャンク内の全回答の指標を計算する (ワーカープロセス用)
+
+    {グループ: {指標名: [値, ...]}} と、JSON として読めなかった行番号を返す。
+    """
+    chunk, field, group_by = args
+    values = {}
+    invalid = []
+    for line_no, line in chunk:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            invalid.append(line_no)
+            continue
+        for group, text in response_texts(entry, field, group_by):
+            columns = values.setdefault(group, {name: [] for name in METRICS})
+            for name, value in evaluate_response(text).items():
+                columns[name].append(value)
+    return values, invalid
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def distribution(values):
+    """指標値の分布 (件数・平均・標準偏差・最小・p10/p50/p90・最大)"""
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+    mean = sum(ordered) / len(ordered)
+    return {
+        "count": len(ordered),
+        "mean": round(mean, 2),
+        "stdev": round((sum((v - mean) ** 2 for v in ordered) / len(ordered)) ** 0.5, 2),
+        "min": ordered[0],
+        "p10": _percentile(ordered, 0.10),
+        "p50": _percentile(ordered, 0.50),
+        "p90": _percentile(ordered, 0.90),
+        "max": ordered[-1],
+    }
+
+def score_file(input_path, field="text", group_by=None, workers=None, chunk_lines=CHUNK_LINES):
+    """JSONL をチャンクに分けてプロセスプールで集計し、グループ・指標ごとの分布を返す"""
+    workers = workers or os.cpu_count() or 1
+    started_at = time.monotonic()
+    columns = {}
+    invalid = []
+
+    def consume(values, chunk_invalid):
+        invalid.extend(chunk_invalid)
+        for group, metric_values in values.items():
+            target = columns.setdefault(group, {name: array("d") for name in METRICS})
+            for name, vals in metric_values.items():
+                target[name].extend(vals)
+
+    with open(input_path, "r", encoding="utf-8") as infile, \
+         ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in read_chunks(infile, chunk_lines):
+            pending.append(executor.submit(score_chunk, (chunk, field, group_by)))
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                consume(*pending.popleft().result())
+        while pending:
+            consume(*pending.popleft().result())
+
+    elapsed = time.monotonic() - started_at
+    responses = sum(len(next(iter(group.values()))) for group in columns.values())
+    return {
+        "input": input_path,
+        "responses": responses,
+        "invalid_lines": invalid,
+        "elapsed_sec": round(elapsed, 2),
+        "responses_per_sec": round(responses / elapsed) if elapsed else None,
+        "workers": workers,
+        "groups": {
+            group: {name: distribution(vals) for name, vals in metric_values.items()}
+            for group, metric_values in sorted(columns.items())
+        },
+    }
+
+def format_distribution_report(report):
+    """グループごとに、指標の分布をMarkdownの表にして返す"""
+    lines = [
+        f"# 📊 定量評価の分布 ({report['input']})",
+        "",
+        f"- 回答数: {report['responses']} ({report['elapsed_sec']}s, {report['responses_per_sec']} 件/s, {report['workers']} workers)",
+    ]
+    if report["invalid_lines"]:
+        lines.append(f"- JSON として読めなかった行: {len(report['invalid_lines'])}")
+    for group, dists in report["groups"].items():
+        lines += ["", f"## {group or '全体'}", ""]
+        lines.append("| 指標 | 平均 | 標準偏差 | 最小 | p10 | p50 | p90 | 最大 |")
+        lines.append("|---|---|---|---|---|---|---|---|")
+        for name, dist in dists.items():
+            if not dist["count"]:
+                continue
+            lines.append(
+                f"| {METRICS[name].label} | {dist['mean']} | {dist['stdev']} | {dist['min']:g} | "
+                f"{dist['p10']:g} | {dist['p50']:g} | {dist['p90']:g} | {dist['max']:g} |"
+            )
+    return "\n".join(lines) + "\n"
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compute per-metric distributions over a JSONL of responses.")
+    parser.add_argument("input", help="JSONL of responses ({\"text\": ...} per line, or training data format).")
+    parser.add_argument("--field", default="text", help="JSON field holding the response text.")
+    parser.add_argument("--group-by", help="JSON field to group responses by (e.g. model).")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--chunk-lines", type=int, default=CHUNK_LINES, help="Lines per worker task.")
+    parser.add_argument("--output", help="Write the Markdown report to this path.")
+    parser.add_argument("--json", help="Also write the distributions as JSON to this path.")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    report = score_file(args.input, args.field, args.group_by, args.workers, args.chunk_lines)
+    text = format_distribution_report(report)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
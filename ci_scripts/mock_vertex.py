@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Vertex AI モックサーバ (ベンチマーク・オフライン検証用) ---
+# streamGenerateContent (SSE) と :predict (埋め込み) を標準ライブラリだけで模倣する。
+# 応答までの遅延・チャンク間隔・429 の発生率を設定でき、記録済みの応答を再生できる。
+# compare_models.py は VERTEX_API_BASE=http://127.0.0.1:<port> で向け先を切り替える。
+
+DEFAULT_PORT = 8765
+EMBEDDING_DIM = 768
+
+DEFAULT_ANSWER = (
+    "まずは部下の話を最後まで聴き、モチベーションが下がっている背景を一緒に整理しましょう。\n\n"
+    "1. 1on1 の場を設け、評価とは切り離して率直に話せる雰囲気をつくる\n"
+    "2. 業務量・人間関係・キャリアの見通しなど、要因を具体的に確認する\n"
+    "3. 小さな目標を合意し、達成をこまめにフィードバックする\n\n"
+    "本人が何にやりがいを感じるのかを問いかけてみるのも有効です。最近、手応えを感じた仕事はありましたか？\n"
+)
+DEFAULT_JUDGMENT = '{"実用性": 7, "共感性": 6, "専門性": 5, "コメント": "具体策があり実践しやすい"}'
+DEFAULT_PAIRWISE_JUDGMENT = (
+    '{"回答A": {"実用性": 6, "共感性": 6, "専門性": 5}, '
+    '"回答B": {"実用性": 7, "共感性": 7, "専門性": 6}, "コメント": "回答Bの方が具体的"}'
+)
+
+# プロンプトに含まれる文字列で応答を選ぶ (先頭から順に照合し、最初に一致したものを使う)
+DEFAULT_RESPONSES = [
+    {"match": "## 回答A", "text": DEFAULT_PAIRWISE_JUDGMENT},
+    {"match": "## 評価対象の回答", "text": DEFAULT_JUDGMENT},
+    {"match": None, "text": DEFAULT_ANSWER},
+]
+
+def load_recordings(path):
+    """記録済み応答の JSONL を読み込む
+
+    各行は {"match": "<プロンプトに含まれる文字列 | null>", "chunks": [...]} または
+    {"match": ..., "text": "..."} 形式。"usageMetadata" があればそのまま返す。
+    同じ match の記録が複数ある場合は順番に再生する。
+    """
+    recordings = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                recordings.append(json.loads(line))
+    return recordings
+
+class MockConfig:
+    """遅延・エラー注入の設定"""
+
+    def __init__(self, latency_ms=200.0, latency_sigma=0.5, chunk_interval_ms=30.0, chunk_jitter=0.3,
+                 chunk_chars=20, error_rate=0.0, retry_after=1.0, embedding_latency_ms=80.0,
+                 embedding_dim=EMBEDDING_DIM, recordings=None, seed=None):
+        # 最初のバイトまでの遅延は対数正規分布 (中央値 latency_ms, 形状 latency_sigma)
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.chunk_interval_ms = chunk_interval_ms
+        self.chunk_jitter = chunk_jitter
+        self.chunk_chars = chunk_chars
+        # 429 RESOURCE_EXHAUSTED を返す確率と Retry-After (秒)
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.embedding_latency_ms = embedding_latency_ms
+        self.embedding_dim = embedding_dim
+        self.recordings = list(recordings or [])
+        self.seed = seed
+
+    def to_dict(self):
+        return {
+            "latency_ms": self.latency_ms,
+            "latency_sigma": self.latency_sigma,
+            "chunk_interval_ms": self.chunk_interval_ms,
+            "chunk_jitter": self.chunk_jitter,
+            "chunk_chars": self.chunk_chars,
+            "error_rate": self.error_rate,
+            "retry_after": self.retry_after,
+            "embedding_latency_ms": self.embedding_latency_ms,
+            "embedding_dim": self.embedding_dim,
+            "recordings": len(self.recordings),
+            "seed": self.seed,
+        }
+
+class MockVertexServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, MockVertexHandler)
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.stats = {"requests": 0, "generate": 0, "predict": 0, "throttled": 0, "not_found": 0}
+        self._replay_positions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def latency(self, median_ms):
+        if median_ms <= 0:
+            return 0.0
+        with self._lock:
+            return median_ms / 1000 * math.exp(self.rng.gauss(0, self.config.latency_sigma))
+
+    def chunk_delay(self):
+        jitter = self.config.chunk_jitter
+        with self._lock:
+            return max(0.0, self.config.chunk_interval_ms / 1000 * self.rng.uniform(1 - jitter, 1 + jitter))
+
+    def throttle(self):
+        if self.config.error_rate <= 0:
+            return False
+        with self._lock:
+            return self.rng.random() < self.config.error_rate
+
+    def pick_response(self, prompt):
+        """プロンプトに一致する記録を選び、(チャンクのリスト, usageMetadata) を返す"""
+        # 記録済みの応答を優先し、一致しなければ組み込みの応答を使う
+        for source in (self.config.recordings, DEFAULT_RESPONSES):
+            candidates = [rec for rec in source if not rec.get("match") or rec["match"] in prompt]
+            if candidates:
+                break
+        # 同じ match の記録だけを順番に再生する
+        match = candidates[0].get("match")
+        group = [rec for rec in candidates if rec.get("match") == match]
+        with self._lock:
+            position = self._replay_positions.get((id(source), match), 0)
+            self._replay_positions[(id(source), match)] = position + 1
+        record = group[position % len(group)]
+
+        chunks = record.get("chunks")
+        if chunks is None:
+            text = record.get("text", "")
+            size = max(1, self.config.chunk_chars)
+            chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        usage = record.get("usageMetadata") or {
+            # 日本語は1文字≒1トークンとして概算する
+            "promptTokenCount": len(prompt),
+            "candidatesTokenCount": sum(len(c) for c in chunks),
+            "totalTokenCount": len(prompt) + sum(len(c) for c in chunks),
+        }
+        return chunks, usage
+
+def embedding_vector(text, dim):
+    """テキストから決定的な単位ベクトルを作る (同じテキストは常に同じベクトル)"""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    values = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+class MockVertexHandler(BaseHTTPRequestHandler):
+    # keep-alive を有効にするため HTTP/1.1 で応答する
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        server.count("requests")
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?", 1)[0]
+
+        if path.endswith(":streamGenerateContent"):
+            server.count("generate")
+            if self._maybe_throttle():
+                return
+            self._stream_generate(body)
+        elif path.endswith(":predict"):
+            server.count("predict")
+            if self._maybe_throttle():
+                return
+            self._predict(body)
+        else:
+            server.count("not_found")
+            self._send_json(404, {"error": {"code": 404, "message": f"unknown path: {path}", "status": "NOT_FOUND"}})
+
+    def _maybe_throttle(self):
+        if not self.server.throttle():
+            return False
+        self.server.count("throttled")
+        self._send_json(
+            429,
+            {"error": {"code": 429, "message": "Resource has been exhausted (mock).", "status": "RESOURCE_EXHAUSTED"}},
+            {"Retry-After": f"{self.server.config.retry_after:g}"},
+        )
+        return True
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream_generate(self, body):
+        prompt = "".join(
+            part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])
+        )
+        chunks, usage = self.server.pick_response(prompt)
+        time.sleep(self.server.latency(self.server.config.latency_ms))
+
+        # SSE は長さが事前に分からないため、送信後に接続を閉じて終端を示す
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.server.chunk_delay())
+            event = {"candidates": [{"content": {"role": "model", "parts": [{"text": chunk}]}}]}
+            if i == len(chunks) - 1:
+                event["candidates"][0]["finishReason"] = "STOP"
+                event["usageMetadata"] = usage
+            self.wfile.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\r\n\r\n")
+            self.wfile.flush()
+
+    def _predict(self, body):
+        time.sleep(self.server.latency(self.server.config.embedding_latency_ms))
+        dim = self.server.config.embedding_dim
+        predictions = [
+            {"embeddings": {
+                "values": embedding_vector(instance.get("content", ""), dim),
+                "statistics": {"token_count": len(instance.get("content", "")), "truncated": False},
+            }}
+            for instance in body.get("instances", [])
+        ]
+        self._send_json(200, {"predictions": predictions})
+
+def start_server(config, host="127.0.0.1", port=0):
+    """バックグラウンドスレッドでモックサーバを起動して返す (port=0 は空きポート)"""
+    server = MockVertexServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_config_arguments(parser):
+    """モックサーバの設定用オプションを parser に追加する (benchmark.py と共用)"""
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Median time to first byte for generation (ms).")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal shape of the first-byte latency.")
+    parser.add_argument("--chunk-interval-ms", type=float, default=30.0, help="Mean delay between SSE chunks (ms).")
+    parser.add_argument("--chunk-jitter", type=float, default=0.3, help="Relative jitter of the chunk delay.")
+    parser.add_argument("--chunk-chars", type=int, default=20, help="Characters per SSE chunk when replaying plain text.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of answering 429 RESOURCE_EXHAUSTED.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429 responses.")
+    parser.add_argument("--embedding-latency-ms", type=float, default=80.0, help="Median latency of :predict (ms).")
+    parser.add_argument("--embedding-dim", type=int, default=EMBEDDING_DIM, help="Dimension of mock embeddings.")
+    parser.add_argument("--recordings", help="JSONL of recorded responses to replay.")
+    parser.add_argument("--seed", type=int, help="Random seed for latency and error injection.")
+
+def config_from_args(args):
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        chunk_interval_ms=args.chunk_interval_ms,
+        chunk_jitter=args.chunk_jitter,
+        chunk_chars=args.chunk_chars,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        embedding_latency_ms=args.embedding_latency_ms,
+        embedding_dim=args.embedding_dim,
+        recordings=load_recordings(args.recordings) if args.recordings else None,
+        seed=args.seed,
+    )
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Local mock of the Vertex AI streamGenerateContent / :predict APIs.")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Bind port.")
+    add_config_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    server = MockVertexServer((args.host, args.port), config_from_args(args))
+    print(f"Mock Vertex AI server listening on {server.url}", file=sys.stderr)
+    print(f"  export VERTEX_API_BASE={server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats), file=sys.stderr)
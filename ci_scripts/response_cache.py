@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# --- モデル応答のディスクキャッシュ ---
+# キーはモデル/エンドポイントURL・プロンプト・generationConfig のハッシュ。
+# 同一条件の再実行 (ラベルの付け直し・ワークフローの再実行) で API を呼ばずに済ませる。
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "model_responses.sqlite3")
+DEFAULT_JUDGE_CACHE_PATH = os.path.join(".cache", "judge_results.sqlite3")
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def make_key(model, payload):
+    """モデル識別子とリクエスト内容 (contents / generationConfig) からキャッシュキーを作る"""
+    material = json.dumps(
+        {
+            "model": model,
+            "contents": payload.get("contents"),
+            "generationConfig": payload.get("generationConfig"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """SQLite に応答テキストを保存する TTL・容量上限 (LRU) 付きキャッシュ"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_bytes=DEFAULT_MAX_BYTES, enabled=True):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix="RESPONSE_CACHE", default_path=DEFAULT_CACHE_PATH):
+        """{prefix}_PATH / _TTL / _MAX_MB / _DISABLED 環境変数から設定を読み込む"""
+        return cls(
+            path=os.environ.get(f"{prefix}_PATH", default_path),
+            ttl_seconds=float(os.environ.get(f"{prefix}_TTL", DEFAULT_TTL_SECONDS)),
+            max_bytes=int(float(os.environ.get(f"{prefix}_MAX_MB", DEFAULT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024),
+            enabled=os.environ.get(f"{prefix}_DISABLED", "") == "",
+        )
+
+    def _connect(self):
+        # 接続は最初の get/put まで遅延させる (parse モード等ではファイルを作らない)
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _bump(self, conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def get(self, key):
+        """キャッシュされた応答を返す。期限切れ・未登録・無効時は None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                self._bump(conn, "misses")
+                conn.commit()
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            self.bytes_served += len(row[0].encode("utf-8"))
+            self._bump(conn, "hits")
+            conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """応答を保存し、容量上限を超えた分を最終アクセスの古い順に削除する"""
+        if not self.enabled:
+            return
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def lifetime_counters(self):
+        """これまでの実行を通算したヒット・ミス数を返す"""
+        with self._lock:
+            conn = self._connect()
+            rows = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        return rows.get("hits", 0), rows.get("misses", 0)
+
+    def summary(self):
+        total_hits, total_misses = self.lifetime_counters()
+        return (
+            f"💾 Response cache: {self.hits} hits / {self.misses} misses "
+            f"({self.bytes_served} bytes served from cache, "
+            f"lifetime {total_hits} hits / {total_misses} misses)"
+        )
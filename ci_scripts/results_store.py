@@ -0,0 +1,281 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from metrics import is_informational
+
+# --- 評価結果の履歴ストア ---
+# 定量評価・審判・類似度の各指標を、モデル (バージョン)・プロンプトのハッシュ・実行時刻とともに
+# SQLite に追記していく (更新・削除はしない)。Issue のコメントを遡らなくても、
+# 任意の2つのモデルを保存済みの全プロンプトで比較し、悪化した指標を洗い出せる。
+#
+#   python3 ci_scripts/results_store.py models
+#   python3 ci_scripts/results_store.py compare gemini-2.5-flash endpoint/1234567890
+#   python3 ci_scripts/results_store.py merge previous/results.sqlite3
+
+DEFAULT_RESULTS_PATH = os.path.join(".cache", "results.sqlite3")
+# 比較時に「悪化」とみなす平均値の低下率
+DEFAULT_TOLERANCE = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    prompt_hash TEXT,
+    model TEXT NOT NULL,
+    endpoint TEXT,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_results_prompt_hash ON results (prompt_hash);
+CREATE INDEX IF NOT EXISTS idx_results_model ON results (model, metric, prompt_hash, value);
+CREATE INDEX IF NOT EXISTS idx_results_endpoint ON results (endpoint);
+CREATE INDEX IF NOT EXISTS idx_results_created_at ON results (created_at);
+CREATE TABLE IF NOT EXISTS prompts (
+    prompt_hash TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL
+);
+"""
+
+def prompt_hash(prompt):
+    """プロンプトのハッシュ (前後の空白は無視する)。プロンプトが無ければ None"""
+    if not prompt:
+        return None
+    return hashlib.sha256(prompt.strip().encode("utf-8")).hexdigest()
+
+def default_run_id():
+    """GitHub Actions では実行ID、それ以外では時刻とプロセスIDから作る"""
+    return os.environ.get("GITHUB_RUN_ID") or f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+
+class ResultsStore:
+    """指標を1行1値で追記する SQLite ストア"""
+
+    def __init__(self, path=DEFAULT_RESULTS_PATH, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.recorded = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix="RESULTS_STORE"):
+        """{prefix}_PATH / _DISABLED 環境変数から設定を読み込む"""
+        return cls(
+            path=os.environ.get(f"{prefix}_PATH", DEFAULT_RESULTS_PATH),
+            enabled=os.environ.get(f"{prefix}_DISABLED", "") == "",
+        )
+
+    def _connect(self):
+        # 接続は最初の読み書きまで遅延させる (parse モード等ではファイルを作らない)
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def record(self, run_id, mode, prompt, model, endpoint, metrics):
+        """{指標名: 値} を1回分の結果として追記する
+
+        結果の保存に失敗しても評価そのものは止めないよう、エラーは警告の表示にとどめる。
+        """
+        if not self.enabled or not metrics:
+            return
+        now = time.time()
+        key = prompt_hash(prompt)
+        rows = [
+            (run_id, mode, now, key, model, endpoint, name, float(value))
+            for name, value in metrics.items() if value is not None
+        ]
+        try:
+            with self._lock:
+                conn = self._connect()
+                if key:
+                    conn.execute("INSERT OR IGNORE INTO prompts (prompt_hash, prompt) VALUES (?, ?)", (key, prompt.strip()))
+                conn.executemany(
+                    "INSERT INTO results (run_id, mode, created_at, prompt_hash, model, endpoint, metric, value) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                conn.commit()
+                self.recorded += len(rows)
+        except sqlite3.Error as e:
+            print(f"⚠️ Failed to record results to {self.path}: {e}", file=sys.stderr)
+
+    def merge(self, path):
+        """別の結果ストア (過去の実行の成果物など) の行のうち、まだ無いものを取り込み、追加した行数を返す
+
+        同じ実行・時刻・モデル・指標の行は重複とみなすため、同じファイルを何度取り込んでもよい。
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                before = conn.total_changes
+                conn.execute("INSERT OR IGNORE INTO prompts (prompt_hash, prompt) SELECT prompt_hash, prompt FROM other.prompts")
+                prompts = conn.total_changes - before
+                conn.execute("""
+                    INSERT INTO results (run_id, mode, created_at, prompt_hash, model, endpoint, metric, value)
+                    SELECT o.run_id, o.mode, o.created_at, o.prompt_hash, o.model, o.endpoint, o.metric, o.value
+                    FROM other.results o
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM results r
+                        WHERE r.model = o.model AND r.metric = o.metric AND r.prompt_hash IS o.prompt_hash
+                          AND r.run_id = o.run_id AND r.mode = o.mode AND r.created_at = o.created_at
+                    )
+                """)
+                conn.commit()
+                return conn.total_changes - before - prompts
+            finally:
+                conn.execute("DETACH DATABASE other")
+
+    def models(self):
+        """記録済みのモデルごとに (モデル, プロンプト数, 最初の記録時刻, 最後の記録時刻) を返す"""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT model, COUNT(DISTINCT prompt_hash), MIN(created_at), MAX(created_at) "
+                "FROM results GROUP BY model ORDER BY MAX(created_at) DESC"
+            ).fetchall()
+
+    def compare(self, model_a, model_b, since=None):
+        """両モデルに記録がある全プロンプトについて、指標ごとの比較を返す
+
+        同じプロンプト・指標の記録が複数回ある場合は平均してから比較する。
+        戻り値は {"metric", "prompts", "mean_a", "mean_b", "better", "worse"} の dict のリスト。
+        """
+        query = """
+            WITH a AS (
+                SELECT prompt_hash, metric, AVG(value) AS value FROM results
+                WHERE model = ? AND prompt_hash IS NOT NULL AND created_at >= ?
+                GROUP BY prompt_hash, metric
+            ), b AS (
+                SELECT prompt_hash, metric, AVG(value) AS value FROM results
+                WHERE model = ? AND prompt_hash IS NOT NULL AND created_at >= ?
+                GROUP BY prompt_hash, metric
+            )
+            SELECT a.metric, COUNT(*), AVG(a.value), AVG(b.value),
+                   SUM(b.value > a.value), SUM(b.value < a.value)
+            FROM a JOIN b ON a.prompt_hash = b.prompt_hash AND a.metric = b.metric
+            GROUP BY a.metric ORDER BY a.metric
+        """
+        since = since or 0
+        with self._lock:
+            rows = self._connect().execute(query, (model_a, since, model_b, since)).fetchall()
+        return [
+            {"metric": metric, "prompts": count, "mean_a": mean_a, "mean_b": mean_b, "better": better, "worse": worse}
+            for metric, count, mean_a, mean_b, better, worse in rows
+        ]
+
+    def largest_drops(self, model_a, model_b, metric, limit=3, since=None):
+        """model_b で指標が最も下がったプロンプトを (プロンプト, a の値, b の値) で返す"""
+        query = """
+            WITH a AS (
+                SELECT prompt_hash, AVG(value) AS value FROM results
+                WHERE model = ? AND metric = ? AND prompt_hash IS NOT NULL AND created_at >= ?
+                GROUP BY prompt_hash
+            ), b AS (
+                SELECT prompt_hash, AVG(value) AS value FROM results
+                WHERE model = ? AND metric = ? AND prompt_hash IS NOT NULL AND created_at >= ?
+                GROUP BY prompt_hash
+            )
+            SELECT p.prompt, a.value, b.value
+            FROM a JOIN b ON a.prompt_hash = b.prompt_hash JOIN prompts p ON p.prompt_hash = a.prompt_hash
+            WHERE b.value < a.value ORDER BY b.value - a.value LIMIT ?
+        """
+        since = since or 0
+        with self._lock:
+            return self._connect().execute(
+                query, (model_a, metric, since, model_b, metric, since, limit)
+            ).fetchall()
+
+def find_regressions(rows, tolerance=DEFAULT_TOLERANCE):
+    """平均値が tolerance を超えて下がった指標名のリストを返す
+
+    定量評価サマリーと同じく値が大きい方を良しとし、大小に良し悪しのない参考指標 (敬語率など) は対象外とする。
+    """
+    regressions = []
+    for row in rows:
+        if is_informational(row["metric"]):
+            continue
+        base = abs(row["mean_a"]) or 1.0
+        if (row["mean_b"] - row["mean_a"]) / base < -tolerance:
+            regressions.append(row["metric"])
+    return regressions
+
+def format_comparison(model_a, model_b, rows, regressions, drops=None):
+    lines = [f"{model_a} -> {model_b}"]
+    if not rows:
+        lines.append("  No prompts recorded for both models.")
+        return "\n".join(lines)
+    lines.append(f"  {'metric':<28} {'prompts':>7} {'A':>10} {'B':>10} {'change':>8}  better/worse")
+    for row in rows:
+        change = (row["mean_b"] - row["mean_a"]) / (abs(row["mean_a"]) or 1.0)
+        flag = "  ⚠️ regression" if row["metric"] in regressions else ("  (informational)" if is_informational(row["metric"]) else "")
+        lines.append(
+            f"  {row['metric']:<28} {row['prompts']:>7} {row['mean_a']:>10.4g} {row['mean_b']:>10.4g} "
+            f"{change:>+8.1%}  {row['better']}/{row['worse']}{flag}"
+        )
+    for metric, prompts in (drops or {}).items():
+        lines.append(f"\n  Largest drops in {metric}:")
+        for prompt, value_a, value_b in prompts:
+            text = prompt.replace("\n", " ")
+            lines.append(f"    {value_a:.4g} -> {value_b:.4g}  {text[:40]}{'…' if len(text) > 40 else ''}")
+    return "\n".join(lines)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Query the historical results store written by compare_models.py.")
+    parser.add_argument("--path", default=os.environ.get("RESULTS_STORE_PATH", DEFAULT_RESULTS_PATH), help="Results database path.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("models", help="List recorded models and how many prompts each has.")
+    compare = subparsers.add_parser("compare", help="Compare two models across all prompts recorded for both (exit 1 on regression).")
+    compare.add_argument("model_a", help="Reference model (e.g. gemini-2.5-flash or endpoint/<id>).")
+    compare.add_argument("model_b", help="Model checked for regressions against model_a.")
+    compare.add_argument("--since-days", type=float, help="Only use results recorded within this many days.")
+    compare.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative drop of a mean treated as a regression.")
+    merge = subparsers.add_parser("merge", help="Copy rows missing from the database out of other results databases.")
+    merge.add_argument("sources", nargs="+", help="Results databases to merge (missing files are skipped).")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    if args.command == "merge":
+        # 初回 (ストアがまだ無い) でも取り込めるよう、merge だけは存在しないパスにも作成する
+        store = ResultsStore(args.path)
+        for source in args.sources:
+            if not os.path.exists(source) or os.path.abspath(source) == os.path.abspath(args.path):
+                continue
+            try:
+                print(f"{source}: {store.merge(source)} rows merged")
+            except sqlite3.Error as e:
+                print(f"⚠️ Failed to merge {source}: {e}", file=sys.stderr)
+        return
+    if not os.path.exists(args.path):
+        print(f"Error: {args.path} が見つかりません。", file=sys.stderr)
+        sys.exit(1)
+    store = ResultsStore(args.path)
+
+    if args.command == "models":
+        for model, prompts, first, last in store.models():
+            print(
+                f"{model:<40} {prompts:>5} prompts  "
+                f"{time.strftime('%Y-%m-%d', time.localtime(first))} .. {time.strftime('%Y-%m-%d', time.localtime(last))}"
+            )
+        return
+
+    since = time.time() - args.since_days * 86400 if args.since_days else None
+    rows = store.compare(args.model_a, args.model_b, since)
+    regressions = find_regressions(rows, args.tolerance)
+    drops = {metric: store.largest_drops(args.model_a, args.model_b, metric, since=since) for metric in regressions}
+    print(format_comparison(args.model_a, args.model_b, rows, regressions, drops))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import math
+
+# --- 逐次検定による早期終了 ---
+# プロンプトを1件評価するごとに、チューニング済みモデルがベースモデルに勝った・負けた回数で検定を更新する。
+# 勝率 p = 0.5 (差がない) に対する尤度比を、p に一様事前分布を置いた混合 (beta-binomial) で計算する。
+# この尤度比は H0 のもとでマルチンゲールになるため、Ville の不等式により
+# 「いつ止めても」尤度比が 1/alpha を超える確率は alpha 以下に収まる (何度のぞき見ても有意水準が崩れない)。
+# 引き分けは情報を持たないため数えない (符号検定)。
+
+DEFAULT_ALPHA = 0.05
+DEFAULT_MIN_ITEMS = 10
+DEFAULT_PRIMARY_METRIC = "judge.total"
+
+class SignSPRT:
+    """差分の符号に対する混合 SPRT (両側)"""
+
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        self.wins = 0
+        self.losses = 0
+        self.ties = 0
+        self.total_delta = 0.0
+
+    def update(self, delta):
+        self.total_delta += delta
+        if delta > 0:
+            self.wins += 1
+        elif delta < 0:
+            self.losses += 1
+        else:
+            self.ties += 1
+
+    @property
+    def count(self):
+        return self.wins + self.losses + self.ties
+
+    @property
+    def log_likelihood_ratio(self):
+        """∫ p^w (1-p)^l dp / 0.5^(w+l) の対数 (= log B(w+1, l+1) + (w+l) log 2)"""
+        w, l = self.wins, self.losses
+        return math.lgamma(w + 1) + math.lgamma(l + 1) - math.lgamma(w + l + 2) + (w + l) * math.log(2)
+
+    @property
+    def significant(self):
+        return self.log_likelihood_ratio >= math.log(1 / self.alpha)
+
+    @property
+    def verdict(self):
+        """有意なら "better" (チューニング済みが優勢) / "worse"、有意でなければ None"""
+        if not self.significant:
+            return None
+        return "better" if self.wins > self.losses else "worse"
+
+    @property
+    def mean_delta(self):
+        return self.total_delta / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {
+            "wins": self.wins,
+            "losses": self.losses,
+            "ties": self.ties,
+            "mean_delta": round(self.mean_delta, 4),
+            "likelihood_ratio": round(math.exp(min(self.log_likelihood_ratio, 700)), 2),
+            "verdict": self.verdict,
+        }
+
+class SequentialMonitor:
+    """指標ごとの SignSPRT をまとめ、主指標の検定が有意になった時点で停止を指示する
+
+    停止の判断には主指標だけを使う。他の指標の検定結果は参考値として報告する。
+    一度停止を指示したら、その後の更新 (停止時に実行中だった項目の結果) で尤度比が下がっても停止のままにする。
+    """
+
+    def __init__(self, primary=DEFAULT_PRIMARY_METRIC, alpha=DEFAULT_ALPHA, min_items=DEFAULT_MIN_ITEMS):
+        self.primary = primary
+        self.alpha = alpha
+        self.min_items = min_items
+        self.items = 0
+        self.tests = {}
+        # 停止条件を最初に満たした時点の件数と判定
+        self.stopped_at = None
+        self.stop_verdict = None
+
+    def update(self, base_metrics, tuned_metrics):
+        """1件分の指標 ({指標名: 値}) で全指標の検定を更新する (両方にある指標のみ)"""
+        self.items += 1
+        for name in base_metrics:
+            if name in tuned_metrics:
+                test = self.tests.setdefault(name, SignSPRT(self.alpha))
+                test.update(tuned_metrics[name] - base_metrics[name])
+        test = self.tests.get(self.primary)
+        if self.stopped_at is None and self.items >= self.min_items and test is not None and test.significant:
+            self.stopped_at = self.items
+            self.stop_verdict = test.verdict
+
+    @property
+    def should_stop(self):
+        return self.stopped_at is not None
+
+    @property
+    def verdict(self):
+        """停止した場合は停止時点の判定、そうでなければ現在の主指標の判定"""
+        if self.should_stop:
+            return self.stop_verdict
+        test = self.tests.get(self.primary)
+        return test.verdict if test else None
+
+    def to_dict(self):
+        return {
+            "primary": self.primary,
+            "alpha": self.alpha,
+            "items": self.items,
+            "stopped": self.should_stop,
+            "stopped_at": self.stopped_at,
+            "verdict": self.verdict,
+            "tests": {name: test.to_dict() for name, test in self.tests.items()},
+        }
@@ -0,0 +1,88 @@
+import heapq
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無い環境では純Pythonで計算する
+    np = None
+
+# --- ベクトル類似度エンジン ---
+# 埋め込みを行列として受け取り、正規化済みベクトルの行列積で
+# 多対多のコサイン類似度をまとめて計算する。
+
+def normalize_rows(vectors):
+    """各行を L2 正規化した行列を返す (ゼロベクトルはゼロのまま)"""
+    if np is not None:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[np.newaxis, :]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    rows = []
+    for vec in vectors:
+        norm = sum(v * v for v in vec) ** 0.5
+        rows.append([v / norm for v in vec] if norm else [0.0] * len(vec))
+    return rows
+
+def similarity_matrix(queries, references, normalized=False):
+    """queries × references のコサイン類似度行列を返す
+
+    normalized=True の場合は入力が正規化済みとみなし、正規化を省略する。
+    """
+    if not normalized:
+        queries = normalize_rows(queries)
+        references = normalize_rows(references)
+    if np is not None:
+        return np.asarray(queries) @ np.asarray(references).T
+    return [[sum(a * b for a, b in zip(q, r)) for r in references] for q in queries]
+
+def top_k(queries, references, k=1, normalized=False):
+    """各クエリについて類似度上位 k 件の (参照インデックス, スコア) を返す"""
+    sims = similarity_matrix(queries, references, normalized=normalized)
+    k = min(k, len(references))
+    if np is not None:
+        sims = np.asarray(sims)
+        if k < sims.shape[1]:
+            candidates = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+        results = []
+        for row, cand in zip(sims, candidates):
+            order = cand[np.argsort(-row[cand])]
+            results.append([(int(i), float(row[i])) for i in order])
+        return results
+    return [
+        heapq.nlargest(k, enumerate(row), key=lambda pair: pair[1])
+        for row in sims
+    ]
+
+def pairwise(queries, references):
+    """queries[i] と references[i] の類似度を要素ごとに返す"""
+    q = normalize_rows(queries)
+    r = normalize_rows(references)
+    if np is not None:
+        return [float(v) for v in np.einsum("ij,ij->i", q, r)]
+    return [sum(a * b for a, b in zip(x, y)) for x, y in zip(q, r)]
+
+POOLING_METHODS = ("mean", "max")
+
+def pool_vectors(vectors, method="mean", weights=None):
+    """チャンクごとのベクトルを1本に統合する
+
+    mean は weights (チャンクの文字数など) による加重平均、max は次元ごとの最大値。
+    """
+    if method not in POOLING_METHODS:
+        raise ValueError(f"unknown pooling method: {method}")
+    if len(vectors) == 1:
+        return list(vectors[0])
+    if weights is None:
+        weights = [1.0] * len(vectors)
+    if np is not None:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if method == "max":
+            return matrix.max(axis=0).tolist()
+        return np.average(matrix, axis=0, weights=weights).tolist()
+    if method == "max":
+        return [max(column) for column in zip(*vectors)]
+    total = float(sum(weights))
+    return [sum(w * v for w, v in zip(weights, column)) / total for column in zip(*vectors)]
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- 処理時間・トークン数の計測 (軽量トレース) ---
+# API 呼び出しとステージごとに Span を記録し、所要時間・送受信バイト数・
+# usageMetadata のトークン数・リトライ回数を集計する。外部ライブラリには依存しない。
+
+class Span:
+    """1回の API 呼び出し、または1ステージ分の計測値"""
+
+    def __init__(self, name, kind="api", **attrs):
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.elapsed = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.retries = 0
+        self.cached = False
+        self.error = None
+
+    def record_usage(self, usage):
+        """usageMetadata の値で更新する (ストリームでは最後のイベントが累計値を持つ)"""
+        self.prompt_tokens = usage.get("promptTokenCount", self.prompt_tokens)
+        self.output_tokens = usage.get("candidatesTokenCount", self.output_tokens)
+        self.total_tokens = usage.get("totalTokenCount", self.prompt_tokens + self.output_tokens)
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self._started
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "started_at": round(self.started_at, 3),
+            "elapsed_sec": round(self.elapsed, 4) if self.elapsed is not None else None,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "retries": self.retries,
+            "cached": self.cached,
+            "error": self.error,
+            **self.attrs,
+        }
+
+class Tracer:
+    """スレッドセーフに Span を集める"""
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, kind="api", **attrs):
+        span = Span(name, kind, **attrs)
+        try:
+            yield span
+        except BaseException as e:
+            # ジェネレータが途中で閉じられた場合 (GeneratorExit) はエラーとして扱わない
+            if not isinstance(e, GeneratorExit):
+                span.error = str(e) or type(e).__name__
+                # 再試行しきれなかった例外は retries 属性に再送回数を持つ (common/vertex_client.py)
+                span.retries += getattr(e, "retries", 0)
+            raise
+        finally:
+            span.finish()
+            with self._lock:
+                self._spans.append(span)
+
+    @property
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self):
+        """Span 名ごとの集計を、最初に記録された順の dict で返す
+
+        打ち切られた Span (attrs の cancelled。負けたヘッジリクエストなど) は所要時間を歪めるため集計しない。
+        """
+        spans = sorted((s for s in self.spans if not s.attrs.get("cancelled")), key=lambda s: s.started_at)
+        summary = {}
+        for span in spans:
+            row = summary.setdefault(span.name, {
+                "kind": span.kind, "count": 0, "errors": 0, "cached": 0, "retries": 0,
+                "total_sec": 0.0, "max_sec": 0.0, "bytes_sent": 0, "bytes_received": 0,
+                "prompt_tokens": 0, "output_tokens": 0, "total_tokens": 0,
+            })
+            row["count"] += 1
+            row["errors"] += 1 if span.error else 0
+            row["cached"] += 1 if span.cached else 0
+            row["retries"] += span.retries
+            row["total_sec"] += span.elapsed or 0.0
+            row["max_sec"] = max(row["max_sec"], span.elapsed or 0.0)
+            for key in ("bytes_sent", "bytes_received", "prompt_tokens", "output_tokens", "total_tokens"):
+                row[key] += getattr(span, key)
+        for row in summary.values():
+            row["total_sec"] = round(row["total_sec"], 4)
+            row["max_sec"] = round(row["max_sec"], 4)
+        return summary
+
+    def to_dict(self):
+        return {
+            "summary": self.summary(),
+            "spans": [span.to_dict() for span in sorted(self.spans, key=lambda s: s.started_at)],
+        }
+
+    def write_json(self, path, extra=None):
+        """集計と全 Span を JSON で書き出す。extra はトップレベルに追加する値"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(self.to_dict(), **(extra or {})), f, ensure_ascii=False, indent=2)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+# プロセス共通のトレーサ
+TRACER = Tracer()
@@ -0,0 +1,119 @@
+import email.utils
+import random
+import threading
+import time
+
+# --- クライアント側のレート制限と再試行ポリシー ---
+# 429 (RESOURCE_EXHAUSTED) を受けたら送信レートを半減して Retry-After の間は全スレッドの送信を止め、
+# 成功が続けば少しずつレートを戻す (AIMD)。バッチ実行で割り当てを使い切っても落ちないようにする。
+
+# 再試行の対象とするステータス (429 は未処理のため常に再送でき、5xx は冪等なリクエストのみ再送する)
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def parse_retry_after(value):
+    """Retry-After ヘッダ (秒数または HTTP 日付) を秒数で返す。解釈できなければ None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+class AdaptiveRateLimiter:
+    """トークンバケット方式のレート制限。429 を受けるたびにレートを下げ、成功が続くと上限まで戻す"""
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, increase_step=0.5, decrease_factor=0.5,
+                 decrease_cooldown=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        # 同時に送ったリクエストがまとめて 429 になった場合に、レートを何度も下げないための間隔 (秒)
+        self.decrease_cooldown = decrease_cooldown
+        self.throttled = 0
+        self.waited_sec = 0.0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """1リクエスト分のトークンを取得するまで待ち、待った秒数を返す"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waited_sec += waited
+                    return waited
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        """429 を受けたときに呼ぶ。レートを下げ、Retry-After の間は全体の送信を止める"""
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._last_decrease = now
+            self._tokens = 0.0
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def summary(self):
+        return (
+            f"🚦 Rate limiter: {self.throttled} throttled, waited {self.waited_sec:.1f}s, "
+            f"current rate {self.rate:.1f}/{self.max_rate:.1f} req/s"
+        )
+
+class RetryPolicy:
+    """指数バックオフ (フルジッタ) による再試行ポリシー"""
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, retry_statuses=RETRYABLE_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def should_retry(self, attempt, status=None, idempotent=True):
+        """attempt 回目 (0 始まり) の失敗を再試行するか。status が None なら通信エラー
+
+        429 はサーバが処理していないため常に再送できる。5xx や通信エラーは、
+        サーバ側で処理が進んだ可能性があるため冪等なリクエストに限る。
+        """
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if status == 429:
+            return True
+        if not idempotent:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """次の再試行までの待ち時間。Retry-After があればそれに従う"""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
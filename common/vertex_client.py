@@ -0,0 +1,361 @@
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from common.rate_limit import AdaptiveRateLimiter, RetryPolicy, parse_retry_after
+
+# --- Vertex AI 共通クライアント ---
+# gcloud のアクセストークンを有効期限までキャッシュし (プロセスをまたいでディスクにも保存)、
+# ホストごとに keep-alive 接続を再利用する。比較スクリプト・学習スクリプトの全てから使う。
+# 全リクエストはホストごとのレート制限を通り、429 / 5xx / 通信エラーは再試行ポリシーに従って再送する。
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TIMEOUT = 300
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "saiteki", "access_token.json")
+TOKENINFO_URL = "https://oauth2.googleapis.com/tokeninfo"
+# 有効期限の何秒前に更新するか / 期限が取得できなかった場合の有効期間
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_FALLBACK_LIFETIME = 3000
+MAX_IDLE_CONNECTIONS_PER_HOST = 8
+# レート制限 (ホストごと) と再試行の設定
+RATE_LIMIT_QPS = float(os.environ.get("VERTEX_RATE_LIMIT_QPS", "10"))
+RATE_LIMIT_BURST = int(os.environ.get("VERTEX_RATE_LIMIT_BURST", "10"))
+MAX_ATTEMPTS = int(os.environ.get("VERTEX_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.environ.get("VERTEX_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.environ.get("VERTEX_RETRY_MAX_DELAY", "60"))
+# 再送しても副作用のないメソッド (POST は呼び出し側が idempotent=True を指定した場合のみ)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# 接続確立・送信時の通信エラー (HTTPError は別途ステータスで判定する)
+CONNECTION_ERRORS = (ConnectionError, socket.timeout, http.client.HTTPException)
+
+def gcloud_path():
+    """GCLOUD_PATH → リポジトリ直下の google-cloud-sdk → PATH 上の gcloud の順に探す"""
+    if os.environ.get("GCLOUD_PATH"):
+        return os.environ["GCLOUD_PATH"]
+    bundled = os.path.join(PROJECT_ROOT, "google-cloud-sdk", "bin", "gcloud")
+    if os.path.exists(bundled):
+        return bundled
+    return shutil.which("gcloud") or "gcloud"
+
+class AccessTokenProvider:
+    """gcloud のアクセストークンを遅延取得し、有効期限が近づくまで使い回す"""
+
+    def __init__(self, cache_path=TOKEN_CACHE_PATH):
+        self.cache_path = cache_path
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def token(self):
+        with self._lock:
+            if self._token and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN:
+                return self._token
+            if self._load_cached():
+                return self._token
+            self._refresh()
+            return self._token
+
+    def invalidate(self):
+        """401 を受けた場合などに、キャッシュ済みトークンを破棄する"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+    def _load_cached(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() >= cached.get("expires_at", 0) - TOKEN_REFRESH_MARGIN:
+            return False
+        self._token = cached["token"]
+        self._expires_at = cached["expires_at"]
+        return True
+
+    def _refresh(self):
+        token = subprocess.check_output(
+            [gcloud_path(), "auth", "print-access-token"], text=True
+        ).strip()
+        self._token = token
+        self._expires_at = time.time() + self._lifetime(token)
+        if self.cache_path:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            # トークンを含むため所有者のみ読み書き可能にする
+            fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"token": token, "expires_at": self._expires_at}, f)
+
+    def _lifetime(self, token):
+        # print-access-token は有効期限を返さないため tokeninfo で問い合わせる
+        try:
+            url = f"{TOKENINFO_URL}?{urllib.parse.urlencode({'access_token': token})}"
+            with urllib.request.urlopen(url, timeout=10) as res:
+                return float(json.loads(res.read()).get("expires_in", TOKEN_FALLBACK_LIFETIME))
+        except Exception:
+            return TOKEN_FALLBACK_LIFETIME
+
+class RequestCancelled(Exception):
+    """RequestCanceller.cancel() で打ち切られたリクエスト (再試行しない)"""
+
+class RequestCanceller:
+    """別スレッドから送信中・ヘッダ待ち・受信中のリクエストを打ち切るためのハンドル
+
+    HttpSession.request(..., canceller=...) に渡すと、接続を取得した時点で結び付けられ、
+    cancel() はその接続のソケットを切断する (接続前なら接続直後に打ち切る)。
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def attach(self, conn):
+        with self._lock:
+            self._conn = conn
+            cancelled = self.cancelled
+        if cancelled:
+            conn.close()
+            raise RequestCancelled("request cancelled")
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled("request cancelled")
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conn = self._conn
+        sock = conn.sock if conn is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class PooledResponse:
+    """HTTPResponse のラッパー。読み切った接続はプールに戻し、途中で閉じた接続は破棄する"""
+
+    def __init__(self, session, key, conn, response, canceller=None):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        # 計測用: 送信したボディのバイト数と、再送した回数 (再接続・トークン更新)
+        self.request_bytes = 0
+        self.retries = 0
+        self._aborted = False
+        self._canceller = canceller
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+    def __iter__(self):
+        return iter(self._response)
+
+    def abort(self):
+        """別スレッドから受信を打ち切る (ブロック中の read は例外で戻る)。接続はプールに戻さない"""
+        self._aborted = True
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        aborted = self._aborted or (self._canceller is not None and self._canceller.cancelled)
+        if self._response.isclosed() and not self._response.will_close and not aborted:
+            self._session._release(self._key, conn)
+        else:
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class HttpSession:
+    """ホストごとに keep-alive 接続をプールして再利用する HTTP クライアント"""
+
+    def __init__(self, token_provider=None, timeout=DEFAULT_TIMEOUT, retry_policy=None,
+                 rate_limit=RATE_LIMIT_QPS, burst=RATE_LIMIT_BURST):
+        self.token_provider = token_provider or AccessTokenProvider()
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy(MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self._idle = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, url):
+        """URL のホストに対応するレート制限を返す (無効化時は None)"""
+        if not self.rate_limit:
+            return None
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AdaptiveRateLimiter(self.rate_limit, self.burst)
+            return self._limiters[host]
+
+    @property
+    def limiters(self):
+        with self._lock:
+            return dict(self._limiters)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host = key
+        conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return conn_class(host, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS_PER_HOST:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, json_body=None, headers=None, auth=False, idempotent=None,
+                canceller=None):
+        """リクエストを送り PooledResponse を返す。2xx 以外は urllib.error.HTTPError を送出する
+
+        auth=True の場合は Bearer トークンを付与し、401 ならトークンを更新して1度だけ再送する。
+        429 は Retry-After に従って再送し、5xx・通信エラーは idempotent なリクエストのみ
+        指数バックオフで再送する (idempotent を省略するとメソッドから判定する)。
+        再試行しきれなかった例外には retries 属性 (再送した回数) を付ける。
+        canceller (RequestCanceller) で打ち切った場合は再試行せず RequestCancelled を送出する。
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        limiter = self.limiter(url)
+        attempt = 0
+        token_refreshed = False
+        while True:
+            if canceller:
+                canceller.check()
+            req_headers = dict(headers or {})
+            if json_body is not None:
+                req_headers.setdefault("Content-Type", "application/json")
+            if auth:
+                req_headers["Authorization"] = f"Bearer {self.token_provider.token()}"
+            if limiter:
+                limiter.acquire()
+            try:
+                response = self._send(method, url, json_body, req_headers, canceller)
+            except urllib.error.HTTPError as e:
+                if auth and e.code == 401 and not token_refreshed:
+                    self.token_provider.invalidate()
+                    token_refreshed = True
+                    continue
+                retry_after = parse_retry_after(e.headers.get("Retry-After")) if e.headers else None
+                if e.code == 429 and limiter:
+                    limiter.on_throttle(retry_after)
+                if not self.retry_policy.should_retry(attempt, e.code, idempotent):
+                    e.retries = attempt + token_refreshed
+                    raise
+                time.sleep(self.retry_policy.delay(attempt, retry_after))
+                attempt += 1
+                continue
+            except CONNECTION_ERRORS as e:
+                if not self.retry_policy.should_retry(attempt, None, idempotent):
+                    e.retries = attempt + token_refreshed
+                    raise
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            if limiter:
+                limiter.on_success()
+            response.retries += attempt + token_refreshed
+            return response
+
+    def _send(self, method, url, json_body, headers, canceller=None):
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        body = json.dumps(json_body).encode("utf-8") if json_body is not None else None
+
+        reconnects = 0
+        while True:
+            conn, reused = self._acquire(key)
+            if canceller:
+                # ヘッダを待っている間もキャンセルで切断できるよう、送信前に接続を結び付けておく
+                canceller.attach(conn)
+            try:
+                if canceller:
+                    if conn.sock is None:
+                        conn.connect()
+                    canceller.check()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if canceller:
+                    canceller.check()
+                # サーバ側でタイムアウトしたアイドル接続だった場合のみ新しい接続で送り直す
+                if not reused:
+                    raise
+                reconnects += 1
+            except Exception:
+                # タイムアウト等その他の失敗でもソケットを残さない (再試行のたびに溜まらないように)
+                conn.close()
+                if canceller:
+                    canceller.check()
+                raise
+
+        if not 200 <= response.status < 300:
+            try:
+                error_body = response.read()
+            finally:
+                conn.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+        pooled = PooledResponse(self, key, conn, response, canceller)
+        pooled.request_bytes = len(body or b"")
+        pooled.retries = reconnects
+        return pooled
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+def session():
+    """プロセス共通の HttpSession を返す"""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = HttpSession()
+        return _default_session
+
+def access_token():
+    """キャッシュ済み (または新規取得した) gcloud のアクセストークンを返す"""
+    return session().token_provider.token()
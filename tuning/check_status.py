@@ -1,28 +1,152 @@
-import subprocess
-import urllib.request
+import argparse
 import json
+import os
+import random
 import sys
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.vertex_client import CONNECTION_ERRORS, session
 
 PROJECT_ID = "gen-lang-client-0646195883"
 REGION = "us-central1"
 JOB_ID = "8139917865869377536"
 
-try:
-    token = subprocess.check_output(["./google-cloud-sdk/bin/gcloud", "auth", "print-access-token"], text=True).strip()
-    
-    url = f"https://{REGION}-aiplatform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/tuningJobs/{JOB_ID}"
-    req = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}"})
-    
-    with urllib.request.urlopen(req) as res:
-        data = json.loads(res.read())
-        print(json.dumps(data, indent=2))
-        
-        state = data.get("state")
-        tuned_model = data.get("tunedModel")
-        
-        print(f"\nState: {state}")
-        if tuned_model:
-            print(f"Tuned Model ID: {tuned_model.get('model')}") # Structure might vary
-        
-except Exception as e:
-    print(f"Error: {e}")
+TERMINAL_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+}
+# watch モードの終了コード
+EXIT_ALL_SUCCEEDED = 0
+EXIT_SOME_FAILED = 1
+EXIT_TIMEOUT = 2
+
+_print_lock = threading.Lock()
+
+def log(message):
+    with _print_lock:
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+def job_url(job_id):
+    # `projects/.../tuningJobs/<ID>` 形式のリソース名も受け付ける
+    job_id = job_id.rstrip("/").split("/")[-1]
+    return f"https://{REGION}-aiplatform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/tuningJobs/{job_id}"
+
+def fetch_job(job_id):
+    with session().request("GET", job_url(job_id), auth=True) as res:
+        return json.loads(res.read())
+
+def tuned_model_ids(data):
+    tuned_model = data.get("tunedModel") or {}
+    return {k: tuned_model[k] for k in ("model", "endpoint") if tuned_model.get(k)}
+
+def check_once(job_id):
+    data = fetch_job(job_id)
+    print(json.dumps(data, indent=2))
+
+    state = data.get("state")
+    tuned_model = data.get("tunedModel")
+
+    print(f"\nState: {state}")
+    if tuned_model:
+        print(f"Tuned Model ID: {tuned_model.get('model')}") # Structure might vary
+
+def watch_job(job_id, interval, max_interval, deadline, stop):
+    """1件のジョブを終了状態になるまでポーリングし、最終状態 (タイムアウト時は None) を返す
+
+    状態が変わらない間は待ち時間を倍々に伸ばし (上限 max_interval)、ジッタで問い合わせを分散させる。
+    出力するのは状態の遷移と、新たに判明したチューニング済みモデルの ID のみ。
+    通信エラー・429・5xx は一時的な失敗として問い合わせを続ける。それ以外の HTTP エラー
+    (ジョブ ID の誤りによる 404 など) は再試行しても直らないため、"HTTP_ERROR_<コード>" を最終状態として返す。
+    """
+    state = None
+    known_ids = {}
+    wait = interval
+    while not stop.is_set():
+        try:
+            data = fetch_job(job_id)
+        except urllib.error.HTTPError as e:
+            if e.code != 429 and e.code < 500:
+                log(f"{job_id}: HTTP {e.code} ({e.reason}), giving up")
+                return f"HTTP_ERROR_{e.code}"
+            wait = min(wait * 2, max_interval)
+            log(f"{job_id}: HTTP {e.code} ({e.reason}), retrying in ~{wait:.0f}s")
+        except (*CONNECTION_ERRORS, urllib.error.URLError) as e:
+            wait = min(wait * 2, max_interval)
+            log(f"{job_id}: error ({e}), retrying in ~{wait:.0f}s")
+        else:
+            new_state = data.get("state")
+            if new_state != state:
+                log(f"{job_id}: {state or '-'} -> {new_state}")
+                state = new_state
+                wait = interval
+            else:
+                wait = min(wait * 2, max_interval)
+            for kind, value in tuned_model_ids(data).items():
+                if known_ids.get(kind) != value:
+                    known_ids[kind] = value
+                    log(f"{job_id}: tuned {kind} = {value}")
+            if state in TERMINAL_STATES:
+                if data.get("error"):
+                    log(f"{job_id}: {data['error'].get('message', data['error'])}")
+                return state
+
+        sleep_for = wait * random.uniform(0.8, 1.2)
+        if deadline and time.monotonic() + sleep_for > deadline:
+            return None
+        stop.wait(sleep_for)
+    return None
+
+def watch(job_ids, interval, max_interval, timeout):
+    """複数ジョブを並行して監視し、終了コードを返す"""
+    deadline = time.monotonic() + timeout if timeout else None
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(job_ids)) as executor:
+        futures = {
+            job_id: executor.submit(watch_job, job_id, interval, max_interval, deadline, stop)
+            for job_id in job_ids
+        }
+        try:
+            final = {job_id: future.result() for job_id, future in futures.items()}
+        except BaseException:
+            # 中断時や想定外の例外 (コードの不具合) では、他のジョブの監視も止めてから送出する
+            stop.set()
+            raise
+
+    print("\nSummary:")
+    for job_id, state in final.items():
+        print(f"  {job_id}: {state or 'TIMEOUT'}")
+    if any(state is None for state in final.values()):
+        return EXIT_TIMEOUT
+    if all(state == "JOB_STATE_SUCCEEDED" for state in final.values()):
+        return EXIT_ALL_SUCCEEDED
+    return EXIT_SOME_FAILED
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Check or watch Vertex AI tuning jobs.")
+    parser.add_argument("job_ids", nargs="*", default=[JOB_ID], help="Tuning job IDs or resource names.")
+    parser.add_argument("--watch", action="store_true", help="Poll until every job reaches a terminal state.")
+    parser.add_argument("--interval", type=float, default=30, help="Initial polling interval in seconds (watch mode).")
+    parser.add_argument("--max-interval", type=float, default=600, help="Maximum polling interval in seconds (watch mode).")
+    parser.add_argument("--timeout", type=float, help="Give up after this many seconds (watch mode, exit code 2).")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.watch:
+        sys.exit(watch(args.job_ids, args.interval, args.max_interval, args.timeout))
+    failed = False
+    for job_id in args.job_ids:
+        try:
+            check_once(job_id)
+        except (urllib.error.URLError, *CONNECTION_ERRORS) as e:
+            print(f"Error: {e}")
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -1,47 +1,156 @@
+import argparse
 import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-input_file = "data/source.jsonl"
-output_file = "data/training.jsonl"
-
-def convert():
-    with open(input_file, 'r', encoding='utf-8') as infile, \
-         open(output_file, 'w', encoding='utf-8') as outfile:
-        
-        for line in infile:
-            if not line.strip(): continue
-            
-            # Original format: {"messages": [{"role": "user", "content": "A"}, {"role": "assistant", "content": "B"}]}
-            entry = json.loads(line)
-            messages = entry.get("messages", [])
-            
-            # Target format: 
-            # {
-            #   "contents": [
-            #     {"role": "user", "parts": [{"text": "A"}]},
-            #     {"role": "model", "parts": [{"text": "B"}]}
-            #   ]
-            # }
-            
-            new_contents = []
-            for msg in messages:
-                role = msg.get("role")
-                # Map 'assistant' to 'model'
-                if role == "assistant":
-                    role = "model"
-                
-                content_text = msg.get("content", "")
-                
-                new_contents.append({
-                    "role": role,
-                    "parts": [{"text": content_text}]
-                })
-            
-            # Only write if we have a valid conversation pair
-            if new_contents:
-                new_entry = {"contents": new_contents}
-                outfile.write(json.dumps(new_entry, ensure_ascii=False) + "\n")
-
-    print(f"Converted {input_file} to {output_file}")
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json でパースする
+    orjson = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+input_file = os.path.join(SCRIPT_DIR, "data", "source.jsonl")
+output_file = os.path.join(SCRIPT_DIR, "data", "training.jsonl")
+
+# 1タスクあたりの行数と、同時に保持する未完了タスク数 (ワーカー数の倍数)。
+# 入力全体を読み込まず、常にこの範囲だけをメモリに置く。
+CHUNK_LINES = 2000
+MAX_PENDING_PER_WORKER = 2
+
+def loads(line):
+    return orjson.loads(line) if orjson else json.loads(line)
+
+def dumps(obj):
+    # 出力は codec によらず従来と同じ書式 (区切り文字) に揃える
+    return json.dumps(obj, ensure_ascii=False)
+
+def convert_entry(entry):
+    """1件の会話を Vertex AI 形式に変換し、(変換結果, エラー内容) を返す"""
+    # Original format: {"messages": [{"role": "user", "content": "A"}, {"role": "assistant", "content": "B"}]}
+    messages = entry.get("messages", [])
+
+    # Target format:
+    # {
+    #   "contents": [
+    #     {"role": "user", "parts": [{"text": "A"}]},
+    #     {"role": "model", "parts": [{"text": "B"}]}
+    #   ]
+    # }
+    new_contents = []
+    for i, msg in enumerate(messages):
+        role = msg.get("role")
+        # Map 'assistant' to 'model'
+        if role == "assistant":
+            role = "model"
+        if role not in ("user", "model"):
+            return None, f"unknown role {role!r} at turn {i}"
+
+        # user から始まり user / model が交互に並ぶ必要がある
+        expected = "user" if i % 2 == 0 else "model"
+        if role != expected:
+            return None, f"role alternation broken at turn {i} (expected {expected}, got {role})"
+
+        content_text = msg.get("content", "")
+        if not isinstance(content_text, str) or not content_text.strip():
+            return None, f"empty turn at turn {i}"
+
+        new_contents.append({
+            "role": role,
+            "parts": [{"text": content_text}]
+        })
+
+    # Only write if we have a valid conversation pair
+    if not new_contents:
+        return None, "no messages"
+    if new_contents[-1]["role"] != "model":
+        return None, "conversation does not end with a model turn"
+    return {"contents": new_contents}, None
+
+def convert_chunk(chunk):
+    """(行番号, 行) のリストを変換し、(出力行のリスト, [(行番号, エラー内容)]) を返す"""
+    output_lines, errors = [], []
+    for line_no, line in chunk:
+        try:
+            entry = loads(line)
+        except ValueError as e:
+            errors.append((line_no, f"invalid JSON: {e}"))
+            continue
+        new_entry, error = convert_entry(entry)
+        if error:
+            errors.append((line_no, error))
+        else:
+            output_lines.append(dumps(new_entry) + "\n")
+    return output_lines, errors
+
+def read_chunks(infile, chunk_lines):
+    chunk = []
+    for line_no, line in enumerate(infile, start=1):
+        if not line.strip():
+            continue
+        chunk.append((line_no, line))
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def convert(input_path=input_file, output_path=output_file, workers=None, chunk_lines=CHUNK_LINES):
+    """input_path をチャンクに分けてプロセスプールで変換し、入力順のまま output_path に書き出す"""
+    workers = workers or os.cpu_count() or 1
+    started_at = time.monotonic()
+    written = 0
+    errors = []
+
+    with open(input_path, "r", encoding="utf-8") as infile, \
+         open(output_path, "w", encoding="utf-8") as outfile, \
+         ProcessPoolExecutor(max_workers=workers) as executor:
+
+        pending = deque()
+
+        def drain_one():
+            nonlocal written
+            output_lines, chunk_errors = pending.popleft().result()
+            outfile.writelines(output_lines)
+            written += len(output_lines)
+            errors.extend(chunk_errors)
+
+        for chunk in read_chunks(infile, chunk_lines):
+            pending.append(executor.submit(convert_chunk, chunk))
+            # 先頭のタスクから順に書き出すことで出力順を保ち、保持するチャンク数を抑える
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                drain_one()
+        while pending:
+            drain_one()
+
+    elapsed = time.monotonic() - started_at
+    size_mb = os.path.getsize(input_path) / 1024 / 1024
+    print(f"Converted {input_path} to {output_path}")
+    print(
+        f"{written} examples written, {len(errors)} skipped "
+        f"in {elapsed:.2f}s ({written / elapsed if elapsed else 0:.0f} examples/s, "
+        f"{size_mb / elapsed if elapsed else 0:.1f} MB/s, {workers} workers, "
+        f"json codec: {'orjson' if orjson else 'json'})"
+    )
+    for line_no, error in errors[:20]:
+        print(f"  line {line_no}: {error}", file=sys.stderr)
+    if len(errors) > 20:
+        print(f"  ... and {len(errors) - 20} more", file=sys.stderr)
+    return written, errors
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert chat-format JSONL into Vertex AI tuning format.")
+    parser.add_argument("--input", default=input_file, help="Source JSONL path ({\"messages\": [...]} per line).")
+    parser.add_argument("--output", default=output_file, help="Output JSONL path for Vertex AI tuning.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--chunk-lines", type=int, default=CHUNK_LINES, help="Lines per worker task.")
+    parser.add_argument("--strict", action="store_true", help="Exit with status 1 if any example is skipped.")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    convert()
+    args = parse_arguments()
+    _, skipped = convert(args.input, args.output, args.workers, args.chunk_lines)
+    if args.strict and skipped:
+        sys.exit(1)
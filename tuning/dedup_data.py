@@ -0,0 +1,323 @@
+import argparse
+import json
+import operator
+import os
+import random
+import sys
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無い環境では純Pythonで MinHash を計算する
+    np = None
+
+from convert_data import CHUNK_LINES, MAX_PENDING_PER_WORKER, loads, read_chunks
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+input_file = os.path.join(SCRIPT_DIR, "data", "training.jsonl")
+output_file = os.path.join(SCRIPT_DIR, "data", "training.dedup.jsonl")
+report_file = os.path.join(SCRIPT_DIR, "data", "dedup_report.json")
+
+# --- 近似重複検出 (MinHash + LSH) ---
+# 会話全体を正規化して文字 n-gram に分割し、MinHash 署名を LSH のバンドに分けて
+# 同じバケットに入った組だけを比較する (全ペア比較をしない)。
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+DEFAULT_THRESHOLD = 0.8
+MERSENNE_PRIME = (1 << 31) - 1
+SEED = 42
+
+def _permutations(num_perm, seed=SEED):
+    rng = random.Random(seed)
+    a = [rng.randrange(1, MERSENNE_PRIME) for _ in range(num_perm)]
+    b = [rng.randrange(0, MERSENNE_PRIME) for _ in range(num_perm)]
+    return a, b
+
+def entry_text(entry):
+    """学習データ形式 (contents) と元データ形式 (messages) の両方から会話全文を取り出す"""
+    if "contents" in entry:
+        return "\n".join(
+            part.get("text", "") for turn in entry["contents"] for part in turn.get("parts", [])
+        )
+    return "\n".join(msg.get("content", "") for msg in entry.get("messages", []))
+
+def shingles(text, size=SHINGLE_SIZE):
+    """NFKC 正規化・空白除去したテキストの文字 n-gram をハッシュ値の集合で返す
+
+    日本語は単語境界が無いため、単語ではなく文字単位で切り出す。
+    """
+    normalized = "".join(unicodedata.normalize("NFKC", text).split())
+    if len(normalized) <= size:
+        return {zlib.crc32(normalized.encode("utf-8")) % MERSENNE_PRIME}
+    return {
+        zlib.crc32(normalized[i:i + size].encode("utf-8")) % MERSENNE_PRIME
+        for i in range(len(normalized) - size + 1)
+    }
+
+def minhash(shingle_set, a, b):
+    """MinHash 署名 (num_perm 個の最小ハッシュ値) を array('I') で返す"""
+    if np is not None:
+        x = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+        hashed = (np.asarray(a, dtype=np.uint64)[:, None] * x[None, :]
+                  + np.asarray(b, dtype=np.uint64)[:, None]) % MERSENNE_PRIME
+        return array("I", hashed.min(axis=1).astype(np.uint32).tobytes())
+    return array("I", [min((ai * x + bi) % MERSENNE_PRIME for x in shingle_set) for ai, bi in zip(a, b)])
+
+def signature_chunk(args):
+    """(行番号, 行) のチャンクから [(行番号, 署名バイト列)] と [(行番号, エラー内容)] を返す (ワーカープロセス用)"""
+    chunk, shingle_size, num_perm = args
+    a, b = _permutations(num_perm)
+    results, errors = [], []
+    for line_no, line in chunk:
+        try:
+            entry = loads(line)
+        except ValueError as e:
+            errors.append((line_no, f"invalid JSON: {e}"))
+            continue
+        results.append((line_no, minhash(shingles(entry_text(entry), shingle_size), a, b).tobytes()))
+    return results, errors
+
+# LSH のパラメータ選びで、見逃し (threshold 以上なのに候補にならない) を誤検出より重く扱う重み。
+# 誤検出は署名の比較で除けるが、見逃しは取り戻せないため
+FALSE_POSITIVE_WEIGHT = 0.1
+FALSE_NEGATIVE_WEIGHT = 0.9
+
+def candidate_probability(similarity, bands, rows):
+    """Jaccard 類似度 similarity の組が、いずれかのバンドで同じバケットに入る確率 (S字カーブ)"""
+    return 1 - (1 - similarity ** rows) ** bands
+
+def _integrate(func, low, high, steps=100):
+    width = (high - low) / steps
+    return sum(func(low + (i + 0.5) * width) for i in range(steps)) * width
+
+def lsh_params(num_perm, threshold):
+    """bands × rows <= num_perm のうち、threshold 前後の誤検出と見逃しの重み付き面積が最小の組を返す
+
+    S字カーブの切れ目を threshold ちょうどに合わせると、threshold 付近の組の半分近くを見逃す。
+    見逃しを重く見ることで切れ目を threshold より下に寄せ、余分な候補は署名の比較で除く。
+    """
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positive = _integrate(lambda s: candidate_probability(s, bands, rows), 0.0, threshold)
+            false_negative = _integrate(lambda s: 1 - candidate_probability(s, bands, rows), threshold, 1.0)
+            error = FALSE_POSITIVE_WEIGHT * false_positive + FALSE_NEGATIVE_WEIGHT * false_negative
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+    return best[1], best[2]
+
+def estimated_jaccard(sig1, sig2):
+    return sum(map(operator.eq, sig1, sig2)) / len(sig1)
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            # 代表は常に先に出現した例 (小さいインデックス) にする
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+def _link_bucket(members, signatures, threshold, uf):
+    """バケット内の組を比較して、threshold 以上の組を同じクラスタにまとめる。比較回数を返す
+
+    既に同じクラスタにつながった例とは比較しないため、全組を比較した場合と同じクラスタになり、
+    完全一致の重複ばかりの巨大バケットでも比較回数はほぼ線形に収まる。
+    """
+    comparisons = 0
+    groups = {}  # クラスタの代表 -> このバケットで処理済みのメンバー
+    for j in members:
+        for root, group in groups.items():
+            if uf.find(root) == uf.find(j):
+                continue
+            for i in group:
+                comparisons += 1
+                if estimated_jaccard(signatures[i], signatures[j]) >= threshold:
+                    uf.union(i, j)
+                    break
+        # j とつながったグループを、最大のグループに追記する形で1つにまとめる (コピーを避ける)
+        root_j = uf.find(j)
+        linked = sorted((groups.pop(r) for r in [r for r in groups if uf.find(r) == root_j]), key=len, reverse=True)
+        merged = linked[0] if linked else []
+        merged.append(j)
+        for group in linked[1:]:
+            merged.extend(group)
+        groups[root_j] = merged
+    return comparisons
+
+def find_clusters(signatures, num_perm, threshold):
+    """署名のリストから近似重複のクラスタ ({代表インデックス: [メンバー]}) を返す"""
+    bands, rows = lsh_params(num_perm, threshold)
+    uf = UnionFind(len(signatures))
+    candidates = 0
+    for band in range(bands):
+        buckets = defaultdict(list)
+        start = band * rows
+        for i, sig in enumerate(signatures):
+            buckets[sig[start:start + rows].tobytes()].append(i)
+        for members in buckets.values():
+            if len(members) > 1:
+                candidates += _link_bucket(members, signatures, threshold, uf)
+
+    clusters = defaultdict(list)
+    for i in range(len(signatures)):
+        clusters[uf.find(i)].append(i)
+    return {root: members for root, members in clusters.items() if len(members) > 1}, candidates
+
+def check_recall(threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM, margin=0.02, pairs=300, set_size=400, seed=SEED):
+    """Jaccard 類似度がちょうど threshold + margin の合成ペアのうち、重複として検出できた割合を返す
+
+    文字 n-gram のハッシュ集合を直接作り、LSH のパラメータと署名の推定誤差を合わせた検出率を確かめる。
+    """
+    rng = random.Random(seed)
+    a, b = _permutations(num_perm)
+    similarity = min(1.0, threshold + margin)
+    # 共通部分 c、片側だけの要素 d ずつで Jaccard = c / (c + 2d)
+    different = round(set_size * (1 - similarity) / (1 + similarity))
+    common = set_size - different
+    signatures = []
+    for _ in range(pairs):
+        values = rng.sample(range(MERSENNE_PRIME), common + 2 * different)
+        shared = values[:common]
+        signatures.append(minhash(set(shared + values[common:common + different]), a, b))
+        signatures.append(minhash(set(shared + values[common + different:]), a, b))
+    clusters, _ = find_clusters(signatures, num_perm, threshold)
+    found = sum(1 for members in clusters.values() for m in members if m % 2 == 1)
+    return found / pairs
+
+def dedup(input_path=input_file, output_path=output_file, report_path=report_file,
+          threshold=DEFAULT_THRESHOLD, shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM, workers=None):
+    """近似重複を除いたデータセットとクラスタレポートを書き出す"""
+    workers = workers or os.cpu_count() or 1
+    started_at = time.monotonic()
+
+    # 1. 署名の計算 (プロセスプールで並列化、メモリには署名のみを保持する)
+    # JSON として読めなかった行は署名を作らず、出力からも除く
+    line_numbers, signatures, errors = [], [], []
+    with open(input_path, "r", encoding="utf-8") as infile, \
+         ProcessPoolExecutor(max_workers=workers) as executor:
+
+        pending = deque()
+
+        def drain_one():
+            results, chunk_errors = pending.popleft().result()
+            errors.extend(chunk_errors)
+            for line_no, sig_bytes in results:
+                sig = array("I")
+                sig.frombytes(sig_bytes)
+                line_numbers.append(line_no)
+                signatures.append(sig)
+
+        for chunk in read_chunks(infile, CHUNK_LINES):
+            pending.append(executor.submit(signature_chunk, (chunk, shingle_size, num_perm)))
+            # 未完了のチャンク数を抑え、入力ファイル全体をキューに積まないようにする
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                drain_one()
+        while pending:
+            drain_one()
+    signed_at = time.monotonic()
+
+    # 2. LSH による候補抽出とクラスタリング
+    clusters, candidates = find_clusters(signatures, num_perm, threshold)
+    drop = {i for members in clusters.values() for i in members[1:]}
+    drop_lines = {line_numbers[i] for i in drop}
+    representative_of = {m: root for root, members in clusters.items() for m in members}
+
+    # 3. 重複を除いた出力と、クラスタごとのレポート
+    previews = {}
+    written = 0
+    with open(input_path, "r", encoding="utf-8") as infile, \
+         open(output_path, "w", encoding="utf-8") as outfile:
+        index_of_line = {line_no: i for i, line_no in enumerate(line_numbers)}
+        for line_no, line in enumerate(infile, start=1):
+            i = index_of_line.get(line_no)
+            if i is None:
+                continue
+            if i in representative_of:
+                try:
+                    previews[i] = entry_text(loads(line))[:80]
+                except ValueError:
+                    # 署名の計算後にファイルが書き換えられた場合など
+                    previews[i] = ""
+            if line_no not in drop_lines:
+                outfile.write(line if line.endswith("\n") else line + "\n")
+                written += 1
+
+    report = {
+        "input": input_path,
+        "examples": len(signatures),
+        "kept": written,
+        "removed": len(drop),
+        "skipped": [{"line": line_no, "error": error} for line_no, error in errors],
+        "threshold": threshold,
+        "shingle_size": shingle_size,
+        "num_perm": num_perm,
+        "lsh": dict(zip(("bands", "rows"), lsh_params(num_perm, threshold))),
+        "clusters": [
+            {
+                "representative_line": line_numbers[root],
+                "duplicate_lines": [line_numbers[m] for m in members[1:]],
+                "similarity": [round(estimated_jaccard(signatures[root], signatures[m]), 3) for m in members[1:]],
+                "preview": previews.get(root, ""),
+            }
+            for root, members in sorted(clusters.items())
+        ],
+    }
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    elapsed = time.monotonic() - started_at
+    print(f"Deduplicated {input_path} -> {output_path}")
+    print(
+        f"{len(signatures)} examples, {len(clusters)} clusters, {len(drop)} removed, {written} kept, "
+        f"{len(errors)} skipped "
+        f"({candidates} candidate pairs checked; signatures {signed_at - started_at:.2f}s, "
+        f"total {elapsed:.2f}s, {workers} workers)"
+    )
+    print(f"Cluster report: {report_path}")
+    for line_no, error in errors[:20]:
+        print(f"  line {line_no}: {error}", file=sys.stderr)
+    if len(errors) > 20:
+        print(f"  ... and {len(errors) - 20} more", file=sys.stderr)
+    return report
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Remove near-duplicate conversations from a tuning dataset (MinHash + LSH).")
+    parser.add_argument("--input", default=input_file, help="Input JSONL (training or source format).")
+    parser.add_argument("--output", default=output_file, help="Deduplicated JSONL path.")
+    parser.add_argument("--report", default=report_file, help="Cluster report JSON path.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Estimated Jaccard similarity treated as duplicate.")
+    parser.add_argument("--shingle-size", type=int, default=SHINGLE_SIZE, help="Character n-gram size.")
+    parser.add_argument("--num-perm", type=int, default=NUM_PERM, help="Number of MinHash permutations.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--check-recall", action="store_true", help="Only report the detection rate of synthetic pairs just above --threshold.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if not 0 < args.threshold <= 1:
+        print("Error: --threshold must be in (0, 1].")
+        sys.exit(1)
+    if args.check_recall:
+        bands, rows = lsh_params(args.num_perm, args.threshold)
+        for margin in (0.02, 0.05, 0.1):
+            similarity = min(1.0, args.threshold + margin)
+            print(
+                f"Jaccard {similarity:.2f}: recall {check_recall(args.threshold, args.num_perm, margin):.1%} "
+                f"(LSH {bands} bands x {rows} rows, candidate probability {candidate_probability(similarity, bands, rows):.1%})"
+            )
+        sys.exit(0)
+    dedup(args.input, args.output, args.report, args.threshold, args.shingle_size, args.num_perm, args.workers)
@@ -1,8 +1,13 @@
 import os
-import google.generativeai as genai
+import json
+import sys
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.vertex_client import session
 
 API_KEY = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=API_KEY)
+MODELS_URL = "https://generativelanguage.googleapis.com/v1beta/models"
 
 models_to_check = [
     "models/gemini-1.5-flash-001",
@@ -11,8 +16,22 @@ models_to_check = [
     "models/gemini-1.0-pro-001-tuning"
 ]
 
+def list_models():
+    """Gemini API のモデル一覧をページングしながら返す (共通クライアントの keep-alive 接続を使う)"""
+    page_token = None
+    while True:
+        params = {"key": API_KEY, "pageSize": 1000}
+        if page_token:
+            params["pageToken"] = page_token
+        with session().request("GET", f"{MODELS_URL}?{urllib.parse.urlencode(params)}") as res:
+            data = json.loads(res.read())
+        yield from data.get("models", [])
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            return
+
 print("Checking specific models:")
-for m in genai.list_models():
-    if m.name in models_to_check or "tuning" in m.name:
-        print(f"- {m.name}")
-        print(f"  Methods: {m.supported_generation_methods}")
+for m in list_models():
+    if m["name"] in models_to_check or "tuning" in m["name"]:
+        print(f"- {m['name']}")
+        print(f"  Methods: {m.get('supportedGenerationMethods', [])}")
@@ -0,0 +1,239 @@
+import argparse
+import heapq
+import importlib
+import json
+import math
+import os
+import re
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from convert_data import CHUNK_LINES, MAX_PENDING_PER_WORKER, loads, read_chunks
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+input_file = os.path.join(SCRIPT_DIR, "data", "training.jsonl")
+
+# --- 学習データのトークン数・コスト見積もり ---
+# ジョブを投入する前に、データセットのトークン数と課金額をローカルで概算する。
+
+# start_tuning.py の hyperParameters.epochCount と合わせる
+DEFAULT_EPOCHS = 5
+# 教師ありチューニングの学習トークン単価 (USD / 100万トークン)。料金改定時は --price-per-million で上書きする
+DEFAULT_PRICE_PER_MILLION = 5.0
+# Vertex AI の1例あたりの最大トークン数
+DEFAULT_MAX_EXAMPLE_TOKENS = 131072
+TOP_N = 10
+
+# ひらがな・カタカナ / CJK統合漢字 / CJK互換漢字 / 全角英数・記号 / 和文の句読点
+CJK_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef\u3000-\u303f]")
+
+def heuristic_tokens(text):
+    """日本語は1文字≒1トークン、それ以外は4文字≒1トークンとして概算する"""
+    cjk = len(CJK_CHARS.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def char_tokens(text):
+    """文字数をそのままトークン数とみなす (最も保守的な見積もり)"""
+    return len(text)
+
+TOKENIZERS = {
+    "heuristic": heuristic_tokens,
+    "chars": char_tokens,
+}
+
+def load_tokenizer(spec):
+    """組み込み名、または `module:function` 形式の任意の関数 (text -> int) を返す"""
+    if spec in TOKENIZERS:
+        return TOKENIZERS[spec]
+    module_name, _, func_name = spec.partition(":")
+    if not func_name:
+        raise ValueError(f"unknown tokenizer: {spec} (use {', '.join(TOKENIZERS)} or module:function)")
+    return getattr(importlib.import_module(module_name), func_name)
+
+def entry_turns(entry):
+    """学習データ形式 (contents) と元データ形式 (messages) の両方から (ロール, テキスト) を返す"""
+    if "contents" in entry:
+        return [
+            (turn.get("role"), "".join(p.get("text", "") for p in turn.get("parts", [])))
+            for turn in entry["contents"]
+        ]
+    return [
+        ("model" if msg.get("role") == "assistant" else msg.get("role"), msg.get("content", ""))
+        for msg in entry.get("messages", [])
+    ]
+
+def profile_chunk(args):
+    """チャンク内の各例のトークン数を数える (ワーカープロセス用)
+
+    [(行番号, 例のトークン数)]、ロールごとの発話トークン数、JSON として読めなかった行番号を返す。
+    """
+    chunk, tokenizer_spec = args
+    count = load_tokenizer(tokenizer_spec)
+    examples = []
+    turns = {}
+    invalid = []
+    for line_no, line in chunk:
+        try:
+            entry = loads(line)
+        except ValueError:
+            invalid.append(line_no)
+            continue
+        total = 0
+        for role, text in entry_turns(entry):
+            tokens = count(text)
+            turns.setdefault(role, []).append(tokens)
+            total += tokens
+        examples.append((line_no, total))
+    return examples, turns, invalid
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def _distribution(values):
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 1) if ordered else 0,
+        "p50": _percentile(ordered, 0.5),
+        "p95": _percentile(ordered, 0.95),
+        "max": ordered[-1] if ordered else 0,
+    }
+
+def _histogram(values):
+    """2のべき乗ごとのバケットに分けた件数を返す"""
+    buckets = {}
+    for v in values:
+        upper = 1 << max(0, (v - 1).bit_length()) if v > 0 else 0
+        buckets[upper] = buckets.get(upper, 0) + 1
+    return sorted(buckets.items())
+
+def profile(input_path=input_file, tokenizer="heuristic", epochs=DEFAULT_EPOCHS,
+            price_per_million=DEFAULT_PRICE_PER_MILLION, max_example_tokens=DEFAULT_MAX_EXAMPLE_TOKENS,
+            max_total_tokens=None, max_cost=None, fail_fast=False, workers=None):
+    """データセットを並列に集計し、(レポート, 上限違反のリスト) を返す"""
+    workers = workers or os.cpu_count() or 1
+    load_tokenizer(tokenizer)  # ワーカー起動前に指定ミスを検出する
+    started_at = time.monotonic()
+
+    example_tokens = array("Q")
+    turn_tokens = {}
+    biggest = []
+    violations = []
+    total = 0
+    totals_exceeded = False
+
+    def consume(examples, turns, invalid):
+        nonlocal total
+        violations.extend(f"line {line_no}: invalid JSON" for line_no in invalid)
+        for line_no, tokens in examples:
+            example_tokens.append(tokens)
+            total += tokens
+            heapq.heappush(biggest, (tokens, line_no))
+            if len(biggest) > TOP_N:
+                heapq.heappop(biggest)
+            if max_example_tokens and tokens > max_example_tokens:
+                violations.append(f"line {line_no}: {tokens} tokens > max example tokens {max_example_tokens}")
+        for role, values in turns.items():
+            turn_tokens.setdefault(role, array("Q")).extend(values)
+        check_totals()
+
+    def check_totals():
+        nonlocal totals_exceeded
+        if totals_exceeded:
+            return
+        billable = total * epochs
+        if max_total_tokens and billable > max_total_tokens:
+            violations.append(f"billable tokens > max total tokens {max_total_tokens}")
+            totals_exceeded = True
+        elif max_cost and billable / 1_000_000 * price_per_million > max_cost:
+            violations.append(f"estimated cost > ${max_cost}")
+            totals_exceeded = True
+
+    with open(input_path, "r", encoding="utf-8") as infile, \
+         ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in read_chunks(infile, CHUNK_LINES):
+            pending.append(executor.submit(profile_chunk, (chunk, tokenizer)))
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                consume(*pending.popleft().result())
+            if fail_fast and violations:
+                break
+        while pending and not (fail_fast and violations):
+            consume(*pending.popleft().result())
+        for future in pending:
+            future.cancel()
+
+    billable = total * epochs
+    report = {
+        "input": input_path,
+        "tokenizer": tokenizer,
+        "examples": len(example_tokens),
+        "total_tokens": total,
+        "epochs": epochs,
+        "billable_tokens": billable,
+        "estimated_cost_usd": round(billable / 1_000_000 * price_per_million, 2),
+        "example_tokens": _distribution(example_tokens),
+        "turn_tokens": {role: _distribution(values) for role, values in turn_tokens.items()},
+        "histogram": _histogram(example_tokens),
+        "biggest_examples": [{"line": line_no, "tokens": tokens} for tokens, line_no in sorted(biggest, reverse=True)],
+        "elapsed_sec": round(time.monotonic() - started_at, 2),
+        "complete": not (fail_fast and violations),
+    }
+    return report, violations
+
+def format_report(report):
+    lines = [
+        f"Dataset: {report['input']} (tokenizer: {report['tokenizer']})",
+        f"Examples: {report['examples']}",
+        f"Total tokens: {report['total_tokens']} x {report['epochs']} epochs = {report['billable_tokens']} billable tokens",
+        f"Estimated cost: ${report['estimated_cost_usd']}",
+        "",
+        "Tokens per example: " + ", ".join(f"{k}={v}" for k, v in report["example_tokens"].items()),
+    ]
+    for role, dist in report["turn_tokens"].items():
+        lines.append(f"Tokens per {role} turn: " + ", ".join(f"{k}={v}" for k, v in dist.items()))
+    lines += ["", "Histogram (tokens per example):"]
+    peak = max((count for _, count in report["histogram"]), default=0)
+    for upper, count in report["histogram"]:
+        bar = "#" * max(1, round(count / peak * 40)) if peak else ""
+        lines.append(f"  <= {upper:>7}: {count:>7} {bar}")
+    lines += ["", f"Biggest {len(report['biggest_examples'])} examples:"]
+    for item in report["biggest_examples"]:
+        lines.append(f"  line {item['line']}: {item['tokens']} tokens")
+    lines.append(f"\n({report['elapsed_sec']}s)")
+    return "\n".join(lines)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Estimate token counts and tuning cost of a JSONL dataset.")
+    parser.add_argument("--input", default=input_file, help="Dataset JSONL (training or source format).")
+    parser.add_argument("--tokenizer", default="heuristic", help=f"Token counter: {', '.join(TOKENIZERS)} or module:function.")
+    parser.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS, help="epochCount of the tuning job.")
+    parser.add_argument("--price-per-million", type=float, default=DEFAULT_PRICE_PER_MILLION, help="USD per 1M training tokens.")
+    parser.add_argument("--max-example-tokens", type=int, default=DEFAULT_MAX_EXAMPLE_TOKENS, help="Fail if any example exceeds this many tokens.")
+    parser.add_argument("--max-total-tokens", type=int, help="Fail if billable tokens (total x epochs) exceed this.")
+    parser.add_argument("--max-cost", type=float, help="Fail if the estimated cost (USD) exceeds this.")
+    parser.add_argument("--fail-fast", action="store_true", help="Stop reading as soon as a limit is exceeded.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--json", help="Also write the report as JSON to this path.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    report, violations = profile(
+        args.input, args.tokenizer, args.epochs, args.price_per_million,
+        args.max_example_tokens, args.max_total_tokens, args.max_cost, args.fail_fast, args.workers,
+    )
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(dict(report, violations=violations), f, ensure_ascii=False, indent=2)
+    if violations:
+        print("\nLimit exceeded:", file=sys.stderr)
+        for v in violations[:20]:
+            print(f"  {v}", file=sys.stderr)
+        sys.exit(1)
@@ -1,28 +1,14 @@
 import os
 import json
-import urllib.request
 import urllib.error
 import sys
-import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.vertex_client import session
 
 # User provided info
 PROJECT_ID = "gen-lang-client-0646195883"
 
-# Fetch Access Token via gcloud
-try:
-    print("Fetching access token via gcloud...")
-    # Using relative path to the installed gcloud (one level up)
-    SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-    PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
-    GCLOUD_PATH = os.path.join(PROJECT_ROOT, "google-cloud-sdk", "bin", "gcloud")
-    ACCESS_TOKEN = subprocess.check_output(
-        [GCLOUD_PATH, "auth", "print-access-token"],  
-        text=True
-    ).strip()
-except Exception as e:
-    print(f"Failed to get access token: {e}")
-    sys.exit(1)
-
 # Derived from https://storage.googleapis.com/saiteki-model/training_data_vertex.jsonl
 TRAINING_DATA_URI = "gs://saiteki-model/training_data_vertex.jsonl" 
 # Note: For local upload, it would be "tuning/data/training.jsonl" relative to project root, 
@@ -49,19 +35,12 @@ def tune_vertex():
         "baseModel": "gemini-2.5-flash" 
     }
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-    data = json.dumps(payload).encode("utf-8")
-    
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    
     print(f"Submitting Tuning Job to Vertex AI ({REGION})...")
     print(f"Payload: {json.dumps(payload, indent=2)}")
 
     try:
-        with urllib.request.urlopen(req) as response:
+        # アクセストークンは共通クライアントが必要になった時点で取得・キャッシュする
+        with session().request("POST", url, json_body=payload, auth=True) as response:
             resp_body = response.read().decode("utf-8")
             print("Job Submitted Successfully!")
             print(resp_body)